@@ -0,0 +1,144 @@
+"""Microbenchmark of request parsing: marshmallow vs the compiled fast path.
+
+    python -m bench.parse
+    python -m bench.parse --number 20000 --check 2000
+
+Per endpoint the payloads a client sends are loaded the way webargs did
+before (a new Schema instance and load()) and through fastparse.load().
+--check first loads randomly mutated payloads both ways and fails when
+a result or error message differs.
+"""
+import argparse
+import random
+import sys
+import timeit
+
+from marshmallow import ValidationError
+
+from wxcloudrun import fastparse
+from wxcloudrun import view_daily_record as views
+
+# endpoint -> (schema, payloads sent by the mini program)
+PAYLOADS = {
+    'wish': (views.NewWish, [{'wish': '身体健康，万事如意'}]),
+    'wish_bulk_create': (views.NewWishBulk, [
+        {'wishes': ['考试顺利', '早睡早起', '每天敲木鱼']}]),
+    'wish_list': (views.WishList, [
+        {'mode': 'list', 'last_id': 1200, 'page_num': 20},
+        {'mode': 'last', 'fulfill': True}]),
+    'wish_update': (views.WishUpdate, [
+        {'wish_id': 1234, 'count': 1, 'knock': 36},
+        {'wish_id': 1234, 'fulfill': True},
+        {'wish_id': 1234, 'gather_shared': True}]),
+    'wish_update_batch': (views.WishUpdateBatch, [
+        {'updates': [{'wish_id': 1200 + i, 'knock': 12} for i in range(8)]}]),
+    'wish_share_create': (views.WishShare, [
+        {'wish_id': 1234, 'share_content': True}]),
+    'wish_share_enter': (views.WishShareEnter, [
+        {'share_id': 'SH0f3a9c1e2b4d5a6f'}]),
+    'wish_share_update': (views.WishShareUpdate, [
+        {'share_id': 'SH0f3a9c1e2b4d5a6f', 'knock': 20},
+        {'share_id': 'SH0f3a9c1e2b4d5a6f',
+         'share_session': '5f1c0d3e9a8b4c7d6e5f4a3b2c1d0e9f', 'knock': 20}]),
+    'wish_share_stats': (views.WishShareStats, [{'wish_id': 1234}]),
+    'leaderboard': (views.Leaderboard, [
+        {}, {'board': 'helped', 'scope': 'user', 'limit': 20}]),
+    'wish_rank': (views.WishRank, [{'wish_id': 1234, 'board': 'count'}]),
+    'wish_history': (views.WishHistory, [
+        {'wish_id': 1234, 'start': '2026-01-01', 'end': '2026-03-31'}]),
+    'export': (views.Export, [{}, {'cursor': 'wish_share:1234,88'}]),
+}
+
+# values swapped into payloads by --check
+MUTATIONS = (None, True, False, 0, -1, 1, 1.5, 10 ** 9, '', '1', 'true',
+             'list', 'x' * 200, '2026-02-30', '2026-1-5', [], [{}], {})
+
+
+def _marshmallow(schema, data):
+  return schema().load(data)
+
+
+def _outcome(load, schema, data):
+  try:
+    return 'ok', load(schema, data)
+  except ValidationError as e:
+    return 'error', e.messages
+
+
+def _mutate(rnd, data):
+  data = dict(data)
+  op = rnd.random()
+  if op < 0.1:
+    data['unknown'] = 1
+  elif op < 0.2 and data:
+    del data[rnd.choice(sorted(data))]
+  elif data:
+    key = rnd.choice(sorted(data))
+    if isinstance(data[key], list) and data[key] and rnd.random() < 0.5:
+      items = list(data[key])
+      i = rnd.randrange(len(items))
+      items[i] = (_mutate(rnd, items[i]) if isinstance(items[i], dict)
+                  else rnd.choice(MUTATIONS))
+      data[key] = items
+    else:
+      data[key] = rnd.choice(MUTATIONS)
+  return data
+
+
+def check(rnd, rounds):
+  """Return the (endpoint, payload) pairs loading differently."""
+  diff = []
+  for label, (schema, payloads) in sorted(PAYLOADS.items()):
+    for _ in range(rounds):
+      data = _mutate(rnd, rnd.choice(payloads))
+      if rnd.random() < 0.3:
+        data = _mutate(rnd, data)
+      if (_outcome(_marshmallow, schema, data) !=
+          _outcome(fastparse.load, schema, data)):
+        diff.append((label, data))
+  return diff
+
+
+def bench(number):
+  res = {}
+  for label, (schema, payloads) in sorted(PAYLOADS.items()):
+    row = {}
+    for name, load in (('marshmallow', _marshmallow),
+                       ('fast', fastparse.load)):
+      seconds = min(timeit.repeat(
+          lambda: [load(schema, i) for i in payloads],
+          number=number, repeat=3))
+      row[name] = seconds / number / len(payloads) * 1e6
+    res[label] = row
+  return res
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--number', type=int, default=5000,
+                      help='loads per payload and repeat')
+  parser.add_argument('--check', type=int, default=500,
+                      help='mutated payloads compared per endpoint')
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args(argv)
+
+  if args.check:
+    diff = check(random.Random(args.seed), args.check)
+    for label, data in diff:
+      print('DIFFERS {} {!r}'.format(label, data))
+    if diff:
+      return 1
+    print('{} mutated payloads per endpoint load the same way'.format(
+        args.check))
+
+  print('{:<20} {:>16} {:>9} {:>8}'.format(
+      'endpoint', 'marshmallow us', 'fast us', 'speedup'))
+  for label, row in sorted(bench(args.number).items()):
+    print('{:<20} {:>16.2f} {:>9.2f} {:>7.1f}x'.format(
+        label, row['marshmallow'], row['fast'],
+        row['marshmallow'] / row['fast']))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
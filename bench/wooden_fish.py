@@ -0,0 +1,369 @@
+"""Reproducible in-process load test of the /api/wooden_fish endpoints.
+
+    python -m bench.wooden_fish --out bench/results.json
+    python -m bench.wooden_fish --baseline bench/baseline.json
+
+The Flask app is driven through its test client against a seeded SQLite
+file (or --database-uri, e.g. a disposable MySQL). The same --seed gives
+the same data and the same request sequence. Per endpoint the run reports
+throughput, p50/p99 latency and SQL round trips per request; with
+--baseline it exits non zero when an endpoint regressed.
+"""
+import argparse
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import simplejson as json
+
+# keep the run self contained: no write-behind, no files shared with a
+# running container
+os.environ.setdefault('WRITE_BEHIND', '0')
+os.environ.setdefault('SHARE_CACHE_PATH', '')
+os.environ.setdefault('METRICS_DIR', '')
+os.environ.setdefault('ETAG_VERSIONS_PATH', '')
+os.environ.setdefault('REPLICA_WRITES_PATH', '')
+os.environ.setdefault('SHARE_SLOT_PATH', '')
+
+from sqlalchemy import event  # noqa: E402
+
+from wxcloudrun import create_app, db  # noqa: E402
+from wxcloudrun import schema  # noqa: E402
+from wxcloudrun.share_rollup import backfill  # noqa: E402
+from wxcloudrun.tables import share_knock as share_knock_table  # noqa: E402
+from wxcloudrun.tables import wish as wish_table  # noqa: E402
+from wxcloudrun.tables import wish_share as wish_share_table  # noqa: E402
+
+app = create_app()
+
+DEFAULT_DB = '/tmp/wooden_fish_bench.db'
+OPENID = 'bench-{:05d}'
+
+# endpoint label -> relative weight of the mixed workload
+WORKLOAD = {
+    'wish': 3,
+    'wish_list:list': 15,
+    'wish_list:last': 10,
+    'wish_update': 30,
+    'wish_share_create': 2,
+    'wish_share_enter': 20,
+    'wish_share_update': 15,
+    'wish_share_stats': 5,
+}
+
+# relative increase of p50/p99 reported as a regression
+DEFAULT_THRESHOLD = 0.2
+
+
+def setup_database(uri):
+  app.config['SQLALCHEMY_DATABASE_URI'] = uri
+  if uri.startswith('sqlite'):
+    path = uri[len('sqlite:///'):]
+    if os.path.exists(path):
+      os.remove(path)
+  engine = db.engine
+  schema.upgrade(engine)
+  return engine
+
+
+class Dataset(object):
+  """Seeded users, wishes, share ids and share_knock history.
+
+  A few share ids are viral: they get most of the share traffic and
+  thousands of share_knock rows.
+  """
+
+  def __init__(self, rnd, users, wishes_per_user, viral, viral_knocks,
+               shares):
+    self.rnd = rnd
+    self.users = [OPENID.format(i) for i in range(users)]
+    self.wishes_per_user = wishes_per_user
+    self.viral_count = viral
+    self.viral_knocks = viral_knocks
+    self.share_count = shares
+    self.wishes = {}
+    self.owners = {}
+    self.viral = []
+    self.shares = []
+    self.sessions = []
+
+  def seed(self, engine):
+    now = datetime.now().replace(microsecond=0)
+    wish = wish_table.table
+    with engine.begin() as conn:
+      conn.execute(wish.insert(), [
+          {'openid': openid,
+           'wish': 'bench wish {}'.format(n),
+           'count': self.rnd.randint(0, 1000),
+           'knock': self.rnd.randint(0, 100000),
+           'fulfill': self.rnd.random() < 0.2,
+           'helper': 0, 'helper_total': 0,
+           'share_count': 0, 'share_count_total': 0,
+           'share_knock': 0, 'share_knock_total': 0,
+           'last_time': now - timedelta(minutes=self.rnd.randint(0, 60 * 24 * 30))}
+          for openid in self.users for n in range(self.wishes_per_user)
+      ])
+      for wish_id, openid in conn.execute(wish.select().with_only_columns(
+          [wish.c.id, wish.c.openid])):
+        self.wishes.setdefault(openid, []).append(wish_id)
+        self.owners[wish_id] = openid
+
+      owners = self.rnd.sample(self.users, self.share_count)
+      share_rows = []
+      for n, openid in enumerate(owners):
+        share_rows.append({'share_id': 'BENCH{:08d}'.format(n),
+                           'wish_id': self.rnd.choice(self.wishes[openid]),
+                           'share_content': True,
+                           'wish': 'bench share {}'.format(n)})
+      conn.execute(wish_share_table.table.insert(), share_rows)
+      self.shares = [(i['share_id'], i['wish_id']) for i in share_rows]
+      self.viral = self.shares[:self.viral_count]
+
+      knock_rows = []
+      for share_id, wish_id in self.viral:
+        for _ in range(self.viral_knocks):
+          knock_rows.append({
+              'wish_id': wish_id,
+              'share_session': uuid4().hex,
+              'openid': self.rnd.choice(self.users),
+              'count': self.rnd.randint(1, 10),
+              'knock': self.rnd.randint(0, 500),
+              'create_time': now - timedelta(
+                  minutes=self.rnd.randint(0, 60 * 24 * 14))})
+      conn.execute(share_knock_table.table.insert(), knock_rows)
+      backfill(conn)
+    return len(knock_rows)
+
+  def owner(self):
+    openid = self.rnd.choice(self.users)
+    return openid, self.rnd.choice(self.wishes[openid])
+
+  def share(self):
+    # 80% of the share traffic goes to the viral ids
+    if self.rnd.random() < 0.8:
+      return self.rnd.choice(self.viral)
+    return self.rnd.choice(self.shares)
+
+
+class Runner(object):
+  """Sends requests one at a time, timing each and counting its SQL."""
+
+  def __init__(self, client, engine, dataset):
+    self.client = client
+    self.dataset = dataset
+    self.statements = 0
+    self.samples = {k: [] for k in WORKLOAD}
+    event.listen(engine, 'before_cursor_execute', self._count)
+
+  def _count(self, conn, cursor, statement, parameters, context, executemany):
+    self.statements += 1
+
+  def post(self, label, path, openid, data):
+    before = self.statements
+    start = time.perf_counter()
+    res = self.client.post('/api/wooden_fish/' + path, json=data,
+                           headers={'X-WX-OPENID': openid})
+    elapsed = time.perf_counter() - start
+    if res.status_code != 200 or res.json['code'] != 0:
+      raise RuntimeError('{} failed: {}'.format(path, res.get_data(True)))
+    self.samples[label].append((elapsed, self.statements - before))
+    return res.json['data']
+
+  def request(self, label):
+    ds = self.dataset
+    rnd = ds.rnd
+    if label == 'wish':
+      openid = rnd.choice(ds.users)
+      wish_id = self.post(label, 'wish', openid,
+                          {'wish': 'bench new wish'})['id']
+      ds.wishes[openid].append(wish_id)
+      ds.owners[wish_id] = openid
+    elif label.startswith('wish_list:'):
+      self.post(label, 'wish_list', rnd.choice(ds.users),
+                {'mode': label.split(':')[1],
+                 'fulfill': rnd.random() < 0.2})
+    elif label == 'wish_update':
+      openid, wish_id = ds.owner()
+      self.post(label, 'wish_update', openid,
+                {'wish_id': wish_id, 'count': 1,
+                 'knock': rnd.randint(1, 200)})
+    elif label == 'wish_share_create':
+      openid, wish_id = ds.owner()
+      share_id = self.post(label, 'wish_share_create', openid,
+                           {'wish_id': wish_id,
+                            'share_content': True})['share_id']
+      ds.shares.append((share_id, wish_id))
+    elif label == 'wish_share_enter':
+      self.post(label, 'wish_share_enter', rnd.choice(ds.users),
+                {'share_id': ds.share()[0]})
+    elif label == 'wish_share_update':
+      # continue a session of this run or start a new one
+      if ds.sessions and rnd.random() < 0.7:
+        openid, share_id, session = rnd.choice(ds.sessions)
+        data = {'share_id': share_id, 'share_session': session}
+      else:
+        openid, share_id, session = rnd.choice(ds.users), ds.share()[0], None
+        data = {'share_id': share_id}
+      data.update(count=rnd.randint(1, 5), knock=rnd.randint(0, 50))
+      res = self.post(label, 'wish_share_update', openid, data)
+      if session is None:
+        ds.sessions.append((openid, share_id, res['share_session']))
+    elif label == 'wish_share_stats':
+      share_id, wish_id = rnd.choice(ds.viral)
+      self.post(label, 'wish_share_stats', ds.owners[wish_id],
+                {'wish_id': wish_id})
+
+  def run(self, requests, warmup):
+    labels = list(WORKLOAD)
+    weights = [WORKLOAD[k] for k in labels]
+    rnd = self.dataset.rnd
+    for _ in range(warmup):
+      self.request(rnd.choices(labels, weights)[0])
+    self.samples = {k: [] for k in WORKLOAD}
+    start = time.perf_counter()
+    for _ in range(requests):
+      self.request(rnd.choices(labels, weights)[0])
+    return time.perf_counter() - start
+
+
+def _percentile(values, q):
+  values = sorted(values)
+  idx = min(len(values) - 1, max(0, int(round(q * len(values) + .5)) - 1))
+  return values[idx]
+
+
+def summarize(samples, elapsed):
+  endpoints = {}
+  total = 0
+  for label, rows in samples.items():
+    if not rows:
+      continue
+    latencies = [i[0] for i in rows]
+    total += len(rows)
+    endpoints[label] = {
+        'requests': len(rows),
+        # requests per second of time spent in this endpoint
+        'throughput': round(len(rows) / sum(latencies), 1),
+        'p50_ms': round(_percentile(latencies, .5) * 1000, 3),
+        'p99_ms': round(_percentile(latencies, .99) * 1000, 3),
+        'sql_per_request': round(sum(i[1] for i in rows) / len(rows), 2)
+    }
+  return {'requests': total,
+          'seconds': round(elapsed, 3),
+          'throughput': round(total / elapsed, 1),
+          'endpoints': endpoints}
+
+
+def _git_revision():
+  try:
+    return subprocess.check_output(
+        ['git', 'rev-parse', '--short', 'HEAD'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def compare(result, baseline, threshold):
+  """Return a line per endpoint metric that got worse than `baseline`.
+
+  Latency has to grow by more than `threshold`, any extra SQL round
+  trip counts since those are deterministic for a given seed.
+  """
+  regressions = []
+  for label, new in result['endpoints'].items():
+    old = baseline['endpoints'].get(label)
+    if old is None:
+      continue
+    for key in ('p50_ms', 'p99_ms'):
+      if new[key] > old[key] * (1 + threshold):
+        regressions.append('{} {} {} -> {}'.format(label, key, old[key], new[key]))
+    if new['sql_per_request'] > old['sql_per_request']:
+      regressions.append('{} sql_per_request {} -> {}'.format(
+          label, old['sql_per_request'], new['sql_per_request']))
+  return regressions
+
+
+def print_table(result):
+  print('{:<20} {:>8} {:>10} {:>9} {:>9} {:>6}'.format(
+      'endpoint', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'sql'))
+  for label, row in sorted(result['endpoints'].items()):
+    print('{:<20} {:>8} {:>10} {:>9} {:>9} {:>6}'.format(
+        label, row['requests'], row['throughput'], row['p50_ms'],
+        row['p99_ms'], row['sql_per_request']))
+  print('total {} requests in {}s, {} req/s'.format(
+      result['requests'], result['seconds'], result['throughput']))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--database-uri', default='sqlite:///' + DEFAULT_DB,
+                      help='SQLite files are recreated; use an empty '
+                           'database for anything else')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--users', type=int, default=500)
+  parser.add_argument('--wishes-per-user', type=int, default=8)
+  parser.add_argument('--shares', type=int, default=200)
+  parser.add_argument('--viral', type=int, default=5,
+                      help='share ids getting most of the share traffic')
+  parser.add_argument('--viral-knocks', type=int, default=2000,
+                      help='share_knock rows seeded per viral share id')
+  parser.add_argument('--requests', type=int, default=5000)
+  parser.add_argument('--warmup', type=int, default=200)
+  parser.add_argument('--out', default=None, help='write the result as JSON')
+  parser.add_argument('--baseline', default=None,
+                      help='JSON of an earlier run to compare against')
+  parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+  args = parser.parse_args(argv)
+  # each seeded share id belongs to a different user
+  if not 0 < args.shares <= args.users:
+    parser.error('--shares must be between 1 and --users')
+  if not 0 < args.viral <= args.shares:
+    parser.error('--viral must be between 1 and --shares')
+
+  rnd = random.Random(args.seed)
+  with app.app_context():
+    engine = setup_database(args.database_uri)
+    dataset = Dataset(rnd, args.users, args.wishes_per_user, args.viral,
+                      args.viral_knocks, args.shares)
+    seed_start = time.perf_counter()
+    knocks = dataset.seed(engine)
+    seed_seconds = time.perf_counter() - seed_start
+    runner = Runner(app.test_client(), engine, dataset)
+    elapsed = runner.run(args.requests, args.warmup)
+    dialect = engine.dialect.name
+
+  result = summarize(runner.samples, elapsed)
+  result['meta'] = {
+      'revision': _git_revision(),
+      'time': datetime.now().isoformat(timespec='seconds'),
+      'python': platform.python_version(),
+      'dialect': dialect,
+      'seed_seconds': round(seed_seconds, 3),
+      'args': {k: v for k, v in vars(args).items()
+               if k not in ('out', 'baseline', 'database_uri')},
+      'share_knock_rows': knocks,
+  }
+  print_table(result)
+  if args.out:
+    with open(args.out, 'w') as f:
+      json.dump(result, f, indent=2, sort_keys=True)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    regressions = compare(result, baseline, args.threshold)
+    for line in regressions:
+      print('REGRESSION ' + line)
+    if regressions:
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
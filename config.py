@@ -7,3 +7,92 @@ DEBUG = False
 username = os.environ.get("MYSQL_USERNAME", 'root')
 password = os.environ.get("MYSQL_PASSWORD", 'root')
 db_address = os.environ.get("MYSQL_ADDRESS", '127.0.0.1:3306')
+
+# 启动时由 gunicorn 主进程在 fork worker 之前执行数据库迁移(flask schema-upgrade)，
+# 多个容器同时启动时由 MySQL GET_LOCK 串行；关闭后须在发布前手动执行
+SCHEMA_UPGRADE_ON_START = os.environ.get("SCHEMA_UPGRADE_ON_START", '1') == '1'
+
+# 并发配置：worker 类型、进程数、线程数与连接池大小需一起调整
+# sync: 多进程同步 worker，每个进程同时只处理一个请求
+# threaded: 多进程 + 线程，连接池按线程数配置，避免等待连接或频繁创建溢出连接
+CONCURRENCY_PROFILES = {
+    'sync': {'worker_class': 'sync', 'workers': 8, 'threads': 1,
+             'pool_size': 1, 'max_overflow': 2},
+    'threaded': {'worker_class': 'gthread', 'workers': 2, 'threads': 16,
+                 'pool_size': 16, 'max_overflow': 4},
+}
+CONCURRENCY_PROFILE = os.environ.get("CONCURRENCY_PROFILE", 'sync')
+_profile = CONCURRENCY_PROFILES[CONCURRENCY_PROFILE]
+WORKER_CLASS = os.environ.get("GUNICORN_WORKER_CLASS", _profile['worker_class'])
+WORKERS = int(os.environ.get("GUNICORN_WORKERS", _profile['workers']))
+THREADS = int(os.environ.get("GUNICORN_THREADS", _profile['threads']))
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", _profile['pool_size']))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", _profile['max_overflow']))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", '10'))
+
+# 只读从库地址，留空则读写都走主库；用户写入后 REPLICA_READ_YOUR_WRITES 秒内其读请求仍走主库，
+# 从库连接失败后 REPLICA_RETRY_INTERVAL 秒内改走主库；写入记录保存在容器内各 worker 共享的本地文件
+MYSQL_REPLICA_ADDRESS = os.environ.get("MYSQL_REPLICA_ADDRESS", '')
+REPLICA_READ_YOUR_WRITES = float(os.environ.get("REPLICA_READ_YOUR_WRITES", '5'))
+REPLICA_RETRY_INTERVAL = float(os.environ.get("REPLICA_RETRY_INTERVAL", '30'))
+REPLICA_WRITES_PATH = os.environ.get("REPLICA_WRITES_PATH", '/tmp/wooden_fish_writes.db')
+
+# 写合并模式：仅自增的敲击更新在进程内合并，按时间/数量阈值批量写库
+# 其它 worker 缓冲的敲击最多 WRITE_BEHIND_INTERVAL 秒后才可读到
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND", '0') == '1'
+WRITE_BEHIND_INTERVAL = float(os.environ.get("WRITE_BEHIND_INTERVAL", '0.5'))
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get("WRITE_BEHIND_MAX_PENDING", '200'))
+
+# 计数器写合并：/api/count 的自增在进程内分段累加，按间隔(秒)批量写库，返回值为近似值
+COUNTER_BUFFER = os.environ.get("COUNTER_BUFFER", '0') == '1'
+COUNTER_FLUSH_INTERVAL = float(os.environ.get("COUNTER_FLUSH_INTERVAL", '1'))
+COUNTER_STRIPES = int(os.environ.get("COUNTER_STRIPES", '16'))
+
+# 分享解析缓存：容量、有效期(秒)、未命中结果的有效期(秒)
+SHARE_CACHE_SIZE = int(os.environ.get("SHARE_CACHE_SIZE", '1024'))
+SHARE_CACHE_TTL = float(os.environ.get("SHARE_CACHE_TTL", '600'))
+SHARE_CACHE_NEGATIVE_TTL = float(os.environ.get("SHARE_CACHE_NEGATIVE_TTL", '10'))
+# 容器内各 worker 共享的本地缓存文件，留空则只使用进程内缓存
+SHARE_CACHE_PATH = os.environ.get("SHARE_CACHE_PATH", '')
+SHARE_CACHE_SHARED_SIZE = int(os.environ.get("SHARE_CACHE_SHARED_SIZE", '65536'))
+
+# share_knock 明细保留天数(需大于统计用的 7 天)，更早的明细并入 share_knock_daily 后按批删除；
+# SHARE_KNOCK_PARTITIONED=1 表示 share_knock 已按月分区(flask share-knock-partition-sql)，过期分区整体删除
+SHARE_KNOCK_RETENTION_DAYS = int(os.environ.get("SHARE_KNOCK_RETENTION_DAYS", '30'))
+SHARE_KNOCK_COMPACT_BATCH = int(os.environ.get("SHARE_KNOCK_COMPACT_BATCH", '1000'))
+SHARE_KNOCK_PARTITIONED = os.environ.get("SHARE_KNOCK_PARTITIONED", '0') == '1'
+
+# 热门分享心愿的助力计数分片：更新心愿行耗时(含行锁等待)达到 SHARE_SLOT_LOCK_WAIT 秒的心愿，
+# SHARE_SLOT_PROMOTE_SECONDS 秒内助力改为随机写入 SHARE_COUNTER_SLOTS 个分片行(设为 0 或 1 关闭)，
+# 其助力排行每个 worker 至多每 SHARE_SLOT_REFRESH_INTERVAL 秒刷新一次；热门标记保存在容器内各 worker 共享的本地文件
+SHARE_COUNTER_SLOTS = int(os.environ.get("SHARE_COUNTER_SLOTS", '0'))
+SHARE_SLOT_LOCK_WAIT = float(os.environ.get("SHARE_SLOT_LOCK_WAIT", '0.05'))
+SHARE_SLOT_PROMOTE_SECONDS = float(os.environ.get("SHARE_SLOT_PROMOTE_SECONDS", '600'))
+SHARE_SLOT_REFRESH_INTERVAL = float(os.environ.get("SHARE_SLOT_REFRESH_INTERVAL", '1'))
+SHARE_SLOT_PATH = os.environ.get("SHARE_SLOT_PATH", '/tmp/wooden_fish_hot_wishes.db')
+
+# 分享 id 签名密钥：设置后新分享 id 自带心愿 id 等信息并以 HMAC 签名，进入/助力无需查库即可解析；
+# 多个密钥以逗号分隔，第一个用于签发、全部用于校验(便于轮换)；留空则仍签发 SH 开头的旧格式 id
+SHARE_ID_SECRET = os.environ.get("SHARE_ID_SECRET", '')
+
+# wish_list / wish_share_enter 的 ETag：版本号保存在容器内各 worker 共享的本地文件(留空则关闭，默认关闭)，
+# 版本号不在容器间同步，其他容器的写入最长在版本号有效期(秒)后才会被本容器看到，
+# 期间本容器可能对已变化的数据返回 304；仅单实例部署(maxNum 为 1)或能接受该延迟时开启
+ETAG_VERSIONS_PATH = os.environ.get("ETAG_VERSIONS_PATH", '')
+ETAG_VERSION_TTL = float(os.environ.get("ETAG_VERSION_TTL", '60'))
+
+# 异步入口(wxcloudrun.asgi)使用的数据库连接，驱动可选 aiomysql / asyncmy / aiosqlite
+ASYNC_DATABASE_URI = os.environ.get(
+    "ASYNC_DATABASE_URI",
+    'mysql+aiomysql://{}:{}@{}/flask_demo'.format(username, password, db_address))
+ASYNC_POOL_SIZE = int(os.environ.get("ASYNC_POOL_SIZE", '20'))
+ASYNC_MAX_OVERFLOW = int(os.environ.get("ASYNC_MAX_OVERFLOW", '10'))
+
+# 请求参数解析：合法请求走预编译的快速校验，其余仍交给 marshmallow；设为 0 则全部使用 marshmallow
+FAST_PARSE = os.environ.get("FAST_PARSE", '1') == '1'
+
+# 接口耗时/SQL统计：统计的路由前缀、采样率(0~1)，以及各 worker 汇总数据的本地目录(留空则只统计当前进程)
+METRICS_ROUTE_PREFIXES = ('/api/wooden_fish/', '/api/count')
+METRICS_SAMPLE_RATE = float(os.environ.get("METRICS_SAMPLE_RATE", '1'))
+METRICS_DIR = os.environ.get("METRICS_DIR", '/tmp/wooden_fish_metrics')
+METRICS_WRITE_INTERVAL = float(os.environ.get("METRICS_WRITE_INTERVAL", '5'))
@@ -0,0 +1,33 @@
+# gunicorn 配置，进程/线程数来自 config.py 的并发配置
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import config  # noqa: E402
+
+bind = '0.0.0.0:80'
+worker_class = config.WORKER_CLASS
+workers = config.WORKERS
+threads = config.THREADS
+max_requests = 1000
+# 主进程加载应用后再 fork，各 worker 共享已导入的模块(写时复制)，冷启动只导入一次；
+# 数据库连接池在 worker 中首次使用时才创建
+preload_app = True
+
+
+def on_starting(server):
+    """主进程 fork worker 之前执行数据库迁移，失败时不启动服务"""
+    if not config.SCHEMA_UPGRADE_ON_START:
+        return
+    # preload_app 已在主进程导入 run，这里取到的是同一个应用
+    from run import app
+    from wxcloudrun import db
+    from wxcloudrun.schema import upgrade
+    with app.app_context():
+        try:
+            applied = upgrade(db.engine)
+        finally:
+            # 主进程的连接不能被 fork 出的 worker 共用
+            db.engine.dispose()
+    server.log.info('schema upgrade: %s', applied or 'up to date')
@@ -1,7 +1,9 @@
 # 创建应用实例
 import sys
 
-from wxcloudrun import app
+from wxcloudrun import create_app
+
+app = create_app()
 
 # 启动Flask Web服务
 if __name__ == '__main__':
@@ -1,29 +1,73 @@
+from wxcloudrun import startup
+
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 import pymysql
 import config
+from wxcloudrun.pool_stats import InstrumentedQueuePool
 
 # 因MySQLDB不支持Python3，使用pymysql扩展库代替MySQLDB库
 pymysql.install_as_MySQLdb()
 
-# 初始化web应用
-app = Flask(__name__, instance_relative_config=True)
-app.config['DEBUG'] = config.DEBUG
+def mysql_engine_options():
+    """
+    MySQL 引擎的连接池参数
+    每个请求共用一个连接，READ COMMITTED 让请求内后面的读取能看到其它连接
+    （如写缓冲的刷新）已提交的写入，不停留在第一次读取时的快照
+    """
+    return {'poolclass': InstrumentedQueuePool,
+            'isolation_level': 'READ COMMITTED',
+            'pool_pre_ping': True,
+            'pool_recycle': 60 * 10,
+            'pool_size': config.DB_POOL_SIZE,
+            'max_overflow': config.DB_MAX_OVERFLOW,
+            'pool_timeout': config.DB_POOL_TIMEOUT,
+            'pool_use_lifo': True}
+
+
+class WoodenFishSQLAlchemy(SQLAlchemy):
+    """按每个引擎（含 binds）的方言设定引擎参数，其它方言（如压测用的 SQLite）用默认值"""
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        if sa_url.get_backend_name() == 'mysql':
+            options.update(mysql_engine_options())
+        return sa_url, options
+
+
+# 初始化DB操作对象，连接池在第一次使用 db.engine 时才创建，
+# gunicorn --preload 的主进程不会建立连接，各worker fork后各自建池
+db = WoodenFishSQLAlchemy()
+
+
+def create_app():
+    """
+    创建web应用
+    :return: Flask应用
+    """
+    app = Flask(__name__, instance_relative_config=True)
 
-# 设定数据库链接
-app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql://{}:{}@{}/flask_demo'.format(config.username, config.password,
-                                                                             config.db_address)
+    # 加载配置
+    app.config.from_object('config')
 
-# 初始化DB操作对象
-db = SQLAlchemy(app,
-                engine_options={'pool_pre_ping': True,
-                                'pool_recycle': 60 * 10,
-                                'pool_size': 1,
-                                'pool_use_lifo': True})
+    # 设定数据库链接
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql://{}:{}@{}/flask_demo'.format(config.username, config.password,
+                                                                                 config.db_address)
+    if config.MYSQL_REPLICA_ADDRESS:
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica': 'mysql://{}:{}@{}/flask_demo'.format(config.username, config.password,
+                                                           config.MYSQL_REPLICA_ADDRESS)
+        }
+    db.init_app(app)
 
-# 加载控制器
-from wxcloudrun import views
-from wxcloudrun import view_daily_record
+    # 加载控制器与命令行工具
+    with startup.phase('import views'):
+        from wxcloudrun import (leaderboard, metrics, replica, retention, schema, search,
+                                share_rollup, share_slots, view, views, view_daily_record)
+    with startup.phase('register blueprints'):
+        for module in (startup, metrics, replica, view, views, view_daily_record, schema, share_rollup,
+                       share_slots, leaderboard, retention, search):
+            app.register_blueprint(module.bp)
 
-# 加载配置
-app.config.from_object('config')
+    startup.ready()
+    return app
@@ -0,0 +1,434 @@
+"""ASGI entry point serving /api/wooden_fish/* on SQLAlchemy's asyncio engine.
+
+    gunicorn -k uvicorn.workers.UvicornWorker wxcloudrun.asgi:app
+
+Requests are validated with the same schemas and answered with the same
+bodies as the Flask views, the SQL is built by the same helpers. A
+handler returns the JSON body, or an async iterator of NDJSON chunks
+that is streamed as it is produced (export).
+"""
+import time
+from uuid import uuid4
+
+import simplejson as json
+from marshmallow import ValidationError
+from sqlalchemy import and_, select
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.exceptions import (BadRequest, MethodNotAllowed, NotFound,
+                                 UnprocessableEntity)
+
+import config
+from wxcloudrun import (export, fastparse, knock_history, leaderboard,
+                        search, share_ids, share_slots)
+from wxcloudrun import view_daily_record as views
+from wxcloudrun.knock_buffer import knock_update_sql
+from wxcloudrun.response import err_body, succ_body
+from wxcloudrun.share_cache import (invalidate_share, invalidate_wish,
+                                    owner_key, share_cache, share_key)
+from wxcloudrun.share_rollup import (last_week_by_wish_sql, last_week_sql,
+                                     rollup_session_sql)
+from wxcloudrun.share_slots import hot_wishes
+from wxcloudrun.tables import wish as wish_table
+from wxcloudrun.tables import wish_share as wish_share_table
+from wxcloudrun.upsert import upsert_inserted
+from wxcloudrun.versions import bump_share, bump_user
+
+
+def _engine_options(uri):
+  if uri.startswith('sqlite'):
+    return {}
+  return {'pool_pre_ping': True,
+          'pool_recycle': 60 * 10,
+          'pool_size': config.ASYNC_POOL_SIZE,
+          'max_overflow': config.ASYNC_MAX_OVERFLOW}
+
+
+engine = create_async_engine(config.ASYNC_DATABASE_URI,
+                             **_engine_options(config.ASYNC_DATABASE_URI))
+
+ROUTES = {}
+
+
+def route(path, schema):
+  def wrapper(func):
+    ROUTES[path] = (schema, func)
+    return func
+  return wrapper
+
+
+async def _fetchall(sql):
+  async with engine.connect() as conn:
+    return (await conn.execute(sql)).fetchall()
+
+
+async def _cached(key, sql, shape):
+  found, value = share_cache.lookup(key)
+  if not found:
+    res = await _fetchall(sql)
+    value = shape(res) if res else None
+    share_cache.put(key, value)
+  return value
+
+
+@route('/api/wooden_fish/wish', views.NewWish)
+async def new_wish(openid, wish):
+  async with engine.begin() as conn:
+    res = await conn.execute(
+        wish_table.table.insert().values(openid=openid, wish=wish)
+    )
+    wish_id = res.inserted_primary_key[0]
+    await conn.execute(search.index_sql(openid, [(wish_id, wish)]))
+  invalidate_wish(wish_id)
+  bump_user(openid)
+  return succ_body({'id': wish_id})
+
+
+@route('/api/wooden_fish/wish_bulk_create', views.NewWishBulk)
+async def new_wish_bulk(openid, wishes):
+  async with engine.begin() as conn:
+    res = await conn.execute(
+        wish_table.table.insert().values(
+            [{'openid': openid, 'wish': i} for i in wishes])
+    )
+    rows = [tuple(i) for i in await conn.execute(views.inserted_wishes_sql(
+        engine.dialect, res, openid, len(wishes)))]
+    await conn.execute(search.index_sql(openid, rows))
+  ids = [i[0] for i in rows]
+  for i in ids:
+    invalidate_wish(i)
+  bump_user(openid)
+  return succ_body({'id': ids})
+
+
+@route('/api/wooden_fish/wish_list', views.WishList)
+async def wish_list(openid, mode, last_id, page_num, fulfill):
+  res = await _fetchall(
+      views.wish_list_sql(openid, mode, last_id, page_num, fulfill))
+  return succ_body(views.to_columns(res, views.WISH_FIELDS))
+
+
+@route('/api/wooden_fish/wish_search', views.WishSearch)
+async def wish_search(openid, query, last_id, page_num, fulfill):
+  res = await _fetchall(
+      views.wish_search_sql(openid, query, last_id, page_num, fulfill))
+  return succ_body(views.to_columns(res, views.WISH_FIELDS))
+
+
+@route('/api/wooden_fish/wish_share_stats', views.WishShareStats)
+async def wish_stats(openid, wish_id):
+  async with engine.connect() as conn:
+    res = (await conn.execute(views.wish_stats_sql(openid, wish_id))).fetchall()
+    if not res:
+      return err_body({'msg': 'wish not found'})
+    res = dict(zip(views.WISH_STATS_FIELDS, res[0]))
+    helper_res = (await conn.execute(last_week_sql(wish_id))).fetchall()
+  res.update(helper_res[0]._mapping)
+  return succ_body(res)
+
+
+@route('/api/wooden_fish/dashboard', views.WishList)
+async def wish_dashboard(openid, mode, last_id, page_num, fulfill):
+  async with engine.connect() as conn:
+    res = (await conn.execute(views.dashboard_sql(
+        openid, mode, last_id, page_num, fulfill))).fetchall()
+    last_week = []
+    if res:
+      last_week = (await conn.execute(
+          last_week_by_wish_sql([i[0] for i in res]))).fetchall()
+  return succ_body(views.dashboard_columns(res, last_week))
+
+
+@route('/api/wooden_fish/wish_update', views.WishUpdate)
+async def wish_update(openid, wish_id, fulfill, count, wish, knock,
+                      clear_record, gather_shared):
+  async with engine.begin() as conn:
+    if gather_shared and hot_wishes is not None:
+      rows = (await conn.execute(
+          share_slots.locked_slots_sql([wish_id]))).fetchall()
+      for sql in share_slots.fold_sqls(rows):
+        await conn.execute(sql)
+    res = await conn.execute(
+        views.wish_update_sql(openid, wish_id, fulfill, count, wish, knock,
+                              clear_record, gather_shared)
+    )
+    if wish is not None and res.rowcount:
+      for sql in search.reindex_sqls(openid, wish_id, wish):
+        await conn.execute(sql)
+    if count or knock or clear_record or gather_shared:
+      await conn.execute(leaderboard.refresh_wishes_sql(
+          engine, [wish_id], leaderboard.KNOCK_BOARDS))
+    if not clear_record and not gather_shared and (count or knock):
+      await conn.execute(knock_history.record_sql(
+          engine, {(openid, wish_id): (count, knock)}))
+  bump_user(openid)
+  return succ_body({'result': True})
+
+
+@route('/api/wooden_fish/wish_update_batch', views.WishUpdateBatch)
+async def wish_update_batch(openid, updates):
+  deltas = views.merge_deltas(openid, updates)
+  wish_ids = [k[1] for k in deltas]
+
+  async with engine.begin() as conn:
+    rows = (await conn.execute(knock_update_sql(deltas))).rowcount
+    await conn.execute(leaderboard.refresh_wishes_sql(
+        engine, wish_ids, leaderboard.KNOCK_BOARDS))
+    history_sql = knock_history.record_sql(engine, deltas)
+    if history_sql is not None:
+      await conn.execute(history_sql)
+  if rows:
+    bump_user(openid)
+  if rows == len(wish_ids):
+    matched = set(wish_ids)
+  else:
+    res = await _fetchall(views.owned_wish_ids_sql(openid, wish_ids))
+    matched = {i[0] for i in res}
+  return succ_body({'wish_id': wish_ids,
+                    'updated': [int(i in matched) for i in wish_ids]})
+
+
+@route('/api/wooden_fish/wish_share_create', views.WishShare)
+async def wish_share_create(openid, wish_id, share_content):
+  origin_table = wish_table.table
+  async with engine.begin() as conn:
+    res = (await conn.execute(
+        select(origin_table.c.wish).where(and_(origin_table.c.id == wish_id,
+                                               origin_table.c.openid == openid))
+    )).fetchall()
+    if not res:
+      return err_body({'msg': 'wish not found'})
+    share_vals = views.new_share_values(wish_id, share_content, res[0][0])
+    share_id = share_vals['share_id']
+    res = await conn.execute(
+        wish_share_table.table.insert().values(**share_vals))
+    if share_ids.enabled():
+      row_id = res.inserted_primary_key[0]
+      share_id = share_ids.sign(wish_id, row_id, share_content, openid)
+      await conn.execute(views.signed_share_id_sql(row_id, share_id))
+  invalidate_share(share_id)
+  bump_share(share_id)
+  return succ_body({'share_id': share_id})
+
+
+async def get_wish_content_from_share_id(share_id, share=None):
+  if share is not None and not share.share_content:
+    return views.signed_share_content(share)
+  return await _cached(share_key(share_id),
+                       views.share_sql(share_id, share),
+                       lambda res: list(res[0]))
+
+
+async def get_openid_from_wishid(wish_id):
+  return await _cached(owner_key(wish_id),
+                       views.owner_sql(wish_id),
+                       lambda res: res[0][0])
+
+
+@route('/api/wooden_fish/wish_share_enter', views.WishShareEnter)
+async def wish_share_enter(openid, share_id):
+  share = share_ids.decode(share_id)
+  res = await get_wish_content_from_share_id(share_id, share)
+  if not res:
+    return err_body({'msg': 'wish not found'})
+  if share is not None:
+    self_share = share_ids.owned_by(share, openid)
+  else:
+    wish_openid = await get_openid_from_wishid(res[2])
+    if wish_openid is None:
+      return err_body({'msg': 'wish not found'})
+    self_share = wish_openid == openid
+  return succ_body({'wish': res[0],
+                    'share_content': res[1],
+                    'self_share': self_share})
+
+
+@route('/api/wooden_fish/wish_share_update', views.WishShareUpdate)
+async def wish_share_update(openid, share_id, share_session, count, knock):
+  share = share_ids.decode(share_id)
+  res = await get_wish_content_from_share_id(share_id, share)
+  if not res:
+    return err_body({'msg': 'wish not found'})
+  wish_id = res[2]
+  new_session = share_session is None
+  if new_session:
+    share_session = uuid4().hex
+
+  helper_sql = views.share_helper_sql(wish_id, count, knock)
+  hot = (helper_sql is not None and hot_wishes is not None and
+         hot_wishes.is_hot(wish_id))
+  async with engine.begin() as conn:
+    if hot:
+      await conn.execute(share_slots.slot_sql(engine, wish_id,
+                                              hot_wishes.slot(), count, knock))
+    elif helper_sql is not None:
+      start = time.perf_counter()
+      await conn.execute(helper_sql)
+      if hot_wishes is not None:
+        hot_wishes.observe(wish_id, time.perf_counter() - start)
+    if not views.share_knock_upserted(engine):
+      res = await conn.execute(views.share_knock_update_sql(
+          share_session, count, knock))
+      inserted = not res.rowcount
+      if inserted:
+        await conn.execute(views.share_knock_insert_sql(
+            wish_id, openid, share_session, count, knock))
+    else:
+      res = await conn.execute(
+          views.share_knock_upsert_sql(engine, wish_id, openid, share_session,
+                                       count, knock)
+      )
+      inserted = upsert_inserted(engine, res)
+    if count or knock:
+      new_session = new_session or inserted
+    await conn.execute(rollup_session_sql(engine, share_session, count, knock,
+                                          helper=int(new_session)))
+    if count and (not hot or hot_wishes.refresh_due(wish_id)):
+      await conn.execute(leaderboard.refresh_wishes_sql(
+          engine, [wish_id], leaderboard.HELPED_BOARDS))
+  if helper_sql is not None:
+    bump_user(await get_openid_from_wishid(wish_id))
+  return succ_body({'result': True,
+                    'share_session': share_session})
+
+
+@route('/api/wooden_fish/leaderboard', views.Leaderboard)
+async def wish_leaderboard(openid, board, scope, limit):
+  res = await _fetchall(leaderboard.top_sql(
+      board, limit, openid if scope == 'user' else None))
+  return succ_body(views.leaderboard_columns(res, openid))
+
+
+@route('/api/wooden_fish/wish_rank', views.WishRank)
+async def wish_rank(openid, wish_id, board):
+  if await get_openid_from_wishid(wish_id) != openid:
+    return err_body({'msg': 'wish not found'})
+  async with engine.connect() as conn:
+    res = (await conn.execute(leaderboard.score_sql(board, wish_id))).fetchall()
+    score = res[0][0] if res else 0
+    ahead = (await conn.execute(leaderboard.ahead_sql(board, score))).scalar()
+    user_ahead = (await conn.execute(
+        leaderboard.ahead_sql(board, score, openid))).scalar()
+  return succ_body({'score': score,
+                    'rank': leaderboard.rank(ahead),
+                    'user_rank': leaderboard.rank(user_ahead),
+                    'rank_limit': leaderboard.RANK_LIMIT})
+
+
+@route('/api/wooden_fish/wish_history', views.WishHistory)
+async def wish_history(openid, wish_id, start, end):
+  end = end or (await _fetchall(knock_history.today_sql()))[0][0]
+  days = knock_history.window(start, end)
+  if days is None:
+    return err_body({'msg': 'invalid date range'})
+  if await get_openid_from_wishid(wish_id) != openid:
+    return err_body({'msg': 'wish not found'})
+  res = await _fetchall(knock_history.range_sql(wish_id, start, end))
+  return succ_body(knock_history.dense(res, start, days))
+
+
+@route('/api/wooden_fish/export', views.Export)
+async def wish_export(openid, cursor):
+  try:
+    position = export.decode_cursor(cursor)
+  except ValueError:
+    return err_body({'msg': 'invalid cursor'})
+
+  async def generate():
+    # a server-side cursor of its own, held while the response streams
+    async with engine.connect() as conn:
+      async for chunk in export.stream_lines(conn, openid, position):
+        yield chunk
+
+  return generate()
+
+
+def _is_json(headers):
+  mimetype = headers.get('content-type', '').split(';')[0].strip().lower()
+  return (mimetype == 'application/json' or
+          (mimetype.startswith('application/') and mimetype.endswith('+json')))
+
+
+async def _read_body(receive):
+  body = b''
+  while True:
+    message = await receive()
+    body += message.get('body', b'')
+    if not message.get('more_body'):
+      return body
+
+
+async def _send(send, status, body, headers):
+  body = body.encode('utf-8')
+  headers = [(k.lower().encode('latin-1'), v.encode('latin-1'))
+             for k, v in headers]
+  headers.append((b'content-length', str(len(body)).encode('latin-1')))
+  await send({'type': 'http.response.start',
+              'status': status,
+              'headers': headers})
+  await send({'type': 'http.response.body', 'body': body})
+
+
+async def _send_chunks(send, status, chunks, headers):
+  headers = [(k.lower().encode('latin-1'), v.encode('latin-1'))
+             for k, v in headers]
+  await send({'type': 'http.response.start',
+              'status': status,
+              'headers': headers})
+  async for chunk in chunks:
+    await send({'type': 'http.response.body',
+                'body': chunk.encode('utf-8'),
+                'more_body': True})
+  await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _send_error(send, exc):
+  await _send(send, exc.code, exc.get_body(), exc.get_headers())
+
+
+async def _lifespan(receive, send):
+  while True:
+    message = await receive()
+    if message['type'] == 'lifespan.startup':
+      await send({'type': 'lifespan.startup.complete'})
+    elif message['type'] == 'lifespan.shutdown':
+      await engine.dispose()
+      await send({'type': 'lifespan.shutdown.complete'})
+      return
+
+
+async def app(scope, receive, send):
+  if scope['type'] == 'lifespan':
+    return await _lifespan(receive, send)
+  if scope['type'] != 'http':
+    return
+
+  if scope['path'] not in ROUTES:
+    return await _send_error(send, NotFound())
+  if scope['method'] != 'POST':
+    return await _send_error(send, MethodNotAllowed(valid_methods=['POST']))
+  schema, handler = ROUTES[scope['path']]
+  headers = {k.decode('latin-1').lower(): v.decode('latin-1')
+             for k, v in scope['headers']}
+  body = await _read_body(receive)
+
+  # same rules as webargs: non JSON or empty bodies parse as {}
+  data = {}
+  if body and _is_json(headers):
+    try:
+      data = json.loads(body)
+    except ValueError:
+      return await _send_error(send, BadRequest())
+  try:
+    kwargs = fastparse.load(schema, data)
+  except ValidationError:
+    return await _send_error(send, UnprocessableEntity())
+
+  openid = headers.get('x-wx-openid')
+  if openid is None:
+    result = err_body({'msg': 'not login'})
+  else:
+    result = await handler(openid, **kwargs)
+  if not isinstance(result, str):
+    return await _send_chunks(send, 200, result,
+                              [('Content-Type', 'application/x-ndjson')])
+  await _send(send, 200, result, [('Content-Type', 'application/json')])
@@ -0,0 +1,122 @@
+import atexit
+import threading
+import time
+
+import config
+from wxcloudrun.dao import increment_counters, query_counts
+from wxcloudrun.write_behind import WriteBehind
+
+
+class StripedCounter(WriteBehind):
+  """Per-worker write-behind buffer for Counter increments.
+
+  Increments land on one of `stripes` slots picked by the calling
+  thread, each behind its own lock, so concurrent taps rarely wait on
+  each other. flush() adds the summed deltas with one atomic upsert.
+  Values returned by add() are the last stored value plus what this
+  worker has not written yet, other workers' pending taps are not
+  included.
+  """
+
+  name = 'counter-buffer'
+
+  def __init__(self, stripes, interval):
+    super(StripedCounter, self).__init__(interval)
+    self._stripes = [(threading.Lock(), {}) for _ in range(stripes)]
+    self._values = {}
+    self.adds = 0
+    self.flushes = 0
+    self.flushed = 0
+    self.flush_seconds = 0.
+    self.flush_max_seconds = 0.
+
+  def _stripe(self):
+    return self._stripes[threading.get_ident() % len(self._stripes)]
+
+  def add(self, id, delta=1):
+    """Buffer `delta` for Counter `id`, returns the estimated value."""
+    lock, pending = self._stripe()
+    with lock:
+      pending[id] = pending.get(id, 0) + delta
+    self._started()
+    if id not in self._values:
+      # the first tap of this worker learns the stored value
+      self.flush()
+    with self._lock:
+      self.adds += 1
+      return self._values.get(id, 0) + self.pending(id)
+
+  def pending(self, id):
+    total = 0
+    for lock, pending in self._stripes:
+      with lock:
+        total += pending.get(id, 0)
+    return total
+
+  def _take(self):
+    merged = {}
+    for lock, pending in self._stripes:
+      with lock:
+        for k, v in pending.items():
+          merged[k] = merged.get(k, 0) + v
+        pending.clear()
+    return merged
+
+  def _put_back(self, deltas):
+    lock, pending = self._stripes[0]
+    with lock:
+      for k, v in deltas.items():
+        pending[k] = pending.get(k, 0) + v
+
+  def flush(self):
+    """Write pending deltas, returns the number of counters written."""
+    with self._flush_lock:
+      deltas = self._take()
+      if not deltas:
+        return 0
+      start = time.perf_counter()
+      try:
+        with self._app.app_context():
+          written = increment_counters(deltas)
+      except Exception:
+        # put the deltas back so they are retried by the next flush
+        self._put_back(deltas)
+        raise
+      if not written:
+        self._put_back(deltas)
+        return 0
+      with self._app.app_context():
+        values = query_counts(deltas)
+      elapsed = time.perf_counter() - start
+      with self._lock:
+        if values is not None:
+          self._values.update(values)
+        self.flushes += 1
+        self.flushed += sum(deltas.values())
+        self.flush_seconds += elapsed
+        self.flush_max_seconds = max(self.flush_max_seconds, elapsed)
+      return len(deltas)
+
+  def discard(self, id):
+    """Drop the pending increments of `id`, e.g. before it is cleared."""
+    with self._flush_lock:
+      for lock, pending in self._stripes:
+        with lock:
+          pending.pop(id, None)
+      with self._lock:
+        self._values[id] = 0
+
+  def stats(self):
+    with self._lock:
+      return {'adds': self.adds,
+              'flushes': self.flushes,
+              'flushed': self.flushed,
+              'flush_seconds': self.flush_seconds,
+              'flush_max_seconds': self.flush_max_seconds}
+
+
+counter_buffer = None
+if config.COUNTER_BUFFER:
+  counter_buffer = StripedCounter(config.COUNTER_STRIPES,
+                                  config.COUNTER_FLUSH_INTERVAL)
+  atexit.register(counter_buffer.flush)
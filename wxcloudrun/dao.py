@@ -1,9 +1,12 @@
 import logging
+from datetime import datetime
 
+from sqlalchemy import func, select
 from sqlalchemy.exc import OperationalError
 
 from wxcloudrun import db
 from wxcloudrun.model import Counters
+from wxcloudrun.upsert import upsert, upsert_inserted
 
 # 初始化日志
 logger = logging.getLogger('log')
@@ -62,3 +65,79 @@ def update_counterbyid(counter):
         db.session.commit()
     except OperationalError as e:
         logger.info("update_counterbyid errorMsg= {} ".format(e))
+
+
+def _increment_sql(bind, rows):
+    """
+    不存在则插入、存在则累加的upsert语句
+    :param rows: [{'id': ID, 'count': 增量}]
+    """
+    table = Counters.__table__
+    now = datetime.now()
+    values = [{'id': i['id'], 'count': i['count'], 'createdAt': now, 'updatedAt': now}
+              for i in rows]
+
+    def update(new):
+        count = table.c.count + new.count
+        if bind.dialect.name == 'mysql' and len(rows) == 1:
+            # LAST_INSERT_ID(expr) 把新值带回OK包，无需再查一次
+            count = func.last_insert_id(count)
+        return {'count': count, 'updatedAt': new.updatedAt}
+
+    return upsert(bind, table, values, update, index_elements=['id'])
+
+
+def increment_counter(id, delta=1):
+    """
+    原子地给Counter加上delta，不存在时以delta创建
+    :param id: Counter的ID
+    :param delta: 增量
+    :return: 加完后的计数值，数据库错误时为None
+    """
+    try:
+        with db.engine.begin() as conn:
+            res = conn.execute(_increment_sql(conn, [{'id': id, 'count': delta}]))
+            if conn.dialect.name == 'mysql':
+                return delta if upsert_inserted(conn, res) else res.lastrowid
+            # 其他数据库(本地测试)在同一事务内读回
+            return conn.execute(
+                select(Counters.__table__.c.count).where(Counters.__table__.c.id == id)
+            ).scalar()
+    except OperationalError as e:
+        logger.info("increment_counter errorMsg= {} ".format(e))
+        return None
+
+
+def increment_counters(deltas):
+    """
+    一条语句原子地累加多个Counter
+    :param deltas: {Counter的ID: 增量}
+    :return: 是否写入成功
+    """
+    rows = [{'id': k, 'count': v} for k, v in sorted(deltas.items()) if v]
+    if not rows:
+        return True
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(_increment_sql(conn, rows))
+        return True
+    except OperationalError as e:
+        logger.info("increment_counters errorMsg= {} ".format(e))
+        return False
+
+
+def query_counts(ids):
+    """
+    批量查询Counter的计数值
+    :param ids: Counter的ID列表
+    :return: {Counter的ID: 计数值}，不存在的ID不在结果中
+    """
+    table = Counters.__table__
+    try:
+        with db.engine.connect() as conn:
+            return dict(conn.execute(
+                select(table.c.id, table.c.count).where(table.c.id.in_(list(ids)))
+            ).fetchall())
+    except OperationalError as e:
+        logger.info("query_counts errorMsg= {} ".format(e))
+        return None
@@ -0,0 +1,25 @@
+from sqlalchemy import Date
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import GenericFunction
+
+
+class days_ago(GenericFunction):
+  """The database's CURRENT_DATE minus a number of days.
+
+  Day windows are compared with dates the database stamped, so today is
+  the database's, not the app's which may be in another timezone.
+  """
+  type = Date()
+  inherit_cache = True
+
+
+@compiles(days_ago)
+def _days_ago(element, compiler, **kw):
+  return 'DATE_SUB(CURRENT_DATE, INTERVAL {} DAY)'.format(
+      compiler.process(element.clauses, **kw))
+
+
+@compiles(days_ago, 'sqlite')
+def _days_ago_sqlite(element, compiler, **kw):
+  return "date(CURRENT_DATE, '-' || {} || ' days')".format(
+      compiler.process(element.clauses, **kw))
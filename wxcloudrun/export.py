@@ -0,0 +1,144 @@
+"""NDJSON export of a user's wishes, shares and helper sessions.
+
+Rows are read through server-side cursors and written out a batch at a
+time, so memory does not grow with the number of rows. Every line
+carries a cursor, passing the last one received resumes an interrupted
+export right after that row. The last line is {"type": "end"}.
+"""
+import simplejson as json
+from sqlalchemy import and_, or_, select
+
+from wxcloudrun.share_slots import total
+from wxcloudrun.tables import share_knock as share_knock_table
+from wxcloudrun.tables import wish as wish_table
+from wxcloudrun.tables import wish_share as wish_share_table
+from wxcloudrun.unix_timestamp import unix_timestamp
+
+EXPORT_BATCH = 500
+
+
+def _after(columns, values):
+  """Rows sorting after `values` on `columns`, for keyset resumption."""
+  if len(columns) == 1:
+    return columns[0] > values[0]
+  return or_(columns[0] > values[0],
+             and_(columns[0] == values[0], _after(columns[1:], values[1:])))
+
+
+def _wish_sql(openid, after):
+  table = wish_table.table
+  sql = select(table.c.id,
+               unix_timestamp(table.c.create_time).label('create_time'),
+               unix_timestamp(table.c.update_time).label('update_time'),
+               unix_timestamp(table.c.last_time).label('last_time'),
+               table.c.wish,
+               table.c.fulfill,
+               table.c.count,
+               table.c.knock,
+               table.c.helper_total,
+               table.c.share_count_total,
+               table.c.share_knock_total,
+               total('helper').label('helper'),
+               total('share_count').label('share_count'),
+               total('share_knock').label('share_knock')).where(
+                   table.c.openid == openid)
+  if after is not None:
+    sql = sql.where(_after([table.c.id], after))
+  return sql.order_by(table.c.id)
+
+
+def _wish_share_sql(openid, after):
+  wish = wish_table.table
+  table = wish_share_table.table
+  sql = select(
+      table.c.wish_id,
+      table.c.id,
+      table.c.share_id,
+      unix_timestamp(table.c.create_time).label('create_time'),
+      table.c.share_content,
+      table.c.wish
+  ).select_from(table.join(wish, wish.c.id == table.c.wish_id)).where(
+      wish.c.openid == openid)
+  if after is not None:
+    sql = sql.where(_after([table.c.wish_id, table.c.id], after))
+  return sql.order_by(table.c.wish_id, table.c.id)
+
+
+def _share_knock_sql(openid, after):
+  wish = wish_table.table
+  table = share_knock_table.table
+  # helpers' openids are not exported
+  sql = select(
+      table.c.wish_id,
+      table.c.id,
+      unix_timestamp(table.c.create_time).label('create_time'),
+      table.c.count,
+      table.c.knock
+  ).select_from(table.join(wish, wish.c.id == table.c.wish_id)).where(
+      wish.c.openid == openid)
+  if after is not None:
+    sql = sql.where(_after([table.c.wish_id, table.c.id], after))
+  return sql.order_by(table.c.wish_id, table.c.id)
+
+
+# (type, query, key columns), exported in this order
+SECTIONS = (
+    ('wish', _wish_sql, ('id',)),
+    ('wish_share', _wish_share_sql, ('wish_id', 'id')),
+    ('share_knock', _share_knock_sql, ('wish_id', 'id')),
+)
+
+
+def encode_cursor(section, key):
+  return '{}:{}'.format(section, ','.join(str(i) for i in key))
+
+
+def decode_cursor(cursor):
+  """Return (section index, key) to resume after, ValueError if invalid."""
+  if cursor is None:
+    return 0, None
+  name, _, key = cursor.partition(':')
+  for i, (section, _, columns) in enumerate(SECTIONS):
+    if section == name:
+      key = tuple(int(v) for v in key.split(','))
+      if len(key) != len(columns):
+        raise ValueError(cursor)
+      return i, key
+  raise ValueError(cursor)
+
+
+def _chunk(section, columns, rows):
+  lines = []
+  for row in rows:
+    data = dict(row._mapping)
+    lines.append(json.dumps({
+        'type': section,
+        'cursor': encode_cursor(section, [data[k] for k in columns]),
+        'data': data}))
+  return '\n'.join(lines) + '\n'
+
+
+END_LINE = json.dumps({'type': 'end'}) + '\n'
+
+
+def export_lines(conn, openid, position=(0, None), batch=EXPORT_BATCH):
+  """Yield NDJSON chunks of up to `batch` rows, starting after `position`."""
+  start, after = position
+  for section, query, columns in SECTIONS[start:]:
+    result = conn.execution_options(stream_results=True).execute(
+        query(openid, after))
+    for rows in result.partitions(batch):
+      yield _chunk(section, columns, rows)
+    after = None
+  yield END_LINE
+
+
+async def stream_lines(conn, openid, position=(0, None), batch=EXPORT_BATCH):
+  """export_lines() on an AsyncConnection, read through conn.stream()."""
+  start, after = position
+  for section, query, columns in SECTIONS[start:]:
+    result = await conn.stream(query(openid, after))
+    async for rows in result.partitions(batch):
+      yield _chunk(section, columns, rows)
+    after = None
+  yield END_LINE
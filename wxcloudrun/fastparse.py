@@ -0,0 +1,222 @@
+"""Compiled fast path for the request schemas.
+
+Each Schema class is compiled once into plain checks of the payloads
+clients actually send: exact JSON types, known keys, the Range / Length
+/ OneOf validators, load_default for missing keys. A payload passing
+them is loaded without marshmallow. Anything else, every invalid request
+included, is loaded by marshmallow, so errors, messages and coercions
+('1' for an Integer, 'true' for a Boolean, ...) stay exactly its own.
+Schemas using anything the compiler does not know (hooks, other field
+types or validators, data_key, unknown other than RAISE) are never
+compiled and always use marshmallow.
+"""
+import re
+import threading
+
+from marshmallow import RAISE, Schema, fields, missing, utils, validate
+from webargs.core import _UNKNOWN_DEFAULT_PARAM
+from webargs.flaskparser import FlaskParser
+
+import config
+
+# marshmallow's own from_iso_date() accepts more, those go the slow way
+_ISO_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+class Unsupported(Exception):
+  pass
+
+
+def _range_check(v):
+  lo, hi = v.min, v.max
+  lo_inc, hi_inc = v.min_inclusive, v.max_inclusive
+
+  def check(value):
+    if lo is not None and (value < lo if lo_inc else value <= lo):
+      return False
+    if hi is not None and (value > hi if hi_inc else value >= hi):
+      return False
+    return True
+  return check
+
+
+def _length_check(v):
+  lo, hi, equal = v.min, v.max, v.equal
+
+  def check(value):
+    n = len(value)
+    if equal is not None:
+      return n == equal
+    return (lo is None or n >= lo) and (hi is None or n <= hi)
+  return check
+
+
+def _validator(v):
+  if type(v) is validate.Range:
+    return _range_check(v)
+  if type(v) is validate.Length:
+    return _length_check(v)
+  if type(v) is validate.OneOf:
+    choices = frozenset(v.choices)
+    return lambda value: value in choices
+  raise Unsupported(v)
+
+
+def _field(field):
+  """Return convert(value) -> loaded value, or `missing` to fall back."""
+  if field.data_key is not None or field.attribute is not None:
+    raise Unsupported(field)
+  checks = tuple(_validator(v) for v in field.validators)
+  allow_none = field.allow_none
+
+  if type(field) is fields.Integer:
+    def convert(value):
+      return value if type(value) is int else missing
+  elif type(field) is fields.String:
+    def convert(value):
+      return value if type(value) is str else missing
+  elif type(field) is fields.Boolean:
+    def convert(value):
+      return value if value is True or value is False else missing
+  elif type(field) is fields.Date and field.format in (None, 'iso'):
+    def convert(value):
+      if type(value) is not str or not _ISO_DATE.match(value):
+        return missing
+      try:
+        return utils.from_iso_date(value)
+      except ValueError:
+        return missing
+  elif type(field) is fields.List:
+    inner = _field(field.inner)
+
+    def convert(value):
+      if type(value) is not list:
+        return missing
+      res = []
+      for i in value:
+        i = inner(i)
+        if i is missing:
+          return missing
+        res.append(i)
+      return res
+  elif (type(field) is fields.Nested and isinstance(field.nested, type) and
+        not field.many and field.only is None and not field.exclude and
+        field.unknown is None):
+    nested = compile_schema(field.nested)
+    if nested is None:
+      raise Unsupported(field)
+    convert = nested.load_fast
+  else:
+    raise Unsupported(field)
+
+  def load(value):
+    if value is None:
+      return None if allow_none else missing
+    value = convert(value)
+    if value is missing:
+      return missing
+    for check in checks:
+      if not check(value):
+        return missing
+    return value
+  return load
+
+
+class CompiledSchema(object):
+  """The fast path of one Schema class."""
+
+  def __init__(self, schema_cls):
+    schema = schema_instance(schema_cls)
+    if schema._hooks or schema.unknown != RAISE:
+      raise Unsupported(schema_cls)
+    self.schema_cls = schema_cls
+    # (name, load, required, load_default)
+    self.fields = tuple(
+        (name, _field(field), field.required, field.load_default)
+        for name, field in schema.load_fields.items())
+    self.names = frozenset(i[0] for i in self.fields)
+
+  def load_fast(self, data):
+    """The loaded dict, or `missing` when marshmallow has to decide."""
+    if type(data) is not dict or not self.names.issuperset(data):
+      return missing
+    res = {}
+    for name, load, required, load_default in self.fields:
+      if name in data:
+        value = load(data[name])
+        if value is missing:
+          return missing
+        res[name] = value
+      elif required:
+        return missing
+      elif load_default is not missing:
+        res[name] = load_default() if callable(load_default) else load_default
+    return res
+
+
+_compiled = {}
+_instances = {}
+# nested schemas are compiled while holding it
+_lock = threading.RLock()
+
+
+def schema_instance(schema_cls):
+  """A shared instance of `schema_cls`, loading does not change it."""
+  try:
+    return _instances[schema_cls]
+  except KeyError:
+    return _instances.setdefault(schema_cls, schema_cls())
+
+
+def compile_schema(schema_cls):
+  """The CompiledSchema of `schema_cls`, None when it cannot be compiled."""
+  try:
+    return _compiled[schema_cls]
+  except KeyError:
+    pass
+  with _lock:
+    if schema_cls not in _compiled:
+      try:
+        _compiled[schema_cls] = CompiledSchema(schema_cls)
+      except Unsupported:
+        _compiled[schema_cls] = None
+    return _compiled[schema_cls]
+
+
+def load(schema_cls, data):
+  """schema_cls().load(data), through the fast path when it applies."""
+  if config.FAST_PARSE:
+    compiled = compile_schema(schema_cls)
+    if compiled is not None:
+      res = compiled.load_fast(data)
+      if res is not missing:
+        return res
+  return schema_instance(schema_cls).load(data)
+
+
+class FastFlaskParser(FlaskParser):
+  """webargs parser trying the compiled schema before marshmallow."""
+
+  def _get_schema(self, argmap, req):
+    # webargs instantiates a Schema class on every request
+    if isinstance(argmap, type) and issubclass(argmap, Schema):
+      return schema_instance(argmap)
+    return super(FastFlaskParser, self)._get_schema(argmap, req)
+
+  def _default_unknown(self, location, unknown):
+    return (unknown == _UNKNOWN_DEFAULT_PARAM and
+            self.unknown == _UNKNOWN_DEFAULT_PARAM and
+            self.DEFAULT_UNKNOWN_BY_LOCATION.get(location) is None)
+
+  def _process_location_data(self, location_data, schema, req, location,
+                             unknown, validators):
+    if (config.FAST_PARSE and not validators and
+        self._default_unknown(location, unknown)):
+      compiled = compile_schema(type(schema))
+      if compiled is not None:
+        res = compiled.load_fast({} if location_data is missing
+                                 else location_data)
+        if res is not missing:
+          return res
+    return super(FastFlaskParser, self)._process_location_data(
+        location_data, schema, req, location, unknown, validators)
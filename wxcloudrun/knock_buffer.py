@@ -0,0 +1,173 @@
+"""Write-behind of increment-only wish updates (WRITE_BEHIND).
+
+wish_update calls only adding to count / knock are merged in a buffer
+and written in one statement every WRITE_BEHIND_INTERVAL seconds, or
+once WRITE_BEHIND_MAX_PENDING wishes are pending.
+
+The buffer lives in the worker: a read flushes the reader's deltas
+buffered by its own worker, while those buffered by another worker, or
+another container, stay invisible until that worker's next flush, for
+WRITE_BEHIND_INTERVAL seconds at most. Deltas still pending when a
+worker is killed without running atexit are lost.
+"""
+import atexit
+import time
+
+from sqlalchemy import and_, case, or_, text
+
+import config
+from wxcloudrun import db
+from wxcloudrun.knock_history import record_sql
+from wxcloudrun.leaderboard import KNOCK_BOARDS, refresh_wishes_sql
+from wxcloudrun.tables import wish as wish_table
+from wxcloudrun.versions import bump_user
+from wxcloudrun.write_behind import WriteBehind
+
+
+def knock_update_sql(deltas):
+  """One UPDATE applying {(openid, wish_id): (count, knock)}."""
+  table = wish_table.table
+  count_whens = []
+  knock_whens = []
+  conds = []
+  for (openid, wish_id), (count, knock) in deltas.items():
+    cond = and_(table.c.id == wish_id, table.c.openid == openid)
+    conds.append(cond)
+    if count:
+      count_whens.append((cond, count))
+    if knock:
+      knock_whens.append((cond, knock))
+
+  values = dict(last_time=text('CURRENT_TIMESTAMP'))
+  if count_whens:
+    values['count'] = table.c.count + case(*count_whens, else_=0)
+  if knock_whens:
+    values['knock'] = table.c.knock + case(*knock_whens, else_=0)
+  return table.update().values(**values).where(or_(*conds))
+
+
+def batch_knock_update(deltas, conn=None):
+  """Apply `deltas` in one statement, returns the number of matched rows.
+
+  Runs on `conn` when given, else on a connection of its own. The
+  version of every openid in `deltas` is bumped after the commit.
+  """
+  if not deltas:
+    return 0
+  if conn is None:
+    with db.engine.connect() as conn:
+      return batch_knock_update(deltas, conn)
+  with conn.begin():
+    rows = conn.execute(knock_update_sql(deltas)).rowcount
+    conn.execute(refresh_wishes_sql(conn, {k[1] for k in deltas}, KNOCK_BOARDS))
+    history_sql = record_sql(conn, deltas)
+    if history_sql is not None:
+      conn.execute(history_sql)
+  if rows:
+    for openid in {k[0] for k in deltas}:
+      bump_user(openid)
+  return rows
+
+
+class KnockBuffer(WriteBehind):
+  """Per-worker write-behind buffer for increment-only wish updates."""
+
+  name = 'knock-buffer'
+
+  def __init__(self, interval, max_pending):
+    super(KnockBuffer, self).__init__(interval)
+    self.max_pending = max_pending
+    self._pending = {}
+    self._first_time = None
+    self.writes = 0
+    self.merged = 0
+    self.flushes = 0
+    self.flushed_rows = 0
+    self.flush_seconds = 0.
+    self.flush_max_seconds = 0.
+
+  def add(self, openid, wish_id, count, knock):
+    key = (openid, wish_id)
+    with self._lock:
+      self.writes += 1
+      if key in self._pending:
+        self.merged += 1
+        c, k = self._pending[key]
+        self._pending[key] = (c + (count or 0), k + (knock or 0))
+      else:
+        self._pending[key] = (count or 0, knock or 0)
+      if self._first_time is None:
+        self._first_time = time.monotonic()
+      due = (len(self._pending) >= self.max_pending or
+             time.monotonic() - self._first_time >= self.interval)
+    self._started()
+    if due:
+      try:
+        self.flush()
+      except Exception:
+        self._app.logger.exception('knock buffer flush failed')
+
+  def _take(self, openid=None):
+    with self._lock:
+      if openid is None:
+        pending, self._pending = self._pending, {}
+      else:
+        pending = {k: v for k, v in self._pending.items() if k[0] == openid}
+        for k in pending:
+          del self._pending[k]
+      if not self._pending:
+        self._first_time = None
+    return pending
+
+  def flush(self, openid=None):
+    """Write pending deltas, or only those of `openid`, to the database."""
+    # serialize flushes so a read after flush(openid) never races an
+    # in-flight batch that still holds this user's deltas
+    with self._flush_lock:
+      pending = self._take(openid)
+      if not pending:
+        return 0
+      start = time.perf_counter()
+      try:
+        with self._app.app_context():
+          rows = batch_knock_update(pending)
+      except Exception:
+        # put the deltas back so they are retried by the next flush
+        with self._lock:
+          for key, (c, k) in pending.items():
+            oc, ok = self._pending.get(key, (0, 0))
+            self._pending[key] = (oc + c, ok + k)
+          if self._first_time is None:
+            self._first_time = time.monotonic()
+        raise
+      elapsed = time.perf_counter() - start
+      with self._lock:
+        self.flushes += 1
+        self.flushed_rows += rows
+        self.flush_seconds += elapsed
+        self.flush_max_seconds = max(self.flush_max_seconds, elapsed)
+      return rows
+
+  def stats(self):
+    with self._lock:
+      return {'writes': self.writes,
+              'merged': self.merged,
+              'pending': len(self._pending),
+              'flushes': self.flushes,
+              'flushed_rows': self.flushed_rows,
+              'flush_seconds': self.flush_seconds,
+              'flush_max_seconds': self.flush_max_seconds}
+
+
+knock_buffer = None
+if config.WRITE_BEHIND:
+  knock_buffer = KnockBuffer(config.WRITE_BEHIND_INTERVAL,
+                             config.WRITE_BEHIND_MAX_PENDING)
+  atexit.register(knock_buffer.flush)
+
+
+def flush_knocks(openid=None):
+  """Flush buffered knocks, returns the number of rows written."""
+  if knock_buffer is None:
+    return 0
+  return knock_buffer.flush(openid)
@@ -0,0 +1,81 @@
+"""Per-wish daily knock history, one row per wish and day."""
+from datetime import timedelta
+
+from sqlalchemy import and_, case, func, or_, select
+
+from wxcloudrun.tables import wish as wish_table
+from wxcloudrun.tables import wish_daily as daily_table
+from wxcloudrun.upsert import upsert
+
+# a year, leap day included
+HISTORY_MAX_DAYS = 366
+
+
+def _add(new):
+  table = daily_table.table
+  return {'count': table.c.count + new.count,
+          'knock': table.c.knock + new.knock}
+
+
+def record_sql(bind, deltas):
+  """Add {(openid, wish_id): (count, knock)} to today's rows.
+
+  Selected from the wish table, so a wish_id the openid does not own
+  adds nothing. Returns None when there is nothing to add.
+  """
+  table = wish_table.table
+  count_whens = []
+  knock_whens = []
+  conds = []
+  for (openid, wish_id), (count, knock) in deltas.items():
+    if not count and not knock:
+      continue
+    cond = and_(table.c.id == wish_id, table.c.openid == openid)
+    conds.append(cond)
+    count_whens.append((cond, count or 0))
+    knock_whens.append((cond, knock or 0))
+  if not conds:
+    return
+  sql = select(
+      table.c.id.label('wish_id'),
+      func.current_date().label('day'),
+      case(*count_whens, else_=0).label('count'),
+      case(*knock_whens, else_=0).label('knock')
+  ).where(or_(*conds))
+  return upsert(bind, daily_table.table, sql, _add,
+                index_elements=['wish_id', 'day'])
+
+
+def today_sql():
+  """The database's date, the day record_sql() adds to."""
+  return select(func.current_date())
+
+
+def window(start, end):
+  """Number of days from `start` to `end` inclusive, None if invalid."""
+  days = (end - start).days + 1
+  if days < 1 or days > HISTORY_MAX_DAYS:
+    return
+  return days
+
+
+def range_sql(wish_id, start, end):
+  table = daily_table.table
+  return select(table.c.day, table.c.count, table.c.knock).where(
+      and_(table.c.wish_id == wish_id,
+           table.c.day >= start,
+           table.c.day <= end))
+
+
+def dense(rows, start, days):
+  """Daily count and knock arrays of `days` days from `start`."""
+  count = [0] * days
+  knock = [0] * days
+  for day, c, k in rows:
+    i = (day - start).days
+    count[i] = c
+    knock[i] = k
+  return {'start': start.isoformat(),
+          'end': (start + timedelta(days=days - 1)).isoformat(),
+          'count': count,
+          'knock': knock}
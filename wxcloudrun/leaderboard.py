@@ -0,0 +1,110 @@
+import click
+from flask import Blueprint
+from sqlalchemy import and_, desc, func, literal, select, union_all
+
+from wxcloudrun import db
+from wxcloudrun.share_slots import total
+from wxcloudrun.tables import wish as wish_table
+from wxcloudrun.tables import wish_score as score_table
+from wxcloudrun.upsert import upsert
+
+bp = Blueprint('leaderboard', __name__, cli_group=None)
+
+BOARDS = ('knock', 'count', 'helped')
+KNOCK_BOARDS = ('knock', 'count')
+HELPED_BOARDS = ('helped',)
+
+# ranks past this are reported as None (wish_rank returns it as
+# rank_limit), keeps a rank lookup an index range of bounded length
+RANK_LIMIT = 1000
+
+
+def _board_score(board):
+  table = wish_table.table
+  if board == 'helped':
+    return table.c.helper_total + total('helper')
+  return table.c[board]
+
+
+def _scores_select(where, boards):
+  table = wish_table.table
+  return union_all(*[
+      select(literal(board).label('board'),
+             table.c.id.label('wish_id'),
+             func.coalesce(table.c.openid, '').label('openid'),
+             func.coalesce(_board_score(board), 0).label('score'))
+      .where(where)
+      for board in boards
+  ])
+
+
+def refresh_sql(bind, where, boards=BOARDS):
+  """Copy the current `boards` scores of the wishes matching `where`.
+
+  Runs in the transaction of the write that changed them, so wish_score
+  is never behind the wish table.
+  """
+  return upsert(bind, score_table.table, _scores_select(where, boards),
+                lambda new: {'score': new.score},
+                index_elements=['board', 'wish_id'])
+
+
+def refresh_wishes_sql(bind, wish_ids, boards=BOARDS):
+  return refresh_sql(bind, wish_table.table.c.id.in_(list(wish_ids)), boards)
+
+
+def top_sql(board, limit, openid=None):
+  table = score_table.table
+  sql = select(table.c.wish_id, table.c.openid, table.c.score).where(
+      and_(table.c.board == board, table.c.score > 0))
+  if openid is not None:
+    sql = sql.where(table.c.openid == openid)
+  return sql.order_by(desc(table.c.score), desc(table.c.wish_id)).limit(limit)
+
+
+def score_sql(board, wish_id):
+  table = score_table.table
+  return select(table.c.score).where(and_(table.c.board == board,
+                                          table.c.wish_id == wish_id))
+
+
+def ahead_sql(board, score, openid=None):
+  """Number of wishes scoring above `score`, counted up to RANK_LIMIT."""
+  table = score_table.table
+  ahead = select(table.c.wish_id).where(and_(table.c.board == board,
+                                             table.c.score > score))
+  if openid is not None:
+    ahead = ahead.where(table.c.openid == openid)
+  ahead = ahead.limit(RANK_LIMIT).subquery('ahead')
+  return select(func.count()).select_from(ahead)
+
+
+def rank(ahead):
+  """The rank after `ahead` wishes, None past RANK_LIMIT."""
+  return ahead + 1 if ahead < RANK_LIMIT else None
+
+
+def ranks(scores):
+  """Competition ranks (1, 2, 2, 4) of scores sorted high to low."""
+  res = []
+  for i, score in enumerate(scores):
+    res.append(res[-1] if i and score == scores[i - 1] else i + 1)
+  return res
+
+
+def rebuild(bind, batch=1000):
+  """Refresh every wish's scores in id ranges of `batch`, returns rows."""
+  table = wish_table.table
+  max_id = bind.execute(select(func.max(table.c.id))).scalar() or 0
+  rows = 0
+  for start in range(0, max_id + 1, batch):
+    rows += bind.execute(refresh_sql(
+        bind, and_(table.c.id >= start, table.c.id < start + batch))).rowcount
+  return rows
+
+
+@bp.cli.command('leaderboard-rebuild')
+@click.option('--batch', type=int, default=1000)
+def rebuild_command(batch):
+  """Recompute wish_score from the wish table."""
+  click.echo('{} rows'.format(rebuild(db.engine, batch)))
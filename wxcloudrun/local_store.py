@@ -0,0 +1,80 @@
+import os
+import sqlite3
+import threading
+import time
+
+import simplejson as json
+
+
+class LocalStore(object):
+  """Small key/value store in a SQLite file on local disk.
+
+  Every gunicorn worker of a container opens the same file, so entries
+  written by one worker are visible to the others.
+  """
+
+  def __init__(self, path, max_rows=None):
+    self.path = path
+    self.max_rows = max_rows
+    self._lock = threading.Lock()
+    self._conn = None
+    self._pid = None
+    self._writes = 0
+
+  def _connect(self):
+    # connections must not cross a fork, reopen in every worker
+    if self._conn is None or self._pid != os.getpid():
+      conn = sqlite3.connect(self.path,
+                             timeout=1,
+                             isolation_level=None,
+                             check_same_thread=False)
+      conn.execute('PRAGMA journal_mode=WAL')
+      conn.execute('PRAGMA synchronous=NORMAL')
+      conn.execute('CREATE TABLE IF NOT EXISTS kv ('
+                   'key TEXT PRIMARY KEY, '
+                   'value TEXT, '
+                   'expires REAL)')
+      self._conn = conn
+      self._pid = os.getpid()
+    return self._conn
+
+  def get(self, key):
+    """Return (value, expires), or None if missing or expired."""
+    with self._lock:
+      row = self._connect().execute(
+          'SELECT value, expires FROM kv WHERE key = ?', (key,)
+      ).fetchone()
+    if row is None or (row[1] is not None and row[1] < time.time()):
+      return None
+    return json.loads(row[0]), row[1]
+
+  def set(self, key, value, ttl=None):
+    """Store `value`, returns the number of rows pruned to stay in size."""
+    expires = None if ttl is None else time.time() + ttl
+    with self._lock:
+      conn = self._connect()
+      conn.execute('REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)',
+                   (key, json.dumps(value), expires))
+      self._writes += 1
+      if self._writes % 256 == 0:
+        return self._prune(conn)
+    return 0
+
+  def delete(self, *keys):
+    if not keys:
+      return
+    with self._lock:
+      self._connect().executemany('DELETE FROM kv WHERE key = ?',
+                                  [(k,) for k in keys])
+
+  def _prune(self, conn):
+    pruned = conn.execute('DELETE FROM kv WHERE expires < ?',
+                          (time.time(),)).rowcount
+    if self.max_rows:
+      pruned += conn.execute(
+          'DELETE FROM kv WHERE key IN ('
+          'SELECT key FROM kv WHERE expires IS NOT NULL '
+          'ORDER BY expires LIMIT max(0, (SELECT count(*) FROM kv) - ?))',
+          (self.max_rows,)
+      ).rowcount
+    return pruned
@@ -0,0 +1,362 @@
+import fcntl
+import os
+import random
+import threading
+import time
+
+import simplejson as json
+from flask import Blueprint, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+import config
+from wxcloudrun.fastparse import FastFlaskParser
+
+SECONDS_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5.)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13, 21)
+
+bp = Blueprint('metrics', __name__)
+
+HISTOGRAMS = {
+    'wooden_fish_request_seconds': SECONDS_BUCKETS,
+    'wooden_fish_request_db_seconds': SECONDS_BUCKETS,
+    'wooden_fish_request_parse_seconds': SECONDS_BUCKETS,
+    'wooden_fish_request_serialize_seconds': SECONDS_BUCKETS,
+    'wooden_fish_request_sql_statements': COUNT_BUCKETS,
+    'wooden_fish_request_checkouts': COUNT_BUCKETS,
+}
+
+
+class Registry(object):
+  """Counters, gauges and histograms keyed by 'name{labels}'."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.counters = {}
+    self.histograms = {}
+    self.collectors = {}
+
+  def inc(self, name, labels='', value=1):
+    key = name + labels
+    with self._lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def observe(self, name, labels, value):
+    key = name + labels
+    buckets = HISTOGRAMS[name]
+    with self._lock:
+      hist = self.histograms.get(key)
+      if hist is None:
+        hist = self.histograms[key] = {'buckets': [0] * (len(buckets) + 1),
+                                       'sum': 0.,
+                                       'count': 0}
+      for idx, le in enumerate(buckets):
+        if value <= le:
+          hist['buckets'][idx] += 1
+          break
+      else:
+        hist['buckets'][-1] += 1
+      hist['sum'] += value
+      hist['count'] += 1
+
+  def snapshot(self):
+    with self._lock:
+      res = {'counters': dict(self.counters),
+             'gauges': {},
+             'histograms': {k: {'buckets': list(v['buckets']),
+                                'sum': v['sum'],
+                                'count': v['count']}
+                            for k, v in self.histograms.items()}}
+    for prefix, (collect, gauges) in self.collectors.items():
+      for k, v in collect().items():
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
+          kind = 'gauges' if k in gauges else 'counters'
+          res[kind]['{}_{}'.format(prefix, k)] = v
+    return res
+
+  def gauge_names(self):
+    return {'{}_{}'.format(prefix, k)
+            for prefix, (_, gauges) in self.collectors.items()
+            for k in gauges}
+
+
+registry = Registry()
+
+
+def register_collector(prefix, collect, gauges=()):
+  """Export the numeric values of `collect()` as `prefix`_<key>.
+
+  Values are per worker totals exported as counters, except the keys in
+  `gauges`: current values or maxima, exported as gauges of the live
+  workers, summed or for *_max* keys the largest.
+  """
+  registry.collectors[prefix] = (collect, frozenset(gauges))
+
+
+def inc(name, **labels):
+  """Increment counter `name` with the given labels."""
+  registry.inc(name, _labels(**labels))
+
+
+def _merge(into, snapshot):
+  for k, v in snapshot['counters'].items():
+    into['counters'][k] = into['counters'].get(k, 0) + v
+  for k, v in snapshot.get('gauges', {}).items():
+    if k not in into['gauges']:
+      into['gauges'][k] = v
+    elif '_max' in k:
+      into['gauges'][k] = max(into['gauges'][k], v)
+    else:
+      into['gauges'][k] += v
+  for k, v in snapshot['histograms'].items():
+    hist = into['histograms'].get(k)
+    if hist is None:
+      into['histograms'][k] = {'buckets': list(v['buckets']),
+                               'sum': v['sum'],
+                               'count': v['count']}
+      continue
+    hist['buckets'] = [a + b for a, b in zip(hist['buckets'], v['buckets'])]
+    hist['sum'] += v['sum']
+    hist['count'] += v['count']
+
+
+def _write_json(path, data):
+  tmp = '{}.{}.tmp'.format(path, os.getpid())
+  with open(tmp, 'w') as f:
+    json.dump(data, f)
+  os.replace(tmp, path)
+
+
+def _alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+
+class WorkerFiles(object):
+  """Share snapshots between gunicorn workers through a local directory.
+
+  Every worker writes <pid>.json, the counters and histograms of exited
+  workers are folded into dead.json so totals never go backwards. Their
+  gauges are dropped.
+  """
+
+  def __init__(self, path, interval):
+    self.path = path
+    self.interval = interval
+    self._last_write = 0.
+    os.makedirs(path, exist_ok=True)
+
+  def maybe_write(self, registry):
+    now = time.monotonic()
+    if now - self._last_write < self.interval:
+      return
+    self._last_write = now
+    self.write(registry)
+
+  def write(self, registry):
+    _write_json(os.path.join(self.path, '{}.json'.format(os.getpid())),
+                registry.snapshot())
+
+  def collect(self, registry):
+    self.write(registry)
+    merged = {'counters': {}, 'gauges': {}, 'histograms': {}}
+    with open(os.path.join(self.path, 'lock'), 'w') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      dead_path = os.path.join(self.path, 'dead.json')
+      dead = {'counters': {}, 'histograms': {}}
+      if os.path.exists(dead_path):
+        with open(dead_path) as f:
+          dead = json.load(f)
+      changed = False
+      for name in os.listdir(self.path):
+        pid = name[:-len('.json')]
+        if not name.endswith('.json') or not pid.isdigit():
+          continue
+        path = os.path.join(self.path, name)
+        try:
+          with open(path) as f:
+            snapshot = json.load(f)
+        except (OSError, ValueError):
+          continue
+        if _alive(int(pid)):
+          _merge(merged, snapshot)
+        else:
+          snapshot.pop('gauges', None)
+          _merge(dead, snapshot)
+          os.remove(path)
+          changed = True
+      # gauges exported as counters by older versions
+      gauges = registry.gauge_names()
+      if any(k in gauges for k in dead['counters']):
+        dead['counters'] = {k: v for k, v in dead['counters'].items()
+                            if k not in gauges}
+        changed = True
+      if changed:
+        _write_json(dead_path, dead)
+    _merge(merged, dead)
+    return merged
+
+
+worker_files = (WorkerFiles(config.METRICS_DIR, config.METRICS_WRITE_INTERVAL)
+                if config.METRICS_DIR else None)
+
+
+def _labels(**labels):
+  return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                        for k, v in sorted(labels.items())) + '}'
+
+
+def _format_le(le):
+  return repr(float(le))
+
+
+def render():
+  """Prometheus text exposition of all workers (or this one)."""
+  if worker_files is not None:
+    data = worker_files.collect(registry)
+  else:
+    data = registry.snapshot()
+
+  lines = []
+  typed = set()
+  for kind, metric_type in (('counters', 'counter'), ('gauges', 'gauge')):
+    for key in sorted(data[kind]):
+      name = key.partition('{')[0]
+      if name not in typed:
+        typed.add(name)
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+      lines.append('{} {}'.format(key, data[kind][key]))
+  for key in sorted(data['histograms']):
+    name, _, labels = key.partition('{')
+    labels = labels[:-1]
+    if name not in typed:
+      typed.add(name)
+      lines.append('# TYPE {} histogram'.format(name))
+    hist = data['histograms'][key]
+    cumulative = 0
+    for le, n in zip(HISTOGRAMS[name] + ('+Inf',), hist['buckets']):
+      cumulative += n
+      le = le if le == '+Inf' else _format_le(le)
+      lines.append('{}_bucket{{{}le="{}"}} {}'.format(
+          name, labels + ',' if labels else '', le, cumulative))
+    lines.append('{}_sum{{{}}} {}'.format(name, labels, hist['sum']))
+    lines.append('{}_count{{{}}} {}'.format(name, labels, hist['count']))
+  return '\n'.join(lines) + '\n'
+
+
+def _tracked(path):
+  return path.startswith(config.METRICS_ROUTE_PREFIXES)
+
+
+def _current():
+  if not has_request_context():
+    return None
+  return g.get('metrics')
+
+
+@bp.before_app_request
+def _before_request():
+  if not _tracked(request.path):
+    return
+  if config.METRICS_SAMPLE_RATE < 1 and random.random() >= config.METRICS_SAMPLE_RATE:
+    g.metrics = None
+  else:
+    g.metrics = {'start': time.perf_counter(),
+                 'sql': 0,
+                 'checkouts': 0,
+                 'db': 0.,
+                 'parse': 0.,
+                 'serialize': 0.}
+
+
+@bp.after_app_request
+def _after_request(response):
+  if not _tracked(request.path):
+    return response
+  route = request.url_rule.rule if request.url_rule else 'other'
+  registry.inc('wooden_fish_requests_total',
+               _labels(route=route, status=response.status_code))
+  m = g.get('metrics')
+  if m is not None:
+    labels = _labels(route=route)
+    registry.observe('wooden_fish_request_seconds', labels,
+                     time.perf_counter() - m['start'])
+    registry.observe('wooden_fish_request_sql_statements', labels, m['sql'])
+    registry.observe('wooden_fish_request_checkouts', labels, m['checkouts'])
+    registry.observe('wooden_fish_request_db_seconds', labels, m['db'])
+    registry.observe('wooden_fish_request_parse_seconds', labels, m['parse'])
+    registry.observe('wooden_fish_request_serialize_seconds', labels,
+                     m['serialize'])
+  if worker_files is not None:
+    try:
+      worker_files.maybe_write(registry)
+    except OSError:
+      current_app.logger.exception('writing metrics snapshot failed')
+  return response
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+  if _current() is not None:
+    conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+  m = _current()
+  if m is None or not conn.info.get('metrics_start'):
+    return
+  m['sql'] += 1
+  m['db'] += time.perf_counter() - conn.info['metrics_start'].pop()
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+  # a failed statement never reaches after_cursor_execute, its start would
+  # stay on the pooled connection and be popped by the next statement
+  conn = context.connection
+  if conn is None or not conn.info.get('metrics_start'):
+    return
+  start = conn.info['metrics_start'].pop()
+  m = _current()
+  if m is not None:
+    m['sql'] += 1
+    m['db'] += time.perf_counter() - start
+
+
+@event.listens_for(Pool, 'checkout')
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+  m = _current()
+  if m is not None:
+    m['checkouts'] += 1
+
+
+def record_serialize(seconds):
+  m = _current()
+  if m is not None:
+    m['serialize'] += seconds
+
+
+class TimedFlaskParser(FastFlaskParser):
+  """webargs parser recording parse/validation time of the request."""
+
+  def parse(self, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+      return super(TimedFlaskParser, self).parse(*args, **kwargs)
+    finally:
+      m = _current()
+      if m is not None:
+        m['parse'] += time.perf_counter() - start
+
+
+parser = TimedFlaskParser()
+use_kwargs = parser.use_kwargs
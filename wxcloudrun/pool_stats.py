@@ -0,0 +1,83 @@
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+class PoolStats(object):
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self.checkouts = 0
+    self.checkout_wait_seconds = 0.
+    self.checkout_wait_max_seconds = 0.
+    self.overflow_events = 0
+    self.timeouts = 0
+    self.pre_ping_failures = 0
+    self.invalidations = 0
+    self.connects = 0
+
+  def stats(self, pool=None):
+    with self._lock:
+      res = {'checkouts': self.checkouts,
+             'checkout_wait_seconds': self.checkout_wait_seconds,
+             'checkout_wait_max_seconds': self.checkout_wait_max_seconds,
+             'overflow_events': self.overflow_events,
+             'timeouts': self.timeouts,
+             'pre_ping_failures': self.pre_ping_failures,
+             'invalidations': self.invalidations,
+             'connects': self.connects}
+    if isinstance(pool, QueuePool):
+      res.update(size=pool.size(),
+                 checked_out=pool.checkedout(),
+                 overflow=pool.overflow())
+    return res
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedQueuePool(QueuePool):
+  """QueuePool recording checkout wait time and overflow use."""
+
+  def _do_get(self):
+    start = time.perf_counter()
+    try:
+      conn = super(InstrumentedQueuePool, self)._do_get()
+    except TimeoutError:
+      with pool_stats._lock:
+        pool_stats.timeouts += 1
+      raise
+    wait = time.perf_counter() - start
+    overflow = self.checkedout() > self.size()
+    with pool_stats._lock:
+      pool_stats.checkouts += 1
+      pool_stats.checkout_wait_seconds += wait
+      pool_stats.checkout_wait_max_seconds = max(
+          pool_stats.checkout_wait_max_seconds, wait)
+      pool_stats.overflow_events += overflow
+    # the pre-ping runs after _do_get and before the checkout event
+    pool_stats._local.pinging = True
+    return conn
+
+
+@event.listens_for(InstrumentedQueuePool, 'checkout')
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+  pool_stats._local.pinging = False
+
+
+@event.listens_for(InstrumentedQueuePool, 'invalidate')
+def _on_invalidate(dbapi_connection, connection_record, exception):
+  with pool_stats._lock:
+    pool_stats.invalidations += 1
+    if getattr(pool_stats._local, 'pinging', False):
+      pool_stats.pre_ping_failures += 1
+
+
+@event.listens_for(InstrumentedQueuePool, 'connect')
+def _on_connect(dbapi_connection, connection_record):
+  with pool_stats._lock:
+    pool_stats.connects += 1
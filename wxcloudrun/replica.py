@@ -0,0 +1,157 @@
+import threading
+import time
+
+from flask import (Blueprint, current_app, has_app_context,
+                   has_request_context, request)
+from sqlalchemy.exc import OperationalError
+
+import config
+from wxcloudrun import db
+from wxcloudrun.local_store import LocalStore
+from wxcloudrun.view import connection_or_engine
+
+REPLICA_BIND = 'replica'
+
+bp = Blueprint('replica', __name__)
+
+
+class ReplicaRouter(object):
+  """Run read-only queries on the replica bind, writes stay on db.engine.
+
+  For `window` seconds after a user's last write their reads go to the
+  primary so they always see their own writes. Recent writers are kept
+  in `store` when set, so the window holds across the workers of a
+  container. A replica that fails to connect is skipped for
+  `retry_interval` seconds.
+  """
+
+  def __init__(self, window, retry_interval, store=None):
+    self.window = window
+    self.retry_interval = retry_interval
+    self.store = store
+    self.read_views = set()
+    self._lock = threading.Lock()
+    self._writes = {}
+    self._down_until = 0.
+    self.replica_reads = 0
+    self.primary_reads = 0
+    self.recent_write_reads = 0
+    self.empty_fallbacks = 0
+    self.failures = 0
+
+  @staticmethod
+  def enabled():
+    # the ASGI app has no replica bind
+    return has_app_context() and REPLICA_BIND in (current_app.config.get('SQLALCHEMY_BINDS') or {})
+
+  def mark_write(self, openid):
+    if openid is None or not self.enabled():
+      return
+    with self._lock:
+      self._writes[openid] = time.time() + self.window
+    if self.store is not None:
+      self.store.set('write:{}'.format(openid), 1, self.window)
+
+  def _recent_write(self, openid):
+    if openid is None:
+      return False
+    with self._lock:
+      until = self._writes.get(openid)
+      if until is not None and until < time.time():
+        del self._writes[openid]
+        until = None
+    if until is not None:
+      return True
+    return (self.store is not None and
+            self.store.get('write:{}'.format(openid)) is not None)
+
+  def _use_replica(self, openid):
+    if not self.enabled() or self._down_until > time.time():
+      return False
+    if self._recent_write(openid):
+      with self._lock:
+        self.recent_write_reads += 1
+      return False
+    return True
+
+  def _replica_failed(self):
+    current_app.logger.exception('replica read failed, using the primary')
+    with self._lock:
+      self.failures += 1
+      self._down_until = time.time() + self.retry_interval
+
+  def connect(self, openid=None):
+    """A connection for a long read, on the replica when allowed."""
+    if self._use_replica(openid):
+      try:
+        conn = db.get_engine(bind=REPLICA_BIND).connect()
+      except OperationalError:
+        self._replica_failed()
+      else:
+        with self._lock:
+          self.replica_reads += 1
+        return conn
+    with self._lock:
+      self.primary_reads += 1
+    return db.engine.connect()
+
+  def fetchall(self, sql, openid=None, primary_if_empty=False):
+    """Fetch all rows of `sql` from the replica when allowed.
+
+    `primary_if_empty` re-reads an empty result on the primary, for rows
+    that may have been created moments ago by someone else.
+    """
+    if self._use_replica(openid):
+      try:
+        rows = connection_or_engine(REPLICA_BIND).execute(sql).fetchall()
+      except OperationalError:
+        self._replica_failed()
+      else:
+        with self._lock:
+          self.replica_reads += 1
+        if rows or not primary_if_empty:
+          return rows
+        with self._lock:
+          self.empty_fallbacks += 1
+    with self._lock:
+      self.primary_reads += 1
+    return connection_or_engine().execute(sql).fetchall()
+
+  def stats(self):
+    with self._lock:
+      return {'enabled': self.enabled(),
+              'down': self._down_until > time.time(),
+              'replica_reads': self.replica_reads,
+              'primary_reads': self.primary_reads,
+              'recent_write_reads': self.recent_write_reads,
+              'empty_fallbacks': self.empty_fallbacks,
+              'failures': self.failures}
+
+
+router = ReplicaRouter(
+    config.REPLICA_READ_YOUR_WRITES,
+    config.REPLICA_RETRY_INTERVAL,
+    store=(LocalStore(config.REPLICA_WRITES_PATH)
+           if config.REPLICA_WRITES_PATH else None)
+)
+
+
+def read_only(func):
+  """Mark a view as read-only, POSTs to any other view count as writes."""
+  router.read_views.add(func)
+  return func
+
+
+def read_fetchall(sql, primary_if_empty=False):
+  """router.fetchall() for the user of the current request."""
+  openid = (request.headers.get('X-WX-OPENID')
+            if has_request_context() else None)
+  return router.fetchall(sql, openid, primary_if_empty=primary_if_empty)
+
+
+@bp.after_app_request
+def _mark_write(response):
+  if (request.method == 'POST' and response.status_code == 200 and
+      current_app.view_functions.get(request.endpoint) not in router.read_views):
+    router.mark_write(request.headers.get('X-WX-OPENID'))
+  return response
@@ -1,18 +1,34 @@
+import time
+
 import simplejson as json
 
 from flask import Response
 
+from wxcloudrun.metrics import record_serialize
+
+
+def _dumps(obj):
+    start = time.perf_counter()
+    data = json.dumps(obj)
+    record_serialize(time.perf_counter() - start)
+    return data
+
+
+def succ_body(data):
+    return _dumps({'code': 0, 'data': data})
+
+
+def err_body(err_msg):
+    return _dumps({'code': -1, 'errorMsg': err_msg})
+
 
 def make_succ_empty_response():
-    data = json.dumps({'code': 0, 'data': {}})
-    return Response(data, mimetype='application/json')
+    return Response(succ_body({}), mimetype='application/json')
 
 
 def make_succ_response(data):
-    data = json.dumps({'code': 0, 'data': data})
-    return Response(data, mimetype='application/json')
+    return Response(succ_body(data), mimetype='application/json')
 
 
 def make_err_response(err_msg):
-    data = json.dumps({'code': -1, 'errorMsg': err_msg})
-    return Response(data, mimetype='application/json')
+    return Response(err_body(err_msg), mimetype='application/json')
@@ -0,0 +1,226 @@
+"""Retention of share_knock rows.
+
+Only the last ROLLUP_WINDOW_DAYS of helper sessions are read, through
+share_knock_daily, so rows older than the retention horizon are folded
+into their daily buckets and removed. Plain tables lose them in bounded
+delete batches, tables partitioned by month (share-knock-partition-sql)
+drop whole partitions.
+"""
+import re
+import time
+from datetime import date, datetime, timedelta
+
+import click
+from flask import Blueprint
+from sqlalchemy import and_, func, select, text
+
+import config
+from wxcloudrun import db
+from wxcloudrun.share_rollup import ROLLUP_WINDOW_DAYS, fold_sql
+from wxcloudrun.tables import share_knock as share_knock_table
+
+bp = Blueprint('retention', __name__, cli_group=None)
+
+PARTITION_NAME = re.compile(r'^p(\d{8})$')
+
+
+def horizon(bind, days):
+  """Midnight `days` days ago, rows created before it expire.
+
+  Today is taken from the database, which stamps create_time.
+  """
+  if days <= ROLLUP_WINDOW_DAYS:
+    raise ValueError('retention must exceed the {} day rollup window'.format(
+        ROLLUP_WINDOW_DAYS))
+  today = bind.execute(select(func.current_date())).scalar()
+  return datetime.combine(today - timedelta(days=days), datetime.min.time())
+
+
+def _day_range(day):
+  table = share_knock_table.table
+  start = datetime.combine(day, datetime.min.time())
+  return and_(table.c.create_time >= start,
+              table.c.create_time < start + timedelta(days=1))
+
+
+def _expired_groups(bind, before, batch):
+  """(wish_id, day) of the oldest `batch` rows created before `before`."""
+  table = share_knock_table.table
+  rows = bind.execute(select(table.c.wish_id, table.c.create_time)
+                      .where(table.c.create_time < before)
+                      .order_by(table.c.create_time)
+                      .limit(batch))
+  return {(i.wish_id, i.create_time.date()) for i in rows}
+
+
+def _delete_rows(conn, where, batch):
+  """Delete the rows matching `where`, `batch` rows per statement."""
+  table = share_knock_table.table
+  rows = 0
+  while True:
+    ids = [i[0] for i in conn.execute(select(table.c.id).where(where)
+                                      .order_by(table.c.id).limit(batch))]
+    if ids:
+      rows += conn.execute(table.delete().where(table.c.id.in_(ids))).rowcount
+    if len(ids) < batch:
+      return rows
+
+
+def compact(engine, before, batch, pause=0., max_batches=None):
+  """Fold and delete share_knock rows created before `before`.
+
+  Each batch takes the wish and day of the oldest `batch` rows. A wish's
+  day is folded and deleted in a transaction of its own, so its bucket
+  is always rebuilt from all of its rows and an interrupted run can
+  simply be repeated, and no DELETE removes more than `batch` rows.
+  Returns (buckets folded, rows deleted).
+  """
+  table = share_knock_table.table
+  buckets = rows = batches = 0
+  while max_batches is None or batches < max_batches:
+    groups = _expired_groups(engine, before, batch)
+    if not groups:
+      break
+    for wish_id, day in groups:
+      where = and_(table.c.wish_id == wish_id, _day_range(day))
+      with engine.begin() as conn:
+        if wish_id is not None:
+          conn.execute(fold_sql(conn, where))
+        rows += _delete_rows(conn, where, batch)
+    buckets += len(groups)
+    batches += 1
+    if pause:
+      time.sleep(pause)
+  return buckets, rows
+
+
+def _month_bounds(start, months):
+  """First days of the `months` months following the month of `start`."""
+  bounds = []
+  year, month = start.year, start.month
+  for _ in range(months):
+    year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    bounds.append(date(year, month, 1))
+  return bounds
+
+
+def _partition(bound):
+  return ("PARTITION `p{:%Y%m%d}` VALUES LESS THAN "
+          "(UNIX_TIMESTAMP('{:%Y-%m-%d} 00:00:00'))".format(bound, bound))
+
+
+def partition_sql(today, months):
+  """DDL partitioning share_knock by month of create_time.
+
+  MySQL requires the partitioning column in every unique key, so the
+  primary key gains create_time and share_session loses its unique key,
+  set SHARE_KNOCK_PARTITIONED=1 before running it so sessions are no
+  longer written with ON DUPLICATE KEY. History older than this month
+  lands in the first partition.
+  """
+  bounds = [date(today.year, today.month, 1)] + _month_bounds(today, months)
+  return [
+      'ALTER TABLE `share_knock` '
+      'DROP PRIMARY KEY, ADD PRIMARY KEY (`id`, `create_time`), '
+      'DROP INDEX `ux_share_knock_share_session`, '
+      'ADD KEY `ix_share_knock_share_session` (`share_session`);',
+      'ALTER TABLE `share_knock` '
+      'PARTITION BY RANGE (UNIX_TIMESTAMP(`create_time`)) ({}, '
+      'PARTITION `pmax` VALUES LESS THAN MAXVALUE);'.format(
+          ', '.join(_partition(i) for i in bounds)),
+  ]
+
+
+def partition_bounds(conn):
+  """Upper bounds of share_knock's month partitions, oldest first."""
+  rows = conn.execute(text(
+      'SELECT PARTITION_NAME FROM information_schema.PARTITIONS '
+      "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'share_knock' "
+      'ORDER BY PARTITION_ORDINAL_POSITION'))
+  bounds = []
+  for (name,) in rows:
+    match = PARTITION_NAME.match(name or '')
+    if match:
+      bounds.append(datetime.strptime(match.group(1), '%Y%m%d').date())
+  return bounds
+
+
+def _fold_before(engine, bound):
+  """Fold every day before `bound` that still has rows, a day per statement."""
+  table = share_knock_table.table
+  with engine.connect() as conn:
+    oldest = conn.execute(
+        select(func.min(table.c.create_time))
+        .where(table.c.create_time < datetime.combine(bound, datetime.min.time()))
+    ).scalar()
+  if oldest is None:
+    return 0
+  day, days = oldest.date(), 0
+  while day < bound:
+    with engine.begin() as conn:
+      conn.execute(fold_sql(conn, and_(_day_range(day),
+                                       table.c.wish_id.isnot(None))))
+    day += timedelta(days=1)
+    days += 1
+  return days
+
+
+def rotate(engine, before, months):
+  """Drop the partitions ending before `before`, add `months` ahead.
+
+  Returns (partitions dropped, partitions added).
+  """
+  with engine.connect() as conn:
+    bounds = partition_bounds(conn)
+  if not bounds:
+    raise RuntimeError('share_knock is not partitioned')
+  dropped = 0
+  for bound in bounds:
+    if bound > before.date():
+      break
+    # dropping is not transactional, a failed run folds the partition again
+    _fold_before(engine, bound)
+    with engine.connect() as conn:
+      conn.execute(text(
+          'ALTER TABLE `share_knock` DROP PARTITION `p{:%Y%m%d}`'.format(bound)))
+    dropped += 1
+  added = [i for i in _month_bounds(date.today(), months) if i > bounds[-1]]
+  if added:
+    with engine.connect() as conn:
+      conn.execute(text(
+          'ALTER TABLE `share_knock` REORGANIZE PARTITION `pmax` INTO '
+          '({}, PARTITION `pmax` VALUES LESS THAN MAXVALUE)'.format(
+              ', '.join(_partition(i) for i in added))))
+  return dropped, len(added)
+
+
+@bp.cli.command('share-knock-compact')
+@click.option('--days', type=int, default=config.SHARE_KNOCK_RETENTION_DAYS,
+              help='keep rows of the last N days')
+@click.option('--batch', type=int, default=config.SHARE_KNOCK_COMPACT_BATCH)
+@click.option('--max-batches', type=int, default=None)
+@click.option('--pause', type=float, default=0.,
+              help='seconds to sleep between batches')
+@click.option('--months', type=int, default=3,
+              help='partitions to keep ahead when partitioned')
+def compact_command(days, batch, max_batches, pause, months):
+  """Fold expired share_knock rows into share_knock_daily and remove them."""
+  try:
+    before = horizon(db.engine, days)
+  except ValueError as e:
+    raise click.BadParameter(str(e), param_hint='--days')
+  if config.SHARE_KNOCK_PARTITIONED:
+    dropped, added = rotate(db.engine, before, months)
+    click.echo('dropped {} partitions, added {}'.format(dropped, added))
+    return
+  buckets, rows = compact(db.engine, before, batch, pause, max_batches)
+  click.echo('folded {} buckets, deleted {} rows'.format(buckets, rows))
+
+
+@bp.cli.command('share-knock-partition-sql')
+@click.option('--months', type=int, default=3,
+              help='monthly partitions to create ahead')
+def partition_sql_command(months):
+  """Print the DDL partitioning share_knock by month."""
+  for sql in partition_sql(date.today(), months):
+    click.echo(sql)
@@ -0,0 +1,368 @@
+import click
+from flask import Blueprint, current_app
+from sqlalchemy import event, select, text
+
+from wxcloudrun import db
+from wxcloudrun.tables import share_knock as share_knock_table
+from wxcloudrun.tables import share_knock_daily as share_knock_daily_table
+from wxcloudrun.tables import wish as wish_table
+from wxcloudrun.tables import wish_daily as wish_daily_table
+from wxcloudrun.tables import wish_gram as wish_gram_table
+from wxcloudrun.tables import wish_score as wish_score_table
+from wxcloudrun.tables import wish_share as wish_share_table
+from wxcloudrun.tables import wish_share_slot as wish_share_slot_table
+
+bp = Blueprint('schema', __name__, cli_group=None)
+
+TABLES = (wish_table.table,
+          wish_share_table.table,
+          share_knock_table.table,
+          share_knock_daily_table.table,
+          wish_score_table.table,
+          wish_daily_table.table,
+          wish_share_slot_table.table,
+          wish_gram_table.table)
+
+# (version, description, statements), append only
+MIGRATIONS = (
+    (1, 'wish tables', (
+        'CREATE TABLE IF NOT EXISTS `wish` ('
+        '`id` int(11) NOT NULL AUTO_INCREMENT, '
+        '`create_time` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP, '
+        '`update_time` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP '
+        'ON UPDATE CURRENT_TIMESTAMP, '
+        '`last_time` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP, '
+        '`openid` varchar(64) DEFAULT NULL, '
+        '`count` int(11) NOT NULL DEFAULT 0, '
+        '`knock` int(11) NOT NULL DEFAULT 0, '
+        '`fulfill` tinyint(1) NOT NULL DEFAULT 0, '
+        '`wish` varchar(128) DEFAULT NULL, '
+        '`helper_total` int(11) NOT NULL DEFAULT 0, '
+        '`share_count_total` int(11) NOT NULL DEFAULT 0, '
+        '`share_knock_total` int(11) NOT NULL DEFAULT 0, '
+        '`helper` int(11) NOT NULL DEFAULT 0, '
+        '`share_count` int(11) NOT NULL DEFAULT 0, '
+        '`share_knock` int(11) NOT NULL DEFAULT 0, '
+        'PRIMARY KEY (`id`), '
+        'KEY `ix_wish_helper` (`helper`)'
+        ') ENGINE = InnoDB DEFAULT CHARSET = utf8mb4;',
+        'CREATE TABLE IF NOT EXISTS `wish_share` ('
+        '`id` int(11) NOT NULL AUTO_INCREMENT, '
+        '`share_id` varchar(64) NOT NULL, '
+        '`wish_id` int(11) NOT NULL, '
+        '`create_time` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP, '
+        '`share_content` tinyint(1) NOT NULL, '
+        '`wish` varchar(128) DEFAULT NULL, '
+        'PRIMARY KEY (`id`), '
+        'UNIQUE KEY `ux_wish_share_share_id` (`share_id`), '
+        'KEY `ix_wish_share_wish_id` (`wish_id`)'
+        ') ENGINE = InnoDB DEFAULT CHARSET = utf8mb4;',
+        'CREATE TABLE IF NOT EXISTS `share_knock` ('
+        '`id` int(11) NOT NULL AUTO_INCREMENT, '
+        '`wish_id` int(11) DEFAULT NULL, '
+        '`share_session` varchar(32) DEFAULT NULL, '
+        '`create_time` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP, '
+        '`openid` varchar(64) NOT NULL, '
+        '`count` int(11) NOT NULL DEFAULT 0, '
+        '`knock` int(11) NOT NULL DEFAULT 0, '
+        'PRIMARY KEY (`id`), '
+        'KEY `ix_share_knock_create_time` (`create_time`)'
+        ') ENGINE = InnoDB DEFAULT CHARSET = utf8mb4;',
+    )),
+    (2, 'share_knock daily rollup', (
+        'CREATE TABLE IF NOT EXISTS `share_knock_daily` ('
+        '`wish_id` int(11) NOT NULL, '
+        '`day` date NOT NULL, '
+        '`helper` int(11) NOT NULL DEFAULT 0, '
+        '`count` int(11) NOT NULL DEFAULT 0, '
+        '`knock` int(11) NOT NULL DEFAULT 0, '
+        'PRIMARY KEY (`wish_id`, `day`)'
+        ') ENGINE = InnoDB DEFAULT CHARSET = utf8mb4;',
+    )),
+    (3, 'unique share_session', (
+        'ALTER TABLE `share_knock` '
+        'ADD UNIQUE KEY `ux_share_knock_share_session` (`share_session`);',
+    )),
+    (4, 'composite indexes for wish_list and share stats', (
+        'ALTER TABLE `wish` '
+        'ADD KEY `ix_wish_openid_fulfill_id` (`openid`, `fulfill`, `id`), '
+        'ADD KEY `ix_wish_openid_fulfill_last_time` '
+        '(`openid`, `fulfill`, `last_time`);',
+        'ALTER TABLE `share_knock` '
+        'ADD KEY `ix_share_knock_wish_id_create_time` '
+        '(`wish_id`, `create_time`);',
+    )),
+    (5, 'wish_score leaderboards', (
+        'CREATE TABLE IF NOT EXISTS `wish_score` ('
+        '`board` varchar(16) NOT NULL, '
+        '`wish_id` int(11) NOT NULL, '
+        '`openid` varchar(64) NOT NULL, '
+        '`score` int(11) NOT NULL DEFAULT 0, '
+        'PRIMARY KEY (`board`, `wish_id`), '
+        'KEY `ix_wish_score_board_score` (`board`, `score`), '
+        'KEY `ix_wish_score_openid_board_score` (`openid`, `board`, `score`)'
+        ') ENGINE = InnoDB DEFAULT CHARSET = utf8mb4;',
+        'INSERT INTO `wish_score` (`board`, `wish_id`, `openid`, `score`) '
+        "SELECT 'knock', `id`, COALESCE(`openid`, ''), `knock` FROM `wish` "
+        'UNION ALL '
+        "SELECT 'count', `id`, COALESCE(`openid`, ''), `count` FROM `wish` "
+        'UNION ALL '
+        "SELECT 'helped', `id`, COALESCE(`openid`, ''), "
+        '`helper_total` + `helper` FROM `wish` '
+        'ON DUPLICATE KEY UPDATE `score` = VALUES(`score`);',
+    )),
+    (6, 'wish_daily knock history', (
+        'CREATE TABLE IF NOT EXISTS `wish_daily` ('
+        '`wish_id` int(11) NOT NULL, '
+        '`day` date NOT NULL, '
+        '`count` int(11) NOT NULL DEFAULT 0, '
+        '`knock` int(11) NOT NULL DEFAULT 0, '
+        'PRIMARY KEY (`wish_id`, `day`)'
+        ') ENGINE = InnoDB DEFAULT CHARSET = utf8mb4;',
+    )),
+    (7, 'wish_share_slot helper counter slots', (
+        'CREATE TABLE IF NOT EXISTS `wish_share_slot` ('
+        '`wish_id` int(11) NOT NULL, '
+        '`slot` int(11) NOT NULL, '
+        '`helper` int(11) NOT NULL DEFAULT 0, '
+        '`share_count` int(11) NOT NULL DEFAULT 0, '
+        '`share_knock` int(11) NOT NULL DEFAULT 0, '
+        'PRIMARY KEY (`wish_id`, `slot`)'
+        ') ENGINE = InnoDB DEFAULT CHARSET = utf8mb4;',
+    )),
+    # grams compare byte for byte, 'a' and 'A' or 'e' and 'é' are distinct
+    # keys; fill with `flask wish-search-rebuild`
+    (8, 'wish_gram search index', (
+        'CREATE TABLE IF NOT EXISTS `wish_gram` ('
+        '`openid` varchar(64) NOT NULL, '
+        '`gram` varchar(2) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL, '
+        '`wish_id` int(11) NOT NULL, '
+        'PRIMARY KEY (`openid`, `gram`, `wish_id`), '
+        'KEY `ix_wish_gram_wish_id` (`wish_id`)'
+        ') ENGINE = InnoDB DEFAULT CHARSET = utf8mb4;',
+    )),
+)
+
+VERSION_TABLE_SQL = (
+    'CREATE TABLE IF NOT EXISTS `schema_version` ('
+    '`version` int(11) NOT NULL, '
+    '`description` varchar(128) DEFAULT NULL, '
+    '`applied_time` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP, '
+    'PRIMARY KEY (`version`)'
+    ') ENGINE = InnoDB DEFAULT CHARSET = utf8mb4;'
+)
+
+SCHEMA_LOCK = 'wooden_fish_schema'
+CHECK_OPENID = 'schema-check'
+
+
+def current_version(conn):
+  conn.execute(text(VERSION_TABLE_SQL))
+  return conn.execute(
+      text('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+  ).scalar()
+
+
+def upgrade(engine, target=None):
+  """Apply pending migrations, returns the versions applied.
+
+  Non-MySQL databases (local tests) get the tables created straight
+  from the Table definitions instead.
+  """
+  if engine.dialect.name != 'mysql':
+    for table in TABLES:
+      table.create(engine, checkfirst=True)
+    return []
+
+  applied = []
+  with engine.connect() as conn:
+    # several containers may start at the same time
+    if not conn.execute(text('SELECT GET_LOCK(:n, 60)'),
+                        {'n': SCHEMA_LOCK}).scalar():
+      raise RuntimeError('schema lock timeout')
+    try:
+      version = current_version(conn)
+      for v, description, statements in MIGRATIONS:
+        if v <= version or (target is not None and v > target):
+          continue
+        for sql in statements:
+          conn.execute(text(sql))
+        conn.execute(
+            text('INSERT INTO schema_version (version, description) '
+                 'VALUES (:v, :d)'),
+            {'v': v, 'd': description})
+        applied.append(v)
+    finally:
+      conn.execute(text('SELECT RELEASE_LOCK(:n)'), {'n': SCHEMA_LOCK})
+  return applied
+
+
+def _run_scenario(client, openid):
+  headers = {'X-WX-OPENID': openid}
+
+  def post(path, data):
+    res = client.post('/api/wooden_fish/' + path, json=data, headers=headers)
+    if res.status_code != 200 or res.json['code'] != 0:
+      raise RuntimeError('{} failed: {}'.format(path, res.get_data(True)))
+    return res.json['data']
+
+  wish_id = post('wish', {'wish': 'schema check'})['id']
+  post('wish_bulk_create', {'wishes': ['schema check a', 'schema check b']})
+  post('wish_update', {'wish_id': wish_id, 'count': 1, 'knock': 10})
+  post('wish_update_batch', {'updates': [{'wish_id': wish_id, 'knock': 1}]})
+  for mode in ('list', 'last'):
+    post('wish_list', {'mode': mode})
+  share_id = post('wish_share_create',
+                  {'wish_id': wish_id, 'share_content': True})['share_id']
+  post('wish_share_enter', {'share_id': share_id})
+  share_session = post('wish_share_update',
+                       {'share_id': share_id, 'knock': 5})['share_session']
+  post('wish_share_update',
+       {'share_id': share_id, 'share_session': share_session, 'knock': 5})
+  post('wish_share_stats', {'wish_id': wish_id})
+  post('wish_search', {'query': 'check'})
+  # a pair ending in a space must not collide with its first character
+  post('wish_search', {'query': 'a c'})
+  post('wish_search', {'query': 'k', 'fulfill': False})
+  post('dashboard', {'mode': 'list'})
+  post('dashboard', {'mode': 'last'})
+  for board in ('knock', 'count', 'helped'):
+    post('leaderboard', {'board': board})
+    post('leaderboard', {'board': board, 'scope': 'user'})
+    post('wish_rank', {'wish_id': wish_id, 'board': board})
+  post('wish_history', {'wish_id': wish_id, 'start': '2000-01-01',
+                        'end': '2000-12-31'})
+  export = client.post('/api/wooden_fish/export', json={}, headers=headers)
+  if not export.get_data(True).endswith('{"type": "end"}\n'):
+    raise RuntimeError('export failed: {}'.format(export.get_data(True)))
+  post('wish_update', {'wish_id': wish_id, 'gather_shared': True})
+  post('wish_update', {'wish_id': wish_id, 'wish': 'schema check edit'})
+  post('wish_update', {'wish_id': wish_id, 'clear_record': True})
+  post('wish_update', {'wish_id': wish_id, 'fulfill': True})
+  post('wish_list', {'mode': 'list', 'fulfill': True})
+
+
+def _cleanup(engine, openid):
+  with engine.begin() as conn:
+    ids = [i[0] for i in conn.execute(
+        select(wish_table.table.c.id)
+        .where(wish_table.table.c.openid == openid))]
+    if not ids:
+      return
+    for table in (wish_daily_table.table,
+                  wish_gram_table.table,
+                  wish_share_slot_table.table,
+                  wish_score_table.table,
+                  share_knock_daily_table.table,
+                  share_knock_table.table,
+                  wish_share_table.table):
+      conn.execute(table.delete().where(table.c.wish_id.in_(ids)))
+    conn.execute(wish_table.table.delete()
+                 .where(wish_table.table.c.openid == openid))
+
+
+def capture_view_queries(openid=CHECK_OPENID):
+  """Drive every wooden_fish endpoint once and return the SQL emitted.
+
+  Returns {statement: parameters}, rows written are removed afterwards.
+  """
+  engine = db.engine
+  statements = {}
+
+  def record(conn, cursor, statement, parameters, context, executemany):
+    statements.setdefault(statement, parameters)
+
+  event.listen(engine, 'before_cursor_execute', record)
+  try:
+    _run_scenario(current_app.test_client(), openid)
+  finally:
+    event.remove(engine, 'before_cursor_execute', record)
+    _cleanup(engine, openid)
+  return statements
+
+
+def explain_full_scans(engine, statement, parameters):
+  """Return the plan rows of `statement` that read a whole table."""
+  verb = statement.lstrip().split(None, 1)[0].upper()
+  if verb not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE'):
+    return []
+  with engine.connect() as conn:
+    if engine.dialect.name == 'mysql':
+      rows = conn.exec_driver_sql('EXPLAIN ' + statement, parameters)
+      # reading a derived table is bounded by its own (checked) plan
+      return [dict(i._mapping) for i in rows
+              if i.type in ('ALL', 'index') and
+              i.select_type not in ('INSERT', 'REPLACE') and
+              not (i.table or '').startswith('<derived')]
+    rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement,
+                                parameters).fetchall()
+    derived = {i.detail.split()[-1] for i in rows
+               if i.detail.startswith(('CO-ROUTINE', 'MATERIALIZE'))}
+    return [dict(i._mapping) for i in rows
+            if i.detail.startswith('SCAN') and
+            'CONSTANT ROW' not in i.detail and
+            i.detail.split()[1] not in derived]
+
+
+@bp.cli.command('schema-upgrade')
+@click.option('--target', type=int, default=None)
+def upgrade_command(target):
+  applied = upgrade(db.engine, target)
+  click.echo('applied {}'.format(applied) if applied else 'up to date')
+
+
+def _unless_applied(version, sql):
+  """Statements running `sql` only while `version` is not recorded.
+
+  MySQL has no ADD KEY IF NOT EXISTS, the statement is prepared from a
+  string picked by the version check instead.
+  """
+  return [
+      "SET @migration = IF((SELECT COUNT(*) FROM `schema_version` "
+      "WHERE `version` = {}) = 0, '{}', 'DO 0');".format(
+          version, sql.rstrip(';').replace("'", "''")),
+      'PREPARE migration FROM @migration;',
+      'EXECUTE migration;',
+      'DEALLOCATE PREPARE migration;',
+  ]
+
+
+def migration_sqls():
+  """upgrade() as plain SQL statements, safe to run again."""
+  res = [VERSION_TABLE_SQL]
+  for v, description, statements in MIGRATIONS:
+    for sql in statements:
+      if sql.startswith('CREATE TABLE IF NOT EXISTS'):
+        res.append(sql)
+      else:
+        res.extend(_unless_applied(v, sql))
+    res.append("INSERT IGNORE INTO `schema_version` (`version`, `description`) "
+               "VALUES ({}, '{}');".format(v, description))
+  return res
+
+
+@bp.cli.command('schema-sql')
+def sql_command():
+  """Print the DDL of all migrations, e.g. for executeSQLs."""
+  for sql in migration_sqls():
+    click.echo(sql)
+
+
+@bp.cli.command('schema-check')
+def check_command():
+  """EXPLAIN every query the views emit, fail on full scans.
+
+  Run against a database holding representative data, the optimizer
+  may prefer a scan on near empty tables.
+  """
+  engine = db.engine
+  failed = 0
+  for statement, parameters in capture_view_queries().items():
+    scans = explain_full_scans(engine, statement, parameters)
+    click.echo('{} {}'.format('SCAN' if scans else 'ok  ',
+                              ' '.join(statement.split())[:160]))
+    for row in scans:
+      click.echo('     {}'.format(row))
+    failed += bool(scans)
+  if failed:
+    raise click.ClickException('{} queries do a full scan'.format(failed))
@@ -0,0 +1,131 @@
+"""Substring search over a user's wishes.
+
+wish_gram holds every character and every pair of adjacent characters
+but those holding whitespace of a wish's lowercased text, keyed by
+(openid, gram, wish_id). It is written in the transaction creating or
+editing the wish. A search walks
+the user's index range of one gram of the query in wish id order,
+probes the others and confirms the substring with LIKE on the wish
+row, so a page costs the candidates examined to fill it, not the
+number of wishes the user has.
+"""
+import click
+from flask import Blueprint
+from sqlalchemy import and_, exists, func, select
+
+from wxcloudrun import db
+from wxcloudrun.tables import wish as wish_table
+from wxcloudrun.tables import wish_gram as gram_table
+
+bp = Blueprint('search', __name__, cli_group=None)
+
+
+def _pairs(text):
+  # utf8mb4_bin pads with spaces, 'a ' would collide with the gram 'a',
+  # the LIKE on the wish row still checks whitespace
+  res = []
+  for i in range(len(text) - 1):
+    pair = text[i:i + 2]
+    if not any(c.isspace() for c in pair):
+      res.append(pair)
+  return res
+
+
+def grams(text):
+  """The characters and adjacent pairs of `text`, lowercased.
+
+  Pairs holding whitespace are left out.
+  """
+  text = (text or '').lower()
+  res = set(text)
+  res.update(_pairs(text))
+  return res
+
+
+def query_grams(query):
+  """Grams every wish containing `query` has, in query order."""
+  query = query.lower()
+  res = []
+  for gram in (_pairs(query) or
+               [c for c in query if not c.isspace()] or
+               [query[0]]):
+    if gram not in res:
+      res.append(gram)
+  return res
+
+
+def index_sql(openid, wishes):
+  """Insert the grams of [(wish_id, text)], None when there are none."""
+  values = [{'openid': openid, 'gram': gram, 'wish_id': wish_id}
+            for wish_id, text in wishes
+            for gram in sorted(grams(text))]
+  if not values:
+    return
+  return gram_table.table.insert().values(values)
+
+
+def unindex_sql(wish_ids):
+  table = gram_table.table
+  return table.delete().where(table.c.wish_id.in_(list(wish_ids)))
+
+
+def reindex_sqls(openid, wish_id, text):
+  """Statements replacing the grams of an edited wish."""
+  res = [unindex_sql([wish_id])]
+  sql = index_sql(openid, [(wish_id, text)])
+  if sql is not None:
+    res.append(sql)
+  return res
+
+
+def search_sql(columns, openid, query, last_id, page_num, fulfill=None):
+  """`columns` of the wishes containing `query` after `last_id`."""
+  wish = wish_table.table
+  table = gram_table.table
+  first, *rest = query_grams(query)
+  sql = (
+      select(*columns)
+      .select_from(table.join(wish, wish.c.id == table.c.wish_id))
+      .where(and_(table.c.openid == openid,
+                  table.c.gram == first,
+                  table.c.wish_id > last_id,
+                  wish.c.wish.contains(query, autoescape=True)))
+  )
+  for gram in rest:
+    other = table.alias()
+    sql = sql.where(exists().where(and_(other.c.openid == openid,
+                                        other.c.gram == gram,
+                                        other.c.wish_id == table.c.wish_id)))
+  if fulfill is not None:
+    sql = sql.where(wish.c.fulfill == fulfill)
+  return sql.order_by(table.c.wish_id).limit(page_num)
+
+
+def rebuild(bind, batch=500):
+  """Rebuild wish_gram in id ranges of `batch` wishes, returns rows."""
+  wish = wish_table.table
+  table = gram_table.table
+  max_id = bind.execute(select(func.max(wish.c.id))).scalar() or 0
+  rows = 0
+  for start in range(0, max_id + 1, batch):
+    with bind.begin() as conn:
+      conn.execute(table.delete().where(
+          and_(table.c.wish_id >= start, table.c.wish_id < start + batch)))
+      owners = {}
+      for wish_id, openid, text in conn.execute(
+          select(wish.c.id, wish.c.openid, wish.c.wish).where(
+              and_(wish.c.id >= start, wish.c.id < start + batch,
+                   wish.c.openid.isnot(None)))):
+        owners.setdefault(openid, []).append((wish_id, text))
+      for openid, wishes in owners.items():
+        sql = index_sql(openid, wishes)
+        if sql is not None:
+          rows += conn.execute(sql).rowcount
+  return rows
+
+
+@bp.cli.command('wish-search-rebuild')
+@click.option('--batch', type=int, default=500)
+def rebuild_command(batch):
+  """Recompute wish_gram from the wish table."""
+  click.echo('{} rows'.format(rebuild(db.engine, batch)))
@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from wxcloudrun.local_store import LocalStore
+
+
+class ShareCache(object):
+  """LRU + TTL cache for share/wish resolution.
+
+  Loaders return None for rows that do not exist, those are kept as
+  negative entries for `negative_ttl` seconds only. When `store` is set,
+  entries are also read from and written to it so all workers of a
+  container share one warm cache.
+  """
+
+  def __init__(self, size, ttl, negative_ttl, store=None):
+    self.size = size
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.store = store
+    self._lock = threading.Lock()
+    self._data = OrderedDict()
+    self.hits = 0
+    self.negative_hits = 0
+    self.shared_hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def _get_local(self, key):
+    with self._lock:
+      item = self._data.get(key)
+      if item is None:
+        return False, None
+      value, expires = item
+      if expires < time.time():
+        del self._data[key]
+        self.expirations += 1
+        return False, None
+      self._data.move_to_end(key)
+      if value is None:
+        self.negative_hits += 1
+      else:
+        self.hits += 1
+      return True, value
+
+  def _set_local(self, key, value, expires):
+    with self._lock:
+      self._data[key] = (value, expires)
+      self._data.move_to_end(key)
+      while len(self._data) > self.size:
+        self._data.popitem(last=False)
+        self.evictions += 1
+
+  def lookup(self, key):
+    """Return (found, value), value None being a cached miss."""
+    found, value = self._get_local(key)
+    if found:
+      return True, value
+    if self.store is not None:
+      item = self.store.get(key)
+      if item is not None:
+        value, expires = item
+        with self._lock:
+          self.shared_hits += 1
+        self._set_local(key, value, expires)
+        return True, value
+    with self._lock:
+      self.misses += 1
+    return False, None
+
+  def put(self, key, value):
+    ttl = self.ttl if value is not None else self.negative_ttl
+    self._set_local(key, value, time.time() + ttl)
+    if self.store is not None:
+      pruned = self.store.set(key, value, ttl)
+      if pruned:
+        with self._lock:
+          self.evictions += pruned
+
+  def get(self, key, loader):
+    found, value = self.lookup(key)
+    if not found:
+      value = loader()
+      self.put(key, value)
+    return value
+
+  def invalidate(self, *keys):
+    with self._lock:
+      for key in keys:
+        self._data.pop(key, None)
+    if self.store is not None:
+      self.store.delete(*keys)
+
+  def stats(self):
+    with self._lock:
+      return {'size': len(self._data),
+              'hits': self.hits,
+              'negative_hits': self.negative_hits,
+              'shared_hits': self.shared_hits,
+              'misses': self.misses,
+              'evictions': self.evictions,
+              'expirations': self.expirations}
+
+
+share_cache = ShareCache(
+    config.SHARE_CACHE_SIZE,
+    config.SHARE_CACHE_TTL,
+    config.SHARE_CACHE_NEGATIVE_TTL,
+    store=(LocalStore(config.SHARE_CACHE_PATH,
+                      max_rows=config.SHARE_CACHE_SHARED_SIZE)
+           if config.SHARE_CACHE_PATH else None)
+)
+
+
+def share_key(share_id):
+  return 'share:{}'.format(share_id)
+
+
+def owner_key(wish_id):
+  return 'owner:{}'.format(wish_id)
+
+
+def invalidate_share(share_id):
+  share_cache.invalidate(share_key(share_id))
+
+
+def invalidate_wish(wish_id):
+  share_cache.invalidate(owner_key(wish_id))
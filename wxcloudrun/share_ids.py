@@ -0,0 +1,83 @@
+"""Signed share ids, resolved without reading the database.
+
+    S1 + base64url(wish_id, share row id, flags, owner tag, mac)
+
+The mac is an HMAC-SHA256 of the rest keyed with SHARE_ID_SECRET, the
+owner tag one of the owner's openid, so wish_share_enter can tell the
+owner apart without the openid showing in the id. The first secret
+signs, all of them verify, so a secret can be rotated. Without a secret
+shares get legacy 'SH' ids. An id that does not verify, legacy ids
+included, is looked up in wish_share as before.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import struct
+from collections import namedtuple
+
+import config
+
+PREFIX = 'S1'
+# wish_id, share row id, flags
+_PAYLOAD = struct.Struct('>IIB')
+_SHARE_CONTENT = 1
+OWNER_BYTES = 6
+MAC_BYTES = 12
+_SIZE = _PAYLOAD.size + OWNER_BYTES + MAC_BYTES
+
+SignedShare = namedtuple('SignedShare',
+                         'wish_id row_id share_content owner_tag key')
+
+_keys = [k.encode() for k in config.SHARE_ID_SECRET.split(',') if k]
+
+
+def enabled():
+  return bool(_keys)
+
+
+def _mac(key, data):
+  return hmac.new(key, PREFIX.encode() + data,
+                  hashlib.sha256).digest()[:MAC_BYTES]
+
+
+def _owner_tag(key, openid):
+  return hmac.new(key, b'owner:' + openid.encode(),
+                  hashlib.sha256).digest()[:OWNER_BYTES]
+
+
+def sign(wish_id, row_id, share_content, openid):
+  key = _keys[0]
+  data = (_PAYLOAD.pack(wish_id, row_id,
+                        _SHARE_CONTENT if share_content else 0) +
+          _owner_tag(key, openid))
+  return PREFIX + base64.urlsafe_b64encode(
+      data + _mac(key, data)).decode().rstrip('=')
+
+
+def decode(share_id):
+  """The SignedShare of a verified `share_id`, else None."""
+  if not _keys or not share_id.startswith(PREFIX):
+    return None
+  token = share_id[len(PREFIX):]
+  try:
+    raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+  except (binascii.Error, ValueError):
+    return None
+  # the decoder skips stray characters, only the canonical spelling counts
+  if (len(raw) != _SIZE or
+      base64.urlsafe_b64encode(raw).decode().rstrip('=') != token):
+    return None
+  data, mac = raw[:-MAC_BYTES], raw[-MAC_BYTES:]
+  for key in _keys:
+    if hmac.compare_digest(mac, _mac(key, data)):
+      wish_id, row_id, flags = _PAYLOAD.unpack(data[:_PAYLOAD.size])
+      return SignedShare(wish_id, row_id, bool(flags & _SHARE_CONTENT),
+                         data[_PAYLOAD.size:], key)
+  return None
+
+
+def owned_by(share, openid):
+  """Whether `openid` created the wish of SignedShare `share`."""
+  return (openid is not None and
+          hmac.compare_digest(share.owner_tag, _owner_tag(share.key, openid)))
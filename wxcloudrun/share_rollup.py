@@ -0,0 +1,159 @@
+import click
+from flask import Blueprint
+from sqlalchemy import and_, func, literal, select
+
+from wxcloudrun import db
+from wxcloudrun.days_ago import days_ago
+from wxcloudrun.tables import share_knock as share_knock_table
+from wxcloudrun.tables import share_knock_daily as daily_table
+from wxcloudrun.upsert import upsert
+
+# today plus the 7 days before it
+ROLLUP_WINDOW_DAYS = 7
+
+bp = Blueprint('share_rollup', __name__, cli_group=None)
+
+
+def _add(new):
+  table = daily_table.table
+  return {'helper': table.c.helper + new.helper,
+          'count': table.c.count + new.count,
+          'knock': table.c.knock + new.knock}
+
+
+def _replace(new):
+  return {'helper': new.helper,
+          'count': new.count,
+          'knock': new.knock}
+
+
+def rollup_session_sql(bind, share_session, count, knock, helper=0):
+  """Add to the bucket of the day `share_session` was created on."""
+  helper_table = share_knock_table.table
+  sql = select(
+      helper_table.c.wish_id.label('wish_id'),
+      func.date(helper_table.c.create_time).label('day'),
+      literal(helper).label('helper'),
+      literal(count or 0).label('count'),
+      literal(knock or 0).label('knock')
+  ).where(helper_table.c.share_session == share_session)
+  return upsert(bind, daily_table.table, sql, _add,
+                index_elements=['wish_id', 'day'])
+
+
+LAST_WEEK_FIELDS = ('last_week_helper', 'last_week_count', 'last_week_knock')
+# what a wish without buckets in the window sums to
+LAST_WEEK_EMPTY = (0, None, None)
+
+
+def _last_week_columns():
+  table = daily_table.table
+  return (func.coalesce(func.sum(table.c.helper), 0).label('last_week_helper'),
+          func.sum(table.c.count).label('last_week_count'),
+          func.sum(table.c.knock).label('last_week_knock'))
+
+
+def _last_week_start():
+  return days_ago(ROLLUP_WINDOW_DAYS)
+
+
+def last_week_sql(wish_id):
+  table = daily_table.table
+  return select(*_last_week_columns()).where(
+      and_(table.c.wish_id == wish_id,
+           table.c.day >= _last_week_start()))
+
+
+def last_week_by_wish_sql(wish_ids):
+  """last_week_sql() of several wishes in one grouped query."""
+  table = daily_table.table
+  return select(table.c.wish_id, *_last_week_columns()).where(
+      and_(table.c.wish_id.in_(list(wish_ids)),
+           table.c.day >= _last_week_start())
+  ).group_by(table.c.wish_id)
+
+
+def _raw_daily(since=None, wish_id=None):
+  helper_table = share_knock_table.table
+  day = func.date(helper_table.c.create_time)
+  sql = select(
+      helper_table.c.wish_id.label('wish_id'),
+      day.label('day'),
+      func.count(helper_table.c.id).label('helper'),
+      func.coalesce(func.sum(helper_table.c.count), 0).label('count'),
+      func.coalesce(func.sum(helper_table.c.knock), 0).label('knock')
+  ).group_by(helper_table.c.wish_id, day)
+  if since is not None:
+    sql = sql.where(helper_table.c.create_time >= since)
+  if wish_id is not None:
+    sql = sql.where(helper_table.c.wish_id == wish_id)
+  return sql
+
+
+def fold_sql(bind, where):
+  """Replace the buckets of the share_knock rows matching `where`.
+
+  Every row of a bucket's wish and day must match, or none.
+  """
+  return upsert(bind, daily_table.table, _raw_daily().where(where), _replace,
+                index_elements=['wish_id', 'day'])
+
+
+def backfill(bind, since=None, wish_id=None):
+  """Rebuild buckets from share_knock history, returns affected rows."""
+  sql = _raw_daily(since, wish_id)
+  return bind.execute(upsert(bind, daily_table.table, sql, _replace,
+                             index_elements=['wish_id', 'day'])).rowcount
+
+
+def check(bind, since=None, wish_id=None):
+  """Compare buckets with the raw aggregate.
+
+  Returns a list of (wish_id, day, rollup, raw) for every bucket that
+  differs, rollup and raw being (helper, count, knock) or None.
+  """
+  table = daily_table.table
+  raw = {(i.wish_id, str(i.day)): (i.helper, i.count, i.knock)
+         for i in bind.execute(_raw_daily(since, wish_id))}
+  sql = select(table.c.wish_id, table.c.day,
+               table.c.helper, table.c.count, table.c.knock)
+  if since is not None:
+    sql = sql.where(table.c.day >= since)
+  if wish_id is not None:
+    sql = sql.where(table.c.wish_id == wish_id)
+  rollup = {(i.wish_id, str(i.day)): (i.helper, i.count, i.knock)
+            for i in bind.execute(sql)}
+  diff = []
+  for key in sorted(set(raw) | set(rollup)):
+    if raw.get(key) != rollup.get(key):
+      diff.append(key + (rollup.get(key), raw.get(key)))
+  return diff
+
+
+def _since(days):
+  if days is None:
+    return None
+  return days_ago(days)
+
+
+@bp.cli.command('share-rollup-backfill')
+@click.option('--days', type=int, default=None,
+              help='only rebuild the last N days, default all history')
+@click.option('--wish-id', type=int, default=None)
+def backfill_command(days, wish_id):
+  with db.engine.begin() as conn:
+    rows = backfill(conn, _since(days), wish_id)
+  click.echo('rebuilt {} buckets'.format(rows))
+
+
+@bp.cli.command('share-rollup-check')
+@click.option('--days', type=int, default=ROLLUP_WINDOW_DAYS)
+@click.option('--wish-id', type=int, default=None)
+def check_command(days, wish_id):
+  diff = check(db.engine, _since(days), wish_id)
+  for wish_id, day, rollup, raw in diff:
+    click.echo('wish {} day {}: rollup={} raw={}'.format(wish_id, day,
+                                                         rollup, raw))
+  if diff:
+    raise click.ClickException('{} buckets differ'.format(len(diff)))
+  click.echo('ok')
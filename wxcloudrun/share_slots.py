@@ -0,0 +1,227 @@
+"""Sharded helper counters of hot shared wishes.
+
+Every helper of a shared wish adds to the wish row's helper /
+share_count / share_knock, so a wish shared widely has all its helpers
+waiting on that one row lock. When the update of a wish row takes
+SHARE_SLOT_LOCK_WAIT seconds or more the wish is promoted for
+SHARE_SLOT_PROMOTE_SECONDS: its helpers add to one of
+SHARE_COUNTER_SLOTS rows of wish_share_slot picked at random instead.
+
+Readers add a wish's slots to its row with total(). fold() moves the
+slots into the wish row, gather_shared does so before collecting and
+`flask share-slots-fold` for every wish having slots.
+"""
+import random
+import threading
+import time
+
+import click
+from flask import Blueprint
+from sqlalchemy import case, func, select, tuple_
+
+import config
+from wxcloudrun import db
+from wxcloudrun.local_store import LocalStore
+from wxcloudrun.tables import wish as wish_table
+from wxcloudrun.tables import wish_share_slot as slot_table
+from wxcloudrun.upsert import upsert
+
+SLOT_COLUMNS = ('helper', 'share_count', 'share_knock')
+
+bp = Blueprint('share_slots', __name__, cli_group=None)
+
+
+def slot_sum(column):
+  """Sum of `column` over the slots of the wish row being selected."""
+  table = slot_table.table
+  return (select(func.coalesce(func.sum(table.c[column]), 0))
+          .where(table.c.wish_id == wish_table.table.c.id)
+          .scalar_subquery())
+
+
+def total(column):
+  """wish.`column` plus its slots, for selects from wish.
+
+  The plain column while slotting is off, run `flask share-slots-fold`
+  before turning it off. Otherwise the slots are only summed for wishes
+  listed in wish_share_slot, which holds nothing but hot wishes not yet
+  folded.
+  """
+  wish = wish_table.table
+  if hot_wishes is None:
+    return wish.c[column]
+  return case((wish.c.id.in_(select(slot_table.table.c.wish_id)),
+               wish.c[column] + slot_sum(column)),
+              else_=wish.c[column])
+
+
+def slot_sql(bind, wish_id, slot, count, knock):
+  """Add a helper's count / knock to slot `slot` of `wish_id`."""
+  table = slot_table.table
+  values = {}
+  if count:
+    values['helper'] = 1
+    values['share_count'] = count
+  if knock:
+    values['share_knock'] = knock
+  if not values:
+    return
+  return upsert(bind, table, dict(values, wish_id=wish_id, slot=slot),
+                lambda new: {k: table.c[k] + new[k] for k in values},
+                index_elements=['wish_id', 'slot'])
+
+
+def locked_slots_sql(wish_ids):
+  """The slots of `wish_ids`, locked until the fold commits."""
+  table = slot_table.table
+  return (select(table.c.wish_id, table.c.slot,
+                 *[table.c[k] for k in SLOT_COLUMNS])
+          .where(table.c.wish_id.in_(list(wish_ids)))
+          .with_for_update())
+
+
+def fold_sqls(rows):
+  """Statements adding locked slot `rows` to their wishes and removing them.
+
+  Only the rows read are removed, a slot inserted since is kept for the
+  next fold.
+  """
+  if not rows:
+    return []
+  sums = {}
+  for row in rows:
+    acc = sums.setdefault(row.wish_id, dict.fromkeys(SLOT_COLUMNS, 0))
+    for k in SLOT_COLUMNS:
+      acc[k] += row._mapping[k]
+  wish = wish_table.table
+  table = slot_table.table
+  res = [wish.update().values(**{k: wish.c[k] + v for k, v in acc.items()})
+         .where(wish.c.id == wish_id)
+         for wish_id, acc in sorted(sums.items())]
+  res.append(table.delete().where(
+      tuple_(table.c.wish_id, table.c.slot).in_(
+          [(i.wish_id, i.slot) for i in rows])))
+  return res
+
+
+def fold(conn, wish_ids):
+  """Fold the slots of `wish_ids` in the caller's transaction.
+
+  Returns the number of slot rows folded.
+  """
+  rows = conn.execute(locked_slots_sql(wish_ids)).fetchall()
+  for sql in fold_sqls(rows):
+    conn.execute(sql)
+  return len(rows)
+
+
+def fold_all(engine, batch=100):
+  """Fold every wish's slots, `batch` wishes per transaction."""
+  table = slot_table.table
+  last = -1
+  rows = 0
+  while True:
+    wish_ids = [i[0] for i in engine.execute(
+        select(table.c.wish_id).distinct()
+        .where(table.c.wish_id > last)
+        .order_by(table.c.wish_id)
+        .limit(batch))]
+    if not wish_ids:
+      return rows
+    with engine.begin() as conn:
+      rows += fold(conn, wish_ids)
+    last = wish_ids[-1]
+
+
+class HotWishes(object):
+  """Wishes whose helpers currently add to slot rows.
+
+  A wish is promoted for `ttl` seconds once updating its row took
+  `lock_wait` seconds, in `store` when set so the promotion holds across
+  the workers of a container. The helped leaderboard row of a hot wish
+  is as contended as the wish row, it is refreshed at most every
+  `refresh_interval` seconds per worker.
+  """
+
+  def __init__(self, slots, lock_wait, ttl, refresh_interval, store=None):
+    self.slots = slots
+    self.lock_wait = lock_wait
+    self.ttl = ttl
+    self.refresh_interval = refresh_interval
+    self.store = store
+    self._lock = threading.Lock()
+    self._hot = {}
+    self._refreshed = {}
+    self.promotions = 0
+    self.slot_writes = 0
+    self.row_writes = 0
+
+  def is_hot(self, wish_id):
+    now = time.time()
+    with self._lock:
+      until = self._hot.get(wish_id)
+      if until is not None and until < now:
+        del self._hot[wish_id]
+        self._refreshed.pop(wish_id, None)
+        until = None
+    if until is not None:
+      return True
+    if self.store is None:
+      return False
+    found = self.store.get('hot:{}'.format(wish_id))
+    if found is None:
+      return False
+    with self._lock:
+      self._hot[wish_id] = found[1]
+    return True
+
+  def observe(self, wish_id, seconds):
+    """Record the time the update of `wish_id`'s row took."""
+    with self._lock:
+      self.row_writes += 1
+      if seconds < self.lock_wait or wish_id in self._hot:
+        return
+      self._hot[wish_id] = time.time() + self.ttl
+      self.promotions += 1
+    if self.store is not None:
+      self.store.set('hot:{}'.format(wish_id), 1, self.ttl)
+
+  def slot(self):
+    with self._lock:
+      self.slot_writes += 1
+    return random.randrange(self.slots)
+
+  def refresh_due(self, wish_id):
+    """Whether to refresh the hot wish's leaderboard row now."""
+    now = time.time()
+    with self._lock:
+      if self._refreshed.get(wish_id, 0) + self.refresh_interval > now:
+        return False
+      self._refreshed[wish_id] = now
+      return True
+
+  def stats(self):
+    with self._lock:
+      return {'hot': len(self._hot),
+              'promotions': self.promotions,
+              'slot_writes': self.slot_writes,
+              'row_writes': self.row_writes}
+
+
+hot_wishes = None
+if config.SHARE_COUNTER_SLOTS > 1:
+  hot_wishes = HotWishes(
+      config.SHARE_COUNTER_SLOTS,
+      config.SHARE_SLOT_LOCK_WAIT,
+      config.SHARE_SLOT_PROMOTE_SECONDS,
+      config.SHARE_SLOT_REFRESH_INTERVAL,
+      store=(LocalStore(config.SHARE_SLOT_PATH)
+             if config.SHARE_SLOT_PATH else None))
+
+
+@bp.cli.command('share-slots-fold')
+@click.option('--batch', type=int, default=100,
+              help='wishes folded per transaction')
+def fold_command(batch):
+  """Move the helper counter slots into the wish rows."""
+  click.echo('folded {} slots'.format(fold_all(db.engine, batch)))
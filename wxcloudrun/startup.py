@@ -0,0 +1,121 @@
+"""Where a cold start spends its time.
+
+Phases are timed from the moment the wxcloudrun package starts to
+import; `flask startup-report` measures a fresh interpreter, including
+the import time of every module (python -X importtime).
+"""
+import time
+
+# taken before the imports below, this module is imported first
+T0 = time.perf_counter()
+
+import os  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+from contextlib import contextmanager  # noqa: E402
+
+import click  # noqa: E402
+import simplejson as json  # noqa: E402
+from flask import Blueprint, current_app  # noqa: E402
+
+bp = Blueprint('startup', __name__, cli_group=None)
+
+_phases = []
+_ready = None
+_first_response = None
+
+
+@contextmanager
+def phase(name):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    _phases.append((name, time.perf_counter() - start))
+
+
+def ready():
+  """Mark the app as created."""
+  global _ready
+  _ready = time.perf_counter() - T0
+
+
+def report():
+  return {'pid': os.getpid(),
+          'phases': [{'name': k, 'seconds': round(v, 4)} for k, v in _phases],
+          'ready_seconds': None if _ready is None else round(_ready, 4),
+          'first_response_seconds': (None if _first_response is None
+                                     else round(_first_response, 4))}
+
+
+@bp.after_app_request
+def _first_response_hook(response):
+  global _first_response
+  if _first_response is None:
+    _first_response = time.perf_counter() - T0
+    current_app.logger.info('startup %s', json.dumps(report()))
+  return response
+
+
+# run in a fresh interpreter so nothing is imported yet
+_COLD_START = '''
+import sys
+import time
+start = time.perf_counter()
+from run import app
+from wxcloudrun import startup
+res = app.test_client().get(sys.argv[1])
+out = startup.report()
+out['status'] = res.status_code
+out['total_seconds'] = round(time.perf_counter() - start, 4)
+import simplejson as json
+print(json.dumps(out))
+'''
+
+
+def parse_importtime(stderr):
+  """Return {module: (self_seconds, cumulative_seconds)}."""
+  res = {}
+  for line in stderr.splitlines():
+    if not line.startswith('import time:'):
+      continue
+    parts = line[len('import time:'):].split('|')
+    if len(parts) != 3 or not parts[0].strip().isdigit():
+      continue
+    res[parts[2].strip()] = (int(parts[0]) / 1e6, int(parts[1]) / 1e6)
+  return res
+
+
+def cold_start(path='/'):
+  """Start a new interpreter, create the app and serve `path` once."""
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  proc = subprocess.run(
+      [sys.executable, '-X', 'importtime', '-c', _COLD_START, path],
+      cwd=root, capture_output=True, text=True)
+  if proc.returncode != 0:
+    raise RuntimeError(proc.stderr[-2000:])
+  res = json.loads(proc.stdout.strip().splitlines()[-1])
+  res['imports'] = parse_importtime(proc.stderr)
+  return res
+
+
+@bp.cli.command('startup-report')
+@click.option('--path', default='/', help='first request to send')
+@click.option('--top', default=15, help='slowest imports to list')
+@click.option('--max-seconds', type=float, default=None,
+              help='fail when the first response takes longer')
+def report_command(path, top, max_seconds):
+  """Time a cold start: imports, app creation and the first response."""
+  res = cold_start(path)
+  click.echo('status {}  ready {}s  first response {}s  total {}s'.format(
+      res['status'], res['ready_seconds'], res['first_response_seconds'],
+      res['total_seconds']))
+  for i in res['phases']:
+    click.echo('  {:<24} {:>8.4f}s'.format(i['name'], i['seconds']))
+  click.echo('slowest imports (cumulative / self):')
+  imports = sorted(res['imports'].items(), key=lambda i: -i[1][1])
+  for name, (own, cumulative) in imports[:top]:
+    click.echo('  {:<40} {:>8.4f}s {:>8.4f}s'.format(name, cumulative, own))
+  if max_seconds is not None and res['first_response_seconds'] > max_seconds:
+    raise click.ClickException('first response took {}s > {}s'.format(
+        res['first_response_seconds'], max_seconds))
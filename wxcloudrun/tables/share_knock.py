@@ -5,6 +5,7 @@ from sqlalchemy import Integer
 from sqlalchemy import TIMESTAMP
 from sqlalchemy import String
 from sqlalchemy import text
+from sqlalchemy import Index
 
 
 table = Table(
@@ -12,13 +13,15 @@ table = Table(
     MetaData(),
     Column('id', Integer, primary_key=True, index=True),
     Column('wish_id', Integer, index=True),
-    Column('share_session', String, index=True),
+    Column('share_session', String, unique=True, index=True),
     Column('create_time',
            TIMESTAMP,
            server_default=text('CURRENT_TIMESTAMP'),
            index=True,
            nullable=False),
     Column('openid', String, nullable=False),
-    Column('count', Integer, nullable=True),
-    Column('knock', Integer, nullable=True)
+    Column('count', Integer, nullable=False, server_default='0'),
+    Column('knock', Integer, nullable=False, server_default='0'),
+    # 7-day helper aggregates and rollup backfill
+    Index('ix_share_knock_wish_id_create_time', 'wish_id', 'create_time')
 )
@@ -0,0 +1,16 @@
+from sqlalchemy import Table
+from sqlalchemy import MetaData
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import Date
+
+
+table = Table(
+    'share_knock_daily',
+    MetaData(),
+    Column('wish_id', Integer, primary_key=True),
+    Column('day', Date, primary_key=True),
+    Column('helper', Integer, nullable=False, server_default='0'),
+    Column('count', Integer, nullable=False, server_default='0'),
+    Column('knock', Integer, nullable=False, server_default='0')
+)
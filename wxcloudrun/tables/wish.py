@@ -6,6 +6,7 @@ from sqlalchemy import TIMESTAMP
 from sqlalchemy import String
 from sqlalchemy import text
 from sqlalchemy import Boolean
+from sqlalchemy import Index
 
 
 table = Table(
@@ -26,14 +27,18 @@ table = Table(
            server_default=text('CURRENT_TIMESTAMP'),
            nullable=False),
     Column('openid', String, nullable=True),
-    Column('count', Integer, nullable=True),
-    Column('knock', Integer, nullable=True),
-    Column('fulfill', Boolean, nullable=True),
+    Column('count', Integer, nullable=False, server_default='0'),
+    Column('knock', Integer, nullable=False, server_default='0'),
+    Column('fulfill', Boolean, nullable=False, server_default='0'),
     Column('wish', String, nullable=True),
-    Column('helper_total', Integer, nullable=True),
-    Column('share_count_total', Integer, nullable=True),
-    Column('share_knock_total', Integer, nullable=True),
-    Column('helper', Integer, index=True, nullable=True),
-    Column('share_count', Integer, nullable=True),
-    Column('share_knock', Integer, nullable=True)
+    Column('helper_total', Integer, nullable=False, server_default='0'),
+    Column('share_count_total', Integer, nullable=False, server_default='0'),
+    Column('share_knock_total', Integer, nullable=False, server_default='0'),
+    Column('helper', Integer, index=True, nullable=False,
+           server_default='0'),
+    Column('share_count', Integer, nullable=False, server_default='0'),
+    Column('share_knock', Integer, nullable=False, server_default='0'),
+    # wish_list: mode=list pages by id, mode=last orders by last_time
+    Index('ix_wish_openid_fulfill_id', 'openid', 'fulfill', 'id'),
+    Index('ix_wish_openid_fulfill_last_time', 'openid', 'fulfill', 'last_time')
 )
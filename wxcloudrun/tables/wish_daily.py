@@ -0,0 +1,16 @@
+from sqlalchemy import Table
+from sqlalchemy import MetaData
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import Date
+
+
+table = Table(
+    'wish_daily',
+    MetaData(),
+    # clustered on (wish_id, day), a date window is one index range
+    Column('wish_id', Integer, primary_key=True),
+    Column('day', Date, primary_key=True),
+    Column('count', Integer, nullable=False, server_default='0'),
+    Column('knock', Integer, nullable=False, server_default='0')
+)
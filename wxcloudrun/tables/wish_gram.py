@@ -0,0 +1,17 @@
+from sqlalchemy import Table
+from sqlalchemy import MetaData
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy import Index
+
+
+table = Table(
+    'wish_gram',
+    MetaData(),
+    # a user's wishes containing a gram are one index range, by wish id
+    Column('openid', String, primary_key=True),
+    Column('gram', String, primary_key=True),
+    Column('wish_id', Integer, primary_key=True),
+    Index('ix_wish_gram_wish_id', 'wish_id')
+)
@@ -0,0 +1,19 @@
+from sqlalchemy import Table
+from sqlalchemy import MetaData
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy import Index
+
+
+table = Table(
+    'wish_score',
+    MetaData(),
+    Column('board', String, primary_key=True),
+    Column('wish_id', Integer, primary_key=True),
+    Column('openid', String, nullable=False),
+    Column('score', Integer, nullable=False, server_default='0'),
+    # global top N / rank, per user top N / rank
+    Index('ix_wish_score_board_score', 'board', 'score'),
+    Index('ix_wish_score_openid_board_score', 'openid', 'board', 'score')
+)
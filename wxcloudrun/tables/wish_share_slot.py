@@ -0,0 +1,16 @@
+from sqlalchemy import Table
+from sqlalchemy import MetaData
+from sqlalchemy import Column
+from sqlalchemy import Integer
+
+
+table = Table(
+    'wish_share_slot',
+    MetaData(),
+    # helper increments of a hot wish, spread over a few rows per wish
+    Column('wish_id', Integer, primary_key=True),
+    Column('slot', Integer, primary_key=True),
+    Column('helper', Integer, nullable=False, server_default='0'),
+    Column('share_count', Integer, nullable=False, server_default='0'),
+    Column('share_knock', Integer, nullable=False, server_default='0')
+)
@@ -0,0 +1,19 @@
+from sqlalchemy import Integer
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import GenericFunction
+
+
+class unix_timestamp(GenericFunction):
+  """Seconds since the epoch of a timestamp column, as an integer.
+
+  MySQL's UNIX_TIMESTAMP(), SQLite (the bench, aiosqlite) has no such
+  function and gets strftime('%s'), its CURRENT_TIMESTAMP being UTC.
+  """
+  type = Integer()
+  inherit_cache = True
+
+
+@compiles(unix_timestamp, 'sqlite')
+def _unix_timestamp_sqlite(element, compiler, **kw):
+  return "CAST(strftime('%s', {}) AS INTEGER)".format(
+      compiler.process(element.clauses, **kw))
@@ -0,0 +1,40 @@
+from sqlalchemy.dialects import mysql, sqlite
+
+
+def upsert(bind, table, values, update, index_elements=None):
+  """Build an insert-or-update statement for `bind`'s dialect.
+
+  `values` is a dict of column values, a list of such dicts (one
+  multi-row statement) or a select whose columns match
+  `index_elements` + the update columns, `update` is called with the
+  row that failed to insert (`VALUES()` / `excluded`) and returns the
+  SET clause. `index_elements` names the conflicting key for SQLite,
+  MySQL always uses the key that conflicted.
+  """
+  if bind.dialect.name == 'mysql':
+    stmt = mysql.insert(table)
+  elif bind.dialect.name == 'sqlite':
+    stmt = sqlite.insert(table)
+  else:
+    raise NotImplementedError(bind.dialect.name)
+
+  if isinstance(values, dict):
+    stmt = stmt.values(**values)
+  elif isinstance(values, list):
+    stmt = stmt.values(values)
+  else:
+    stmt = stmt.from_select([c.name for c in values.selected_columns], values)
+
+  if bind.dialect.name == 'mysql':
+    return stmt.on_duplicate_key_update(**update(stmt.inserted))
+  return stmt.on_conflict_do_update(index_elements=index_elements,
+                                    set_=update(stmt.excluded))
+
+
+def upsert_inserted(bind, result):
+  """Whether an executed upsert inserted a new row.
+
+  MySQL reports 1 affected row for an insert and 2 for an update, other
+  dialects cannot tell the two apart and always return False.
+  """
+  return bind.dialect.name == 'mysql' and result.rowcount == 1
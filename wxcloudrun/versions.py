@@ -0,0 +1,97 @@
+import os
+import time
+import zlib
+
+import simplejson as json
+from flask import Response, request
+
+import config
+from wxcloudrun.local_store import LocalStore
+from wxcloudrun.metrics import inc
+from wxcloudrun.replica import router
+
+USER = 'user'
+SHARE = 'share'
+
+
+class VersionStore(object):
+  """Opaque per-user / per-share version tokens backing the ETags.
+
+  Write paths bump the token after their write committed. Tokens live
+  in a LocalStore file shared by the workers of a container and expire
+  after `ttl` seconds, a missing token is replaced by a fresh one so an
+  old ETag can never match again. Writes served by another container
+  are therefore noticed within `ttl` seconds at the latest.
+  """
+
+  def __init__(self, store, ttl):
+    self.store = store
+    self.ttl = ttl
+
+  @staticmethod
+  def _new_token():
+    return '{:x}{:x}'.format(time.time_ns(), os.getpid())
+
+  def get(self, kind, key):
+    item = self.store.get('{}:{}'.format(kind, key))
+    if item is not None:
+      return item[0]
+    token = self._new_token()
+    self.store.set('{}:{}'.format(kind, key), token, self.ttl)
+    return token
+
+  def bump(self, kind, key):
+    self.store.set('{}:{}'.format(kind, key), self._new_token(), self.ttl)
+
+
+versions = (VersionStore(LocalStore(config.ETAG_VERSIONS_PATH),
+                         config.ETAG_VERSION_TTL)
+            if config.ETAG_VERSIONS_PATH else None)
+
+
+def bump_user(openid):
+  """Bump `openid`'s version once its write committed.
+
+  The user's reads are sent to the primary first, so a lagging replica
+  cannot serve an old body under the new version.
+  """
+  if openid is None:
+    return
+  router.mark_write(openid)
+  if versions is not None:
+    versions.bump(USER, openid)
+
+
+def bump_share(share_id):
+  if versions is not None:
+    versions.bump(SHARE, share_id)
+
+
+def etag_for(kind, key, *args):
+  """Weak ETag of a response depending on `kind`/`key` and `args`.
+
+  A missing version is created, call it only for keys that exist.
+  """
+  if versions is None:
+    return None
+  args_hash = zlib.crc32(json.dumps(args).encode('utf-8'))
+  return '{}-{:08x}'.format(versions.get(kind, key), args_hash)
+
+
+def not_modified(etag):
+  """A 304 response when the client already holds `etag`, else None."""
+  if etag is None or not request.if_none_match:
+    return None
+  route = request.url_rule.rule
+  inc('wooden_fish_conditional_requests_total', route=route)
+  if not request.if_none_match.contains_weak(etag):
+    return None
+  inc('wooden_fish_not_modified_total', route=route)
+  return with_etag(Response(status=304), etag)
+
+
+def with_etag(response, etag):
+  if etag is not None:
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+  return response
@@ -1,18 +1,59 @@
 from flask.views import View
-from flask import request
-from sqlalchemy.engine import Engine
+from flask import Blueprint, g, has_request_context, request
+from sqlalchemy.engine import Connection, Engine
 from wxcloudrun import db
+from wxcloudrun.metrics import parser
+from wxcloudrun.response import make_err_response
+
+bp = Blueprint('view', __name__)
+
+
+def request_connection(bind=None) -> Connection:
+  """The connection of `bind` for the current request.
+
+  Checked out on first use and shared by every query of the request,
+  returned to the pool in teardown.
+  """
+  conns = g.setdefault('db_connections', {})
+  conn = conns.get(bind)
+  if conn is None:
+    conn = conns[bind] = db.get_engine(bind=bind).connect()
+  return conn
+
+
+def connection_or_engine(bind=None):
+  """request_connection() inside a request, else the engine."""
+  if has_request_context():
+    return request_connection(bind)
+  return db.get_engine(bind=bind)
+
+
+@bp.teardown_app_request
+def _release_connections(exc):
+  for conn in g.pop('db_connections', {}).values():
+    # rolls back whatever a failed handler left open
+    conn.close()
 
 
 class BasicView(View):
+  """POST endpoint loading its JSON body with the `args` Schema.
+
+  A valid body without X-WX-OPENID is answered with 'not login' unless
+  `login_required` is False, otherwise `handle()` is called with the
+  loaded arguments.
+  """
+  methods = ['POST']
+  args = None
+  login_required = True
+
   @property
   def headers(self):
     return request.headers
-  
+
   @property
   def openid(self) -> str:
     return self.headers.get('X-WX-OPENID')
-  
+
   @property
   def appid(self) -> str:
     return self.headers.get('X-WX-APPID')
@@ -20,3 +61,21 @@ class BasicView(View):
   @property
   def dbe(self) -> Engine:
     return db.engine
+
+  @property
+  def conn(self) -> Connection:
+    return request_connection()
+
+  def begin(self):
+    """A transaction on the request's connection."""
+    return self.conn.begin()
+
+  def dispatch_request(self, **kwargs):
+    if self.args is not None:
+      kwargs.update(parser.parse(self.args, request, location='json'))
+    if self.login_required and self.openid is None:
+      return make_err_response({'msg': 'not login'})
+    return self.handle(**kwargs)
+
+  def handle(self, **kwargs):
+    raise NotImplementedError
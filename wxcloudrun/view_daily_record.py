@@ -1,52 +1,124 @@
-from datetime import datetime, timedelta
-from functools import lru_cache
+import time
+from datetime import date
 from uuid import uuid4
 
-from flask import request
+from flask import Blueprint, Response, stream_with_context
 from marshmallow import Schema, fields
 from marshmallow.validate import Length, OneOf, Range
-from sqlalchemy import and_, asc, desc, func, select, text
-from sqlalchemy.engine import Engine
-from webargs.flaskparser import use_kwargs
+from sqlalchemy import and_, asc, desc, select, text
 
-from run import app
-from wxcloudrun import db
+import config
+from wxcloudrun import (export, knock_history, leaderboard, search,
+                        share_ids, share_slots)
+from wxcloudrun.knock_buffer import batch_knock_update, flush_knocks, knock_buffer
+from wxcloudrun.replica import read_fetchall, read_only, router
 from wxcloudrun.response import make_err_response, make_succ_response
+from wxcloudrun.share_cache import (invalidate_share, invalidate_wish,
+                                    owner_key, share_cache, share_key)
+from wxcloudrun.share_rollup import (LAST_WEEK_EMPTY, LAST_WEEK_FIELDS,
+                                     last_week_by_wish_sql, last_week_sql,
+                                     rollup_session_sql)
+from wxcloudrun.share_slots import hot_wishes, total
 from wxcloudrun.tables import share_knock as share_knock_table
 from wxcloudrun.tables import wish as wish_table
 from wxcloudrun.tables import wish_share as wish_share_table
+from wxcloudrun.unix_timestamp import unix_timestamp
+from wxcloudrun.upsert import upsert, upsert_inserted
+from wxcloudrun.versions import (SHARE, USER, bump_share, bump_user, etag_for,
+                                 not_modified, with_etag)
+from wxcloudrun.view import BasicView
 
 WISH_SHARE_PREFIX = 'SH'
+WISH_UPDATE_BATCH_MAX = 100
+WISH_BULK_CREATE_MAX = 50
+LEADERBOARD_MAX = 50
+
+WISH_LENGTH = Length(min=1, max=128)
+
+COUNT_RANGE = Range(min=0, max=100)
+KNOCK_RANGE = Range(min=0, max=10000)
+
+bp = Blueprint('wooden_fish', __name__)
 
 
 class NewWish(Schema):
   wish = fields.String(required=True,
-                       validate=[Length(min=1, max=128)])
+                       validate=[WISH_LENGTH])
+
+
+class NewWishView(BasicView):
+  args = NewWish
+
+  def handle(self, wish: str):
+    table = wish_table.table
+
+    with self.begin():
+      res = self.conn.execute(
+          table.insert().values(
+              openid=self.openid,
+              wish=wish
+          )
+      )
+      wish_id = res.inserted_primary_key[0]
+      self.conn.execute(search.index_sql(self.openid, [(wish_id, wish)]))
+    invalidate_wish(wish_id)
+    bump_user(self.openid)
+    return make_succ_response({'id': wish_id})
+
+
+bp.add_url_rule('/api/wooden_fish/wish',
+                view_func=NewWishView.as_view('new_wish'))
+
+
+class NewWishBulk(Schema):
+  wishes = fields.List(fields.String(validate=[WISH_LENGTH]),
+                       required=True,
+                       validate=[Length(min=1, max=WISH_BULK_CREATE_MAX)])
 
 
-@app.route('/api/wooden_fish/wish', methods=['POST'])
-@use_kwargs(NewWish)
-def new_wish(wish: str):
-  openid = request.headers.get('X-WX-OPENID')
-  if openid is None:
-    return make_err_response({'msg': 'not login'})
-  engine: Engine = db.engine
+def inserted_wishes_sql(dialect, res, openid, num):
+  """(id, wish) of the `num` wishes of `openid` a multi-row insert `res`
+  just added.
+
+  Ids are only known to be at or above the first one: with
+  innodb_autoinc_lock_mode 2 concurrent inserts interleave, and
+  auto_increment_increment may step by more than 1. Run it in the
+  inserting transaction.
+  """
+  first = res.lastrowid
+  if dialect.name == 'sqlite':
+    # SQLite reports the last id, its writes are serialized
+    first -= num - 1
   table = wish_table.table
+  return (select(table.c.id, table.c.wish)
+          .where(and_(table.c.openid == openid, table.c.id >= first))
+          .order_by(table.c.id)
+          .limit(num))
 
-  with engine.begin() as conn:
-    conn.execute(
-        table.insert().values(
-            openid=openid,
-            wish=wish
-        )
-    )
-    res = conn.execute(
-        select(table.c.id)
-        .where(table.c.openid == openid)
-        .order_by(desc(table.c.create_time))
-        .limit(1)
-    ).fetchall()
-  return make_succ_response({'id': res[0][0]})
+
+class NewWishBulkView(BasicView):
+  args = NewWishBulk
+
+  def handle(self, wishes: list):
+    table = wish_table.table
+
+    with self.begin():
+      res = self.conn.execute(
+          table.insert().values([{'openid': self.openid, 'wish': i}
+                                 for i in wishes])
+      )
+      rows = [tuple(i) for i in self.conn.execute(inserted_wishes_sql(
+          self.conn.dialect, res, self.openid, len(wishes)))]
+      self.conn.execute(search.index_sql(self.openid, rows))
+    ids = [i[0] for i in rows]
+    for i in ids:
+      invalidate_wish(i)
+    bump_user(self.openid)
+    return make_succ_response({'id': ids})
+
+
+bp.add_url_rule('/api/wooden_fish/wish_bulk_create',
+                view_func=NewWishBulkView.as_view('new_wish_bulk'))
 
 
 class WishList(Schema):
@@ -63,29 +135,27 @@ WISH_FIELDS = ('id', 'create_time', 'update_time', 'last_time',
                'count', 'knock', 'fulfill', 'wish', 'share_count')
 
 
-@app.route('/api/wooden_fish/wish_list', 
-           methods=['POST'])
-@use_kwargs(WishList)
-def wish_list(mode: str, last_id: int, page_num: int, fulfill: bool):
-  openid = request.headers.get('X-WX-OPENID')
-  if openid is None:
-    return make_err_response({'msg': 'not login'})
-  engine: Engine = db.engine
+def wish_columns():
+  """The WISH_FIELDS columns of the wish table."""
   table = wish_table.table
-
-  sql = select(table.c.id,
-               func.unix_timestamp(table.c.create_time).label('create_time'),
-               func.unix_timestamp(table.c.update_time).label('update_time'),
-               func.unix_timestamp(table.c.last_time).label('last_time'),
-               table.c.count,
-               table.c.knock,
-               table.c.fulfill,
-               table.c.wish, 
-               table.c.share_count)
+  return (table.c.id,
+          unix_timestamp(table.c.create_time).label('create_time'),
+          unix_timestamp(table.c.update_time).label('update_time'),
+          unix_timestamp(table.c.last_time).label('last_time'),
+          table.c.count,
+          table.c.knock,
+          table.c.fulfill,
+          table.c.wish,
+          total('share_count').label('share_count'))
+
+
+def wish_list_sql(openid, mode, last_id, page_num, fulfill):
+  table = wish_table.table
+  sql = select(*wish_columns())
   if mode == 'list':
     sql = (
         sql
-        .where(and_(table.c.fulfill.is_(fulfill),
+        .where(and_(table.c.fulfill == fulfill,
                     table.c.openid == openid,
                     table.c.id > last_id))
         .order_by(asc(table.c.id))
@@ -94,91 +164,192 @@ def wish_list(mode: str, last_id: int, page_num: int, fulfill: bool):
   elif mode == 'last':
     sql = (
         sql
-        .where(and_(table.c.fulfill.is_(fulfill),
+        .where(and_(table.c.fulfill == fulfill,
                     table.c.openid == openid))
         .order_by(desc(table.c.last_time))
         .limit(page_num)
     )
-  res = engine.execute(sql).fetchall()
-  result = {i: list() for i in WISH_FIELDS}
-  for i in res:
-    for idx, k in enumerate(WISH_FIELDS):
+  return sql
+
+
+def to_columns(rows, keys):
+  result = {i: list() for i in keys}
+  for i in rows:
+    for idx, k in enumerate(keys):
       result[k].append(i[idx])
-  return make_succ_response(result)
+  return result
+
+
+class WishListView(BasicView):
+  args = WishList
+  decorators = [read_only]
+
+  def handle(self, mode: str, last_id: int, page_num: int, fulfill: bool):
+    openid = self.openid
+    # buffered knocks bump the version, land them before taking it
+    flush_knocks(openid)
+    etag = etag_for(USER, openid, mode, last_id, page_num, fulfill)
+    response = not_modified(etag)
+    if response is not None:
+      return response
+
+    res = read_fetchall(wish_list_sql(openid, mode, last_id, page_num,
+                                      fulfill))
+    return with_etag(make_succ_response(to_columns(res, WISH_FIELDS)), etag)
+
+
+bp.add_url_rule('/api/wooden_fish/wish_list',
+                view_func=WishListView.as_view('wish_list'))
+
+
+class WishSearch(Schema):
+  query = fields.String(required=True, validate=[WISH_LENGTH])
+  last_id = fields.Integer(load_default=0,
+                           validate=[Range(min=0)])
+  page_num = fields.Integer(load_default=10,
+                            validate=[Range(min=1, max=100)])
+  # None searches fulfilled and open wishes
+  fulfill = fields.Boolean(load_default=None)
+
+
+def wish_search_sql(openid, query, last_id, page_num, fulfill):
+  return search.search_sql(wish_columns(), openid, query, last_id,
+                                page_num, fulfill)
+
+
+class WishSearchView(BasicView):
+  args = WishSearch
+  decorators = [read_only]
+
+  def handle(self, query: str, last_id: int, page_num: int, fulfill: bool):
+    openid = self.openid
+    flush_knocks(openid)
+    etag = etag_for(USER, openid, 'search', query, last_id, page_num, fulfill)
+    response = not_modified(etag)
+    if response is not None:
+      return response
+
+    res = read_fetchall(wish_search_sql(openid, query, last_id, page_num,
+                                        fulfill))
+    return with_etag(make_succ_response(to_columns(res, WISH_FIELDS)), etag)
+
+
+bp.add_url_rule('/api/wooden_fish/wish_search',
+                view_func=WishSearchView.as_view('wish_search'))
 
 
 class WishShareStats(Schema):
   wish_id = fields.Integer(required=True, validate=[Range(min=0)])
 
 
-@app.route('/api/wooden_fish/wish_share_stats',
-           methods=['POST'])
-@use_kwargs(WishShareStats)
-def wish_stats(wish_id: int):
-  openid = request.headers.get('X-WX-OPENID')
-  if openid is None:
-    return make_err_response({'msg': 'not login'})
-  engine: Engine = db.engine
-  table = wish_table.table
-  helper_table = share_knock_table.table
+WISH_STATS_FIELDS = ('helper_total', 'share_count_total', 'share_knock_total',
+                     'helper', 'share_count', 'share_knock')
 
-  sql = select(
+
+def wish_stats_sql(openid, wish_id):
+  table = wish_table.table
+  return select(
       table.c.helper_total,
       table.c.share_count_total,
       table.c.share_knock_total,
-      table.c.helper,
-      table.c.share_count,
-      table.c.share_knock
+      total('helper').label('helper'),
+      total('share_count').label('share_count'),
+      total('share_knock').label('share_knock')
   ).where(and_(table.c.id == wish_id,
                table.c.openid == openid))
-  res = engine.execute(sql).fetchall()
-  if not res:
-    return make_err_response({'msg': 'wish not found'})
-  res = dict(zip(('helper_total',
-                  'share_count_total',
-                  'share_knock_total',
-                  'helper',
-                  'share_count',
-                  'share_knock'),
-                 res[0]))
-
-  last_week_sql = select(
-      func.count(helper_table.c.id).label('last_week_helper'),
-      func.sum(helper_table.c.count).label('last_week_count'),
-      func.sum(helper_table.c.knock).label('last_week_knock')
-  ).where(and_(helper_table.c.wish_id == wish_id,
-               helper_table.c.create_time >= (datetime.now() - timedelta(days=7)).timestamp()))
-  helper_res = engine.execute(last_week_sql).fetchall()
-  helper_res = dict(zip(('last_week_helper',
-                         'last_week_count',
-                         'last_week_knock'),
-                        helper_res[0]))
-  res.update(helper_res)
-  return make_succ_response(res)
+
+
+class WishShareStatsView(BasicView):
+  args = WishShareStats
+  decorators = [read_only]
+
+  def handle(self, wish_id: int):
+    flush_knocks(self.openid)
+
+    res = read_fetchall(wish_stats_sql(self.openid, wish_id))
+    if not res:
+      return make_err_response({'msg': 'wish not found'})
+    res = dict(zip(WISH_STATS_FIELDS, res[0]))
+
+    helper_res = read_fetchall(last_week_sql(wish_id))
+    res.update(helper_res[0]._mapping)
+    return make_succ_response(res)
+
+
+bp.add_url_rule('/api/wooden_fish/wish_share_stats',
+                view_func=WishShareStatsView.as_view('wish_stats'))
+
+
+DASHBOARD_WISH_FIELDS = WISH_FIELDS + ('helper_total', 'share_count_total',
+                                       'share_knock_total', 'helper',
+                                       'share_knock')
+DASHBOARD_FIELDS = DASHBOARD_WISH_FIELDS + LAST_WEEK_FIELDS
+
+
+def dashboard_sql(openid, mode, last_id, page_num, fulfill):
+  """wish_list_sql() with the share counters of wish_share_stats."""
+  table = wish_table.table
+  return wish_list_sql(openid, mode, last_id, page_num, fulfill).add_columns(
+      table.c.helper_total,
+      table.c.share_count_total,
+      table.c.share_knock_total,
+      total('helper').label('helper'),
+      total('share_knock').label('share_knock'))
+
+
+def dashboard_columns(rows, last_week):
+  """Columns of a wish page with each wish's last week attached."""
+  res = to_columns(rows, DASHBOARD_WISH_FIELDS)
+  last_week = {i[0]: tuple(i[1:]) for i in last_week}
+  stats = [last_week.get(i, LAST_WEEK_EMPTY) for i in res['id']]
+  for idx, k in enumerate(LAST_WEEK_FIELDS):
+    res[k] = [i[idx] for i in stats]
+  return res
+
+
+class DashboardView(BasicView):
+  """A page of wish_list with the wish_share_stats of every wish."""
+  args = WishList
+  decorators = [read_only]
+
+  def handle(self, mode: str, last_id: int, page_num: int, fulfill: bool):
+    openid = self.openid
+    flush_knocks(openid)
+    # the last week window moves at midnight without any write
+    etag = etag_for(USER, openid, 'dashboard', str(date.today()), mode,
+                    last_id, page_num, fulfill)
+    response = not_modified(etag)
+    if response is not None:
+      return response
+
+    res = read_fetchall(dashboard_sql(openid, mode, last_id, page_num,
+                                      fulfill))
+    last_week = []
+    if res:
+      last_week = read_fetchall(last_week_by_wish_sql([i[0] for i in res]))
+    return with_etag(make_succ_response(dashboard_columns(res, last_week)),
+                     etag)
+
+
+bp.add_url_rule('/api/wooden_fish/dashboard',
+                view_func=DashboardView.as_view('wish_dashboard'))
 
 
 class WishUpdate(Schema):
   wish_id = fields.Integer(required=True, validate=[Range(min=0)])
   fulfill = fields.Boolean(load_default=None)
   count = fields.Integer(load_default=1,
-                         validate=[Range(min=0, max=100)])
+                         validate=[COUNT_RANGE])
   knock = fields.Integer(load_default=None,
-                         validate=[Range(min=0, max=10000)])
+                         validate=[KNOCK_RANGE])
   wish = fields.String(load_default=None,
-                       validate=[Length(min=1, max=128)])
+                       validate=[WISH_LENGTH])
   clear_record = fields.Boolean(load_default=False)
   gather_shared = fields.Boolean(load_default=False)
 
 
-@app.route('/api/wooden_fish/wish_update',
-           methods=['POST'])
-@use_kwargs(WishUpdate)
-def wish_update(wish_id: int, fulfill: bool, count: int, wish: str, knock: int,
-                clear_record: bool, gather_shared: bool):
-  openid = request.headers.get('X-WX-OPENID')
-  if openid is None:
-    return make_err_response({'msg': 'not login'})
-  engine: Engine = db.engine
+def wish_update_sql(openid, wish_id, fulfill, count, wish, knock,
+                    clear_record, gather_shared):
   table = wish_table.table
 
   values = dict(last_time=text('CURRENT_TIMESTAMP'))
@@ -209,164 +380,515 @@ def wish_update(wish_id: int, fulfill: bool, count: int, wish: str, knock: int,
   if wish is not None:
     values['wish'] = wish
 
-  engine.execute(
-      table.update().values(**values).where(table.c.id == wish_id,
-                                            table.c.openid == openid)
-  )
-  return make_succ_response({'result': True})
+  return table.update().values(**values).where(table.c.id == wish_id,
+                                               table.c.openid == openid)
+
+
+class WishUpdateView(BasicView):
+  args = WishUpdate
+
+  def handle(self, wish_id: int, fulfill: bool, count: int, wish: str,
+             knock: int, clear_record: bool, gather_shared: bool):
+    openid = self.openid
+    increment_only = (fulfill is None and wish is None and
+                      not clear_record and not gather_shared)
+    if knock_buffer is not None:
+      if increment_only:
+        # the flush bumps the version once the deltas committed
+        knock_buffer.add(openid, wish_id, count, knock)
+        return make_succ_response({'result': True})
+      # buffered increments must land before a reset/gather/edit
+      knock_buffer.flush(openid)
+
+    conn = self.conn
+    with self.begin():
+      if gather_shared and hot_wishes is not None:
+        # a hot wish's helpers added to its slots
+        share_slots.fold(conn, [wish_id])
+      res = conn.execute(
+          wish_update_sql(openid, wish_id, fulfill, count, wish, knock,
+                          clear_record, gather_shared)
+      )
+      if wish is not None and res.rowcount:
+        for sql in search.reindex_sqls(openid, wish_id, wish):
+          conn.execute(sql)
+      if count or knock or clear_record or gather_shared:
+        conn.execute(leaderboard.refresh_wishes_sql(conn, [wish_id],
+                                                    leaderboard.KNOCK_BOARDS))
+      if not clear_record and not gather_shared and (count or knock):
+        conn.execute(knock_history.record_sql(
+            conn, {(openid, wish_id): (count, knock)}))
+    bump_user(openid)
+    return make_succ_response({'result': True})
+
+
+bp.add_url_rule('/api/wooden_fish/wish_update',
+                view_func=WishUpdateView.as_view('wish_update'))
+
+
+class WishDelta(Schema):
+  wish_id = fields.Integer(required=True, validate=[Range(min=0)])
+  count = fields.Integer(load_default=1,
+                         validate=[COUNT_RANGE])
+  knock = fields.Integer(load_default=None,
+                         validate=[KNOCK_RANGE])
 
 
-class WishShare(Schema):
-  wish_id = fields.Integer(required=True, validate=[Range(min=0)])
-  share_content = fields.Bool(load_default=False)
+class WishUpdateBatch(Schema):
+  updates = fields.List(fields.Nested(WishDelta),
+                        required=True,
+                        validate=[Length(min=1, max=WISH_UPDATE_BATCH_MAX)])
 
 
-@app.route('/api/wooden_fish/wish_share_create',
-           methods=['POST'])
-@use_kwargs(WishShare)
-def wish_share_create(wish_id: int, share_content: bool):
-  openid = request.headers.get('X-WX-OPENID')
-  if openid is None:
-    return make_err_response({'msg': 'not login'})
+def merge_deltas(openid, updates):
+  deltas = {}
+  for i in updates:
+    key = (openid, i['wish_id'])
+    c, k = deltas.get(key, (0, 0))
+    deltas[key] = (c + (i['count'] or 0), k + (i['knock'] or 0))
+  return deltas
 
-  engine: Engine = db.engine
-  origin_table = wish_table.table
-  table = wish_share_table.table
 
-  sql = select(origin_table.c.wish).where(and_(origin_table.c.id == wish_id,
-                                               origin_table.c.openid == openid))
-  res = engine.execute(sql).fetchall()
-  if not res:
-    return make_err_response({'msg': 'wish not found'})
-  share_id = WISH_SHARE_PREFIX + uuid4().hex[:16]
+def owned_wish_ids_sql(openid, wish_ids):
+  table = wish_table.table
+  return select(table.c.id).where(and_(table.c.openid == openid,
+                                       table.c.id.in_(wish_ids)))
+
+
+class WishUpdateBatchView(BasicView):
+  args = WishUpdateBatch
+
+  def handle(self, updates: list):
+    deltas = merge_deltas(self.openid, updates)
+    wish_ids = [k[1] for k in deltas]
+
+    rows = batch_knock_update(deltas, self.conn)
+    if rows == len(wish_ids):
+      matched = set(wish_ids)
+    else:
+      # only look up which ids belong to the caller when some did not match
+      res = self.conn.execute(owned_wish_ids_sql(self.openid,
+                                                 wish_ids)).fetchall()
+      matched = {i[0] for i in res}
+    return make_succ_response(
+        {'wish_id': wish_ids,
+         'updated': [int(i in matched) for i in wish_ids]}
+    )
+
+
+bp.add_url_rule('/api/wooden_fish/wish_update_batch',
+                view_func=WishUpdateBatchView.as_view('wish_update_batch'))
+
 
+class WishShare(Schema):
+  wish_id = fields.Integer(required=True, validate=[Range(min=0)])
+  share_content = fields.Bool(load_default=False)
+
+
+def new_share_values(wish_id, share_content, wish):
   share_vals = {
-      'share_id': share_id,
+      'share_id': WISH_SHARE_PREFIX + uuid4().hex[:16],
       'wish_id': wish_id,
       'share_content': share_content
   }
   if share_content:
-    wish = res[0][0]
     share_vals['wish'] = wish
+  return share_vals
 
-  engine.execute(
-      table.insert().values(**share_vals)
-  )
-  return make_succ_response({'share_id': share_id})
+
+def signed_share_id_sql(row_id, share_id):
+  table = wish_share_table.table
+  return table.update().values(share_id=share_id).where(table.c.id == row_id)
+
+
+class WishShareCreateView(BasicView):
+  args = WishShare
+
+  def handle(self, wish_id: int, share_content: bool):
+    origin_table = wish_table.table
+    table = wish_share_table.table
+
+    sql = select(origin_table.c.wish).where(
+        and_(origin_table.c.id == wish_id,
+             origin_table.c.openid == self.openid))
+    res = self.conn.execute(sql).fetchall()
+    if not res:
+      return make_err_response({'msg': 'wish not found'})
+    share_vals = new_share_values(wish_id, share_content, res[0][0])
+    share_id = share_vals['share_id']
+
+    with self.begin():
+      res = self.conn.execute(
+          table.insert().values(**share_vals)
+      )
+      if share_ids.enabled():
+        # the signed id carries the row id, known once inserted
+        row_id = res.inserted_primary_key[0]
+        share_id = share_ids.sign(wish_id, row_id, share_content, self.openid)
+        self.conn.execute(signed_share_id_sql(row_id, share_id))
+    invalidate_share(share_id)
+    bump_share(share_id)
+    return make_succ_response({'share_id': share_id})
+
+
+bp.add_url_rule('/api/wooden_fish/wish_share_create',
+                view_func=WishShareCreateView.as_view('wish_share_create'))
 
 
 class WishShareEnter(Schema):
   share_id = fields.String(required=True)
 
 
-@lru_cache(maxsize=64)
-def get_openid_from_wishid(wish_id) -> str:
-  engine: Engine = db.engine
+def owner_sql(wish_id):
   table = wish_table.table
-  sql = (select(table.c.openid)
-         .where(table.c.id == wish_id)
-         .limit(1))
-  res = engine.execute(sql).fetchall()
+  return (select(table.c.openid)
+          .where(table.c.id == wish_id)
+          .limit(1))
+
+
+def _load_openid_from_wishid(wish_id):
+  # a miss may be a wish the replica has not caught up with yet
+  res = read_fetchall(owner_sql(wish_id), primary_if_empty=True)
   if not res:
-    return make_err_response({'msg': 'wish not found'})
+    return
   return res[0][0]
 
 
-@lru_cache(maxsize=64)
-def get_wish_content_from_share_id(share_id):
-  engine: Engine = db.engine
+def get_openid_from_wishid(wish_id) -> str:
+  return share_cache.get(owner_key(wish_id),
+                         lambda: _load_openid_from_wishid(wish_id))
+
+
+def share_sql(share_id, share=None):
+  """The share row of `share_id`, by primary key for a SignedShare."""
   table = wish_share_table.table
-  sql = (select(table.c.wish,
-                table.c.share_content,
-                table.c.wish_id)
-         .where(table.c.share_id == share_id)
-         .limit(1))
-  res = engine.execute(sql).fetchall()
-  return res
+  sql = select(table.c.wish,
+               table.c.share_content,
+               table.c.wish_id)
+  if share is not None:
+    sql = sql.where(and_(table.c.id == share.row_id,
+                         table.c.wish_id == share.wish_id))
+  else:
+    sql = sql.where(table.c.share_id == share_id)
+  return sql.limit(1)
 
 
-@app.route('/api/wooden_fish/wish_share_enter',
-           methods=['POST'])
-@use_kwargs(WishShareEnter)
-def wish_share_enter(share_id: str):
-  openid = request.headers.get('X-WX-OPENID')
-  if openid is None:
-    return make_err_response({'msg': 'not login'})
+def signed_share_content(share):
+  """[wish, share_content, wish_id] of a share not sharing its text."""
+  return [None, False, share.wish_id]
 
-  res = get_wish_content_from_share_id(share_id)
+
+def _load_share(share_id, share=None):
+  res = read_fetchall(share_sql(share_id, share), primary_if_empty=True)
   if not res:
-    return make_err_response({'msg': 'wish not found'})
-  wish_id = res[0][2]
-  wish_openid = get_openid_from_wishid(wish_id)
-  return make_succ_response({'wish': res[0][0],
-                             'share_content': res[0][1], 
-                             'self_share': wish_openid == openid})
+    return
+  return list(res[0])
+
+
+def get_wish_content_from_share_id(share_id, share=None):
+  """Return [wish, share_content, wish_id] of a share, or None.
+
+  `share` is share_ids.decode(share_id), a verified id not sharing the
+  wish text resolves without a lookup.
+  """
+  if share is not None and not share.share_content:
+    return signed_share_content(share)
+  return share_cache.get(share_key(share_id),
+                         lambda: _load_share(share_id, share))
+
+
+class WishShareEnterView(BasicView):
+  args = WishShareEnter
+  decorators = [read_only]
+
+  def handle(self, share_id: str):
+    share = share_ids.decode(share_id)
+    res = get_wish_content_from_share_id(share_id, share)
+    if not res:
+      return make_err_response({'msg': 'wish not found'})
+    if share is not None:
+      self_share = share_ids.owned_by(share, self.openid)
+    else:
+      wish_openid = get_openid_from_wishid(res[2])
+      if wish_openid is None:
+        return make_err_response({'msg': 'wish not found'})
+      self_share = wish_openid == self.openid
+    # taken once the share resolved, unknown ids must not mint versions
+    etag = etag_for(SHARE, share_id, self.openid)
+    response = not_modified(etag)
+    if response is not None:
+      return response
+    return with_etag(make_succ_response({'wish': res[0],
+                                         'share_content': res[1],
+                                         'self_share': self_share}),
+                     etag)
+
+
+bp.add_url_rule('/api/wooden_fish/wish_share_enter',
+                view_func=WishShareEnterView.as_view('wish_share_enter'))
 
 
 class WishShareUpdate(Schema):
   share_id = fields.String(required=True)
-  share_session = fields.String(load_default=None)
+  share_session = fields.String(load_default=None,
+                                validate=[Length(min=1, max=32)])
   count = fields.Integer(load_default=1,
-                         validate=[Range(min=0, max=100)])
+                         validate=[COUNT_RANGE])
   knock = fields.Integer(load_default=None,
-                         validate=[Range(min=0, max=10000)])
+                         validate=[KNOCK_RANGE])
 
 
-@lru_cache(maxsize=64)
 def get_wish_id_from_share_id(share_id):
-  table = wish_share_table.table
-  engine: Engine = db.engine
-  res = engine.execute(
-      select(table.c.wish_id).where(table.c.share_id == share_id).limit(1)
-  ).fetchall()
+  share = share_ids.decode(share_id)
+  if share is not None:
+    return share.wish_id
+  res = get_wish_content_from_share_id(share_id)
   if not res:
     return
-  return res[0][0]
-
+  return res[2]
 
-@app.route('/api/wooden_fish/wish_share_update',
-           methods=['POST'])
-@use_kwargs(WishShareUpdate)
-def wish_share_update(share_id: str, share_session: str, count: int, knock: int):
-  openid = request.headers.get('X-WX-OPENID')
-  if openid is None:
-    return make_err_response({'msg': 'not login'})
 
-  wish_id = get_wish_id_from_share_id(share_id)
-  if wish_id is None:
-    return make_err_response({'msg': 'wish not found'})
-  engine: Engine = db.engine
+def share_helper_sql(wish_id, count, knock):
   table = wish_table.table
-  insert_table = share_knock_table.table
-  insert_val = {'wish_id': wish_id, 'openid': openid}
-  if share_session is None:
-    insert_val['share_session'] = uuid4().hex
-
   values = {}
   if count:
-    insert_val['count'] = count
     values['helper'] = table.c.helper + 1
     values['share_count'] = table.c.share_count + count
   if knock:
-    insert_val['knock'] = knock
     values['share_knock'] = table.c.share_knock + knock
-  if values:
-    engine.execute(
-        table.update().values(**values).where(table.c.id == wish_id)
-    )
-  if share_session is None:
-    engine.execute(
-        insert_table.insert().values(**insert_val)
-    )
-  else:
-    engine.execute(
-        insert_table
-        .update()
-        .values(count=insert_table.c.count + insert_val.get('count', 0),
-                knock=insert_table.c.knock + insert_val.get('knock', 0))
-        .where(insert_table.c.share_session == share_session)
-    )
-  return make_succ_response(
-      {'result': True,
-       'share_session': share_session or insert_val['share_session']}
+  if not values:
+    return
+  return table.update().values(**values).where(table.c.id == wish_id)
+
+
+def share_knock_upsert_sql(bind, wish_id, openid, share_session, count, knock):
+  insert_table = share_knock_table.table
+  return upsert(
+      bind, insert_table,
+      {'wish_id': wish_id,
+       'openid': openid,
+       'share_session': share_session,
+       'count': count or 0,
+       'knock': knock or 0},
+      lambda new: {'count': insert_table.c.count + new.count,
+                   'knock': insert_table.c.knock + new.knock},
+      index_elements=['share_session'])
+
+
+def share_knock_update_sql(share_session, count, knock):
+  table = share_knock_table.table
+  return table.update().values(
+      count=table.c.count + (count or 0),
+      knock=table.c.knock + (knock or 0)
+  ).where(table.c.share_session == share_session)
+
+
+def share_knock_insert_sql(wish_id, openid, share_session, count, knock):
+  return share_knock_table.table.insert().values(
+      wish_id=wish_id,
+      openid=openid,
+      share_session=share_session,
+      count=count or 0,
+      knock=knock or 0)
+
+
+def share_knock_upserted(bind):
+  """Whether the share_knock row of a session is written by one upsert.
+
+  A partitioned share_knock has no unique key on share_session to
+  upsert on, and only MySQL tells an upsert's insert from its update.
+  Otherwise the session's row is updated or else inserted.
+  """
+  return not config.SHARE_KNOCK_PARTITIONED and bind.dialect.name == 'mysql'
+
+
+def write_share_knock(conn, wish_id, openid, share_session, count, knock):
+  """Add to the share_knock row of `share_session`, returns if it is new."""
+  if not share_knock_upserted(conn):
+    if conn.execute(share_knock_update_sql(share_session, count,
+                                           knock)).rowcount:
+      return False
+    conn.execute(share_knock_insert_sql(wish_id, openid, share_session,
+                                        count, knock))
+    return True
+  res = conn.execute(
+      share_knock_upsert_sql(conn, wish_id, openid, share_session, count, knock)
   )
+  return upsert_inserted(conn, res)
+
+
+class WishShareUpdateView(BasicView):
+  args = WishShareUpdate
+
+  def handle(self, share_id: str, share_session: str, count: int, knock: int):
+    openid = self.openid
+    wish_id = get_wish_id_from_share_id(share_id)
+    if wish_id is None:
+      return make_err_response({'msg': 'wish not found'})
+    new_session = share_session is None
+    if new_session:
+      share_session = uuid4().hex
+
+    helper_sql = share_helper_sql(wish_id, count, knock)
+    hot = (helper_sql is not None and hot_wishes is not None and
+           hot_wishes.is_hot(wish_id))
+    conn = self.conn
+    with self.begin():
+      if hot:
+        conn.execute(share_slots.slot_sql(conn, wish_id, hot_wishes.slot(),
+                                          count, knock))
+      elif helper_sql is not None:
+        start = time.perf_counter()
+        conn.execute(helper_sql)
+        if hot_wishes is not None:
+          hot_wishes.observe(wish_id, time.perf_counter() - start)
+      inserted = write_share_knock(conn, wish_id, openid, share_session,
+                                   count, knock)
+      if count or knock:
+        new_session = new_session or inserted
+      conn.execute(rollup_session_sql(conn, share_session, count, knock,
+                                      helper=int(new_session)))
+      if count and (not hot or hot_wishes.refresh_due(wish_id)):
+        conn.execute(leaderboard.refresh_wishes_sql(conn, [wish_id],
+                                                    leaderboard.HELPED_BOARDS))
+    if helper_sql is not None:
+      # the owner's wish_list shows the share counters
+      bump_user(get_openid_from_wishid(wish_id))
+    return make_succ_response(
+        {'result': True,
+         'share_session': share_session}
+    )
+
+
+bp.add_url_rule('/api/wooden_fish/wish_share_update',
+                view_func=WishShareUpdateView.as_view('wish_share_update'))
+
+
+class Leaderboard(Schema):
+  board = fields.String(load_default='knock',
+                        validate=[OneOf(leaderboard.BOARDS)])
+  scope = fields.String(load_default='global',
+                        validate=[OneOf(['global', 'user'])])
+  limit = fields.Integer(load_default=10,
+                         validate=[Range(min=1, max=LEADERBOARD_MAX)])
+
+
+def leaderboard_columns(rows, openid):
+  scores = [i.score for i in rows]
+  # other users' wishes are only shown by id and score
+  return {'rank': leaderboard.ranks(scores),
+          'wish_id': [i.wish_id for i in rows],
+          'score': scores,
+          'self': [i.openid == openid for i in rows]}
+
+
+class LeaderboardView(BasicView):
+  args = Leaderboard
+  decorators = [read_only]
+
+  def handle(self, board: str, scope: str, limit: int):
+    openid = self.openid
+    flush_knocks(openid)
+
+    res = read_fetchall(leaderboard.top_sql(
+        board, limit, openid if scope == 'user' else None))
+    return make_succ_response(leaderboard_columns(res, openid))
+
+
+bp.add_url_rule('/api/wooden_fish/leaderboard',
+                view_func=LeaderboardView.as_view('wish_leaderboard'))
+
+
+class WishRank(Schema):
+  wish_id = fields.Integer(required=True, validate=[Range(min=0)])
+  board = fields.String(load_default='knock',
+                        validate=[OneOf(leaderboard.BOARDS)])
+
+
+class WishRankView(BasicView):
+  """A wish's score and rank, globally and among the user's wishes.
+
+  Ranks are only counted up to rank_limit, past it rank / user_rank are
+  null and the wish is ranked rank_limit+.
+  """
+  args = WishRank
+  decorators = [read_only]
+
+  def handle(self, wish_id: int, board: str):
+    openid = self.openid
+    if get_openid_from_wishid(wish_id) != openid:
+      return make_err_response({'msg': 'wish not found'})
+    flush_knocks(openid)
+
+    res = read_fetchall(leaderboard.score_sql(board, wish_id))
+    score = res[0][0] if res else 0
+    ahead = read_fetchall(leaderboard.ahead_sql(board, score))[0][0]
+    user_ahead = read_fetchall(
+        leaderboard.ahead_sql(board, score, openid))[0][0]
+    return make_succ_response({'score': score,
+                               'rank': leaderboard.rank(ahead),
+                               'user_rank': leaderboard.rank(user_ahead),
+                               'rank_limit': leaderboard.RANK_LIMIT})
+
+
+bp.add_url_rule('/api/wooden_fish/wish_rank',
+                view_func=WishRankView.as_view('wish_rank'))
+
+
+class WishHistory(Schema):
+  wish_id = fields.Integer(required=True, validate=[Range(min=0)])
+  start = fields.Date(required=True)
+  # defaults to today in the database, the day knocks are recorded on
+  end = fields.Date(load_default=None)
+
+
+class WishHistoryView(BasicView):
+  args = WishHistory
+  decorators = [read_only]
+
+  def handle(self, wish_id: int, start: date, end: date):
+    openid = self.openid
+    end = end or read_fetchall(knock_history.today_sql())[0][0]
+    days = knock_history.window(start, end)
+    if days is None:
+      return make_err_response({'msg': 'invalid date range'})
+    if get_openid_from_wishid(wish_id) != openid:
+      return make_err_response({'msg': 'wish not found'})
+    flush_knocks(openid)
+
+    res = read_fetchall(knock_history.range_sql(wish_id, start, end))
+    return make_succ_response(knock_history.dense(res, start, days))
+
+
+bp.add_url_rule('/api/wooden_fish/wish_history',
+                view_func=WishHistoryView.as_view('wish_history'))
+
+
+class Export(Schema):
+  # the cursor of the last line received, to resume an interrupted export
+  cursor = fields.String(load_default=None)
+
+
+class ExportView(BasicView):
+  args = Export
+  decorators = [read_only]
+
+  def handle(self, cursor: str):
+    openid = self.openid
+    try:
+      position = export.decode_cursor(cursor)
+    except ValueError:
+      return make_err_response({'msg': 'invalid cursor'})
+    flush_knocks(openid)
+
+    def generate():
+      # a server-side cursor of its own, held while the response streams
+      with router.connect(openid) as conn:
+        yield from export.export_lines(conn, openid, position)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+bp.add_url_rule('/api/wooden_fish/export',
+                view_func=ExportView.as_view('wish_export'))
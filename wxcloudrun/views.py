@@ -1,12 +1,23 @@
-from datetime import datetime
-from flask import render_template, request
-from run import app
-from wxcloudrun.dao import delete_counterbyid, query_counterbyid, insert_counter, update_counterbyid
+import os
+from flask import Blueprint, Response, render_template, request
+from sqlalchemy import select
+from wxcloudrun import db
+from wxcloudrun.counter_buffer import counter_buffer
+from wxcloudrun.dao import delete_counterbyid, increment_counter
+from wxcloudrun.knock_buffer import knock_buffer
+from wxcloudrun.metrics import register_collector, render
 from wxcloudrun.model import Counters
+from wxcloudrun.pool_stats import pool_stats
+from wxcloudrun.replica import read_fetchall, router
 from wxcloudrun.response import make_succ_empty_response, make_succ_response, make_err_response
+from wxcloudrun.share_cache import share_cache
+from wxcloudrun.share_slots import hot_wishes
+from wxcloudrun.startup import report as startup_report
 
+bp = Blueprint('views', __name__)
 
-@app.route('/')
+
+@bp.route('/')
 def index():
     """
     :return: 返回index页面
@@ -14,7 +25,7 @@ def index():
     return render_template('index.html')
 
 
-@app.route('/api/count', methods=['POST'])
+@bp.route('/api/count', methods=['POST'])
 def count():
     """
     :return:计数结果/清除结果
@@ -30,25 +41,20 @@ def count():
     # 按照不同的action的值，进行不同的操作
     action = params['action']
 
-    # 执行自增操作
+    # 执行自增操作：一条upsert原子累加并带回新值
     if action == 'inc':
-        counter = query_counterbyid(1)
-        if counter is None:
-            counter = Counters()
-            counter.id = 1
-            counter.count = 1
-            counter.created_at = datetime.now()
-            counter.updated_at = datetime.now()
-            insert_counter(counter)
+        if counter_buffer is not None:
+            count = counter_buffer.add(1)
         else:
-            counter.id = 1
-            counter.count += 1
-            counter.updated_at = datetime.now()
-            update_counterbyid(counter)
-        return make_succ_response(counter.count)
+            count = increment_counter(1)
+        if count is None:
+            return make_err_response('计数更新失败')
+        return make_succ_response(count)
 
     # 执行清0操作
     elif action == 'clear':
+        if counter_buffer is not None:
+            counter_buffer.discard(1)
         delete_counterbyid(1)
         return make_succ_empty_response()
 
@@ -57,10 +63,53 @@ def count():
         return make_err_response('action参数错误')
 
 
-@app.route('/api/count', methods=['GET'])
+@bp.route('/api/count', methods=['GET'])
 def get_count():
     """
     :return: 计数的值
     """
-    counter = Counters.query.filter(Counters.id == 1).first()
-    return make_succ_response(0) if counter is None else make_succ_response(counter.count)
+    table = Counters.__table__
+    res = read_fetchall(select(table.c.count).where(table.c.id == 1))
+    count = 0 if not res else res[0][0]
+    if counter_buffer is not None:
+        count += counter_buffer.pending(1)
+    return make_succ_response(count)
+
+
+@bp.route('/api/stats', methods=['GET'])
+def stats():
+    """
+    :return: 当前worker的连接池、写合并与分享缓存统计
+    """
+    return make_succ_response({
+        'pid': os.getpid(),
+        'pool': pool_stats.stats(db.engine.pool),
+        'knock_buffer': None if knock_buffer is None else knock_buffer.stats(),
+        'counter_buffer': None if counter_buffer is None else counter_buffer.stats(),
+        'share_cache': share_cache.stats(),
+        'hot_wishes': None if hot_wishes is None else hot_wishes.stats(),
+        'replica': router.stats(),
+        'startup': startup_report()
+    })
+
+
+register_collector('wooden_fish_pool', lambda: pool_stats.stats(db.engine.pool),
+                   gauges=('checkout_wait_max_seconds', 'size', 'checked_out', 'overflow'))
+register_collector('wooden_fish_share_cache', share_cache.stats, gauges=('size',))
+register_collector('wooden_fish_replica', router.stats)
+if knock_buffer is not None:
+    register_collector('wooden_fish_knock_buffer', knock_buffer.stats,
+                       gauges=('pending', 'flush_max_seconds'))
+if counter_buffer is not None:
+    register_collector('wooden_fish_counter_buffer', counter_buffer.stats,
+                       gauges=('flush_max_seconds',))
+if hot_wishes is not None:
+    register_collector('wooden_fish_hot_wishes', hot_wishes.stats, gauges=('hot',))
+
+
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    :return: Prometheus 文本格式的指标，汇总容器内所有worker
+    """
+    return Response(render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,49 @@
+import threading
+import time
+
+from flask import current_app
+
+
+class WriteBehind(object):
+  """Base of the per-worker write-behind buffers.
+
+  Subclasses buffer writes and implement flush(). A daemon thread calls
+  flush() every `interval` seconds once the first write arrives.
+  """
+
+  name = 'write-behind'
+
+  def __init__(self, interval):
+    self.interval = interval
+    self._lock = threading.Lock()
+    self._flush_lock = threading.Lock()
+    self._timer = None
+    # flushes run in timer threads and atexit, outside any request
+    self._app = None
+
+  def flush(self):
+    raise NotImplementedError
+
+  def _started(self):
+    """Remember the app of the current request and start the timer."""
+    self._app = current_app._get_current_object()
+    self._ensure_timer()
+
+  def _ensure_timer(self):
+    if self._timer is not None and self._timer.is_alive():
+      return
+    with self._lock:
+      if self._timer is not None and self._timer.is_alive():
+        return
+      self._timer = threading.Thread(target=self._run,
+                                     name=self.name,
+                                     daemon=True)
+      self._timer.start()
+
+  def _run(self):
+    while True:
+      time.sleep(self.interval)
+      try:
+        self.flush()
+      except Exception:
+        self._app.logger.exception('%s flush failed', self.name)